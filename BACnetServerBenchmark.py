@@ -0,0 +1,723 @@
+#
+# BACnet Server Example Benchmarks
+# Calls the CAS BACnet Stack callbacks of BACnetServerExample directly, the same way the stack does, without loading
+# the CAS BACnet Stack library.
+#
+# Usage: python BACnetServerBenchmark.py devices [--calls N]
+#        python BACnetServerBenchmark.py provision [--objects N]
+#        python BACnetServerBenchmark.py store [--objects N] [--calls N]
+#        python BACnetServerBenchmark.py updates [--objects N] [--calls N]
+#        python BACnetServerBenchmark.py ingest [--objects N] [--calls N]
+#        python BACnetServerBenchmark.py persist [--objects N] [--calls N]
+#        python BACnetServerBenchmark.py writelog [--objects N] [--calls N]
+#        python BACnetServerBenchmark.py stack [--objects N] [--seconds N] [--rates RATES]
+#        python BACnetServerBenchmark.py instrument [--calls N]
+#        python BACnetServerBenchmark.py startup [--runs N]
+#        python BACnetServerBenchmark.py adapters [--objects N] [--seconds N] [--rates RATES]
+#        python BACnetServerBenchmark.py shards [--workers 1,2,4] [--devices N] [--seconds N] [--rates RATES]
+#
+# The example, and the benchmarks that call its callbacks through the adapter, use the adapter backend selected with
+# BACNET_ADAPTER (ctypes by default, or cffi). "adapters" runs the stack benchmark with each backend and compares them.
+#
+
+import argparse
+import csv
+import ctypes
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import tempfile
+import time
+
+import BACnetServerExample as example
+import BACnetServerEventLoop
+import BACnetServerFakeStack
+import BACnetServerFieldSources
+import BACnetServerInstrumentation
+import BACnetServerPersistence
+import BACnetServerPointStore
+import BACnetServerProvisioning
+import BACnetServerStartup
+import BACnetServerUpdates
+import BACnetServerWriteLog
+from CASBACnetStackAdapter import *
+
+
+def TimeCalls(function, argumentList):
+    # Returns the average nanoseconds per call of function(*arguments) over the argument list
+    start = time.time()
+    for arguments in argumentList:
+        function(*arguments)
+    return (time.time() - start) * 1e9 / len(argumentList)
+
+
+def BenchmarkDevices(calls):
+    """Callback latency as the number of hosted devices grows from 1 to 10,000."""
+    print("devices   indexed properties   GetPropertyReal ns   GetPropertyEnumerated ns   GetPropertyCharString ns")
+
+    real = ctypes.c_float()
+    enumerated = ctypes.c_uint32()
+    charString = (ctypes.c_char * 256)()
+    elementCount = ctypes.c_uint32()
+    realPointer = ctypes.pointer(real)
+    enumeratedPointer = ctypes.pointer(enumerated)
+    elementCountPointer = ctypes.pointer(elementCount)
+
+    analogInput = bacnet_objectType["analogInput"]
+    binaryInput = bacnet_objectType["binaryInput"]
+    presentValue = bacnet_propertyIdentifier["presentValue"]
+    objectName = bacnet_propertyIdentifier["objectname"]
+
+    firstInstance = example.db["device"]["instance"]
+    example.IndexDatabase(example.db)
+    deviceInstances = [firstInstance]
+    for deviceCount in (1, 10, 100, 1000, 10000):
+        while len(deviceInstances) < deviceCount:
+            deviceInstance = firstInstance + len(deviceInstances)
+            example.IndexDatabase(example.CreateVirtualDevice(deviceInstance))
+            deviceInstances.append(deviceInstance)
+
+        # Spread the calls over every device so the index is not just hitting a few hot keys
+        targets = [random.choice(deviceInstances) for _ in range(calls)]
+        realResult = TimeCalls(example.CallbackGetPropertyReal, [
+            (device, analogInput, example.db["analogInput"]["instance"], presentValue, realPointer, False, 0)
+            for device in targets])
+        enumeratedResult = TimeCalls(example.CallbackGetPropertyEnumerated, [
+            (device, binaryInput, example.db["binaryInput"]["instance"], presentValue, enumeratedPointer, False, 0)
+            for device in targets])
+        charStringResult = TimeCalls(example.CallbackGetPropertyCharString, [
+            (device, analogInput, example.db["analogInput"]["instance"], objectName, charString,
+             elementCountPointer, 256, 0, False, 0)
+            for device in targets])
+        indexed = sum(len(index) for index in example.propertyIndex.values())
+        print("%7d   %18d   %18.0f   %24.0f   %24.0f" % (
+            deviceCount, indexed, realResult, enumeratedResult, charStringResult))
+
+
+class RegistrationCounter(object):
+    """Accepts the CAS BACnet Stack registration calls made by BACnetServerProvisioning and counts them, so the
+    benchmark measures the Python side of provisioning without the CAS BACnet Stack library."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def accept(self, *args):
+        self.calls += 1
+        return True
+
+    def __getattr__(self, name):
+        if name.startswith("BACnetStack_"):
+            return self.accept
+        raise AttributeError(name)
+
+
+def WritePointList(path, objectCount, objectsPerDevice=500):
+    # Writes a point list of input and value objects spread over devices of objectsPerDevice objects each
+    objectTypeNames = ("analogInput", "analogValue", "binaryInput", "binaryValue", "multiStateInput",
+                       "multiStateValue")
+    devices = []
+    for deviceIndex in range((objectCount + objectsPerDevice - 1) // objectsPerDevice):
+        deviceInstance = 400000 + deviceIndex
+        objects = []
+        for objectIndex in range(min(objectsPerDevice, objectCount - deviceIndex * objectsPerDevice)):
+            objectTypeName = objectTypeNames[objectIndex % len(objectTypeNames)]
+            record = {"type": objectTypeName, "instance": objectIndex, "objectName": "Point %d" % objectIndex,
+                      "presentValue": 1}
+            if objectTypeName.startswith("analog"):
+                record["units"] = 62
+                record["covIncrement"] = 1.0
+            elif objectTypeName.startswith("multiState"):
+                record["numberOfStates"] = 3
+                record["stateText"] = ["Off", "On", "Auto"]
+            objects.append(record)
+        devices.append({"instance": deviceInstance, "objectName": "Device %d" % deviceInstance, "objects": objects})
+
+    if path.endswith(".json"):
+        with open(path, "w") as jsonFile:
+            json.dump({"devices": devices}, jsonFile)
+        return
+
+    fields = ["device", "type", "instance", "objectName", "presentValue", "units", "covIncrement", "numberOfStates",
+              "stateText"]
+    with open(path, "w") as csvFile:
+        writer = csv.DictWriter(csvFile, fields)
+        writer.writeheader()
+        for device in devices:
+            writer.writerow({"device": device["instance"], "type": "device", "instance": device["instance"],
+                             "objectName": device["objectName"]})
+            for record in device["objects"]:
+                row = dict(record, device=device["instance"])
+                if "stateText" in row:
+                    row["stateText"] = "|".join(row["stateText"])
+                writer.writerow(row)
+
+
+def BenchmarkProvision(objectCount):
+    """Startup time of provisioning a point list of objectCount objects, from file to indexed properties."""
+    directory = tempfile.mkdtemp()
+    try:
+        for fileName in ("points.csv", "points.json"):
+            path = os.path.join(directory, fileName)
+            WritePointList(path, objectCount)
+            for index in example.propertyIndex.values():
+                index.clear()
+            example.devices.clear()
+
+            stack = RegistrationCounter()
+            report = BACnetServerProvisioning.ProvisioningReport()
+            start = time.time()
+            pointList = BACnetServerProvisioning.Load(path, report)
+            BACnetServerProvisioning.Validate(pointList, report)
+            BACnetServerProvisioning.Provision(stack, pointList, example.IndexDevice, report)
+            print("%s: total=%.3fs %s" % (fileName, time.time() - start, report.summary()))
+    finally:
+        shutil.rmtree(directory)
+
+
+def SizeOf(value, seen):
+    # Bytes used by value and everything it refers to that has not been counted yet (seen holds the ids counted)
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(SizeOf(key, seen) + SizeOf(item, seen) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(SizeOf(item, seen) for item in value)
+    elif hasattr(value, "__slots__"):
+        for cls in type(value).__mro__:
+            for name in getattr(cls, "__slots__", ()):
+                if hasattr(value, name):
+                    size += SizeOf(getattr(value, name), seen)
+    return size
+
+
+def BenchmarkStore(objectCount, calls):
+    """Bytes per point and getter latency of the object record (db) layout against the point store."""
+    print("layout    objects   bytes/object   GetPropertyReal ns   GetPropertyUInt ns")
+    real = ctypes.c_float()
+    unsigned = ctypes.c_uint32()
+    realPointer = ctypes.pointer(real)
+    unsignedPointer = ctypes.pointer(unsigned)
+    analogInput = bacnet_objectType["analogInput"]
+    multiStateInput = bacnet_objectType["multiStateInput"]
+    presentValue = bacnet_propertyIdentifier["presentValue"]
+    deviceInstance = 400000
+
+    for layout in ("records", "store"):
+        for index in example.propertyIndex.values():
+            index.clear()
+        example.devices.clear()
+        example.pointStore = BACnetServerPointStore.PointStore() if layout == "store" else None
+
+        # Half analog inputs, half multi-state inputs, like the points of a typical controller
+        pointList = BACnetServerProvisioning.PointList()
+        objects = pointList.addDevice({"instance": deviceInstance, "objectName": "Device", "vendorname": "Example",
+                                       "vendoridentifier": 0})
+        for objectInstance in range(objectCount // 2):
+            objects.append(("analogInput", {"instance": objectInstance, "objectName": "AI %d" % objectInstance,
+                                            "presentValue": 20.5, "units": 62, "reliability": 0,
+                                            "covIncrement": 1.0}))
+            objects.append(("multiStateInput", {"instance": objectInstance, "objectName": "MSI %d" % objectInstance,
+                                                "presentValue": 1, "numberOfStates": 3,
+                                                "stateText": ["Off", "On", "Auto"]}))
+        example.IndexDevice(objects)
+        del pointList, objects
+
+        # Everything the property index refers to, but not the index itself, which is the same for both layouts
+        seen = set()
+        size = sum(SizeOf(accessor, seen) for index in example.propertyIndex.values()
+                   for accessor in index.values())
+        if example.pointStore is not None:
+            size += SizeOf(example.pointStore.columns, seen)
+
+        instances = [random.randrange(objectCount // 2) for _ in range(calls)]
+        realResult = TimeCalls(example.CallbackGetPropertyReal, [
+            (deviceInstance, analogInput, objectInstance, presentValue, realPointer, False, 0)
+            for objectInstance in instances])
+        unsignedResult = TimeCalls(example.CallbackGetPropertyUInt, [
+            (deviceInstance, multiStateInput, objectInstance, presentValue, unsignedPointer, False, 0)
+            for objectInstance in instances])
+        print("%-7s   %7d   %12.0f   %18.0f   %18.0f" % (
+            layout, objectCount, float(size) / objectCount, realResult, unsignedResult))
+        if example.pointStore is not None:
+            print("Point store: " + example.pointStore.summary())
+
+
+def BenchmarkUpdates(objectCount, updateCount, batchSize=1000):
+    """ValueUpdated calls made for a field bus reporting small analog changes, one call per update against the
+    ChangeBatcher. ValueUpdated is a foreign function with the argtypes of BACnetStack_ValueUpdated, calling a
+    CFUNCTYPE counter, so every call pays the ctypes conversion the CAS BACnet Stack call would, and a little more."""
+    for index in example.propertyIndex.values():
+        index.clear()
+    example.devices.clear()
+    example.pointStore = BACnetServerPointStore.PointStore()
+
+    deviceInstance = 400000
+    pointList = BACnetServerProvisioning.PointList()
+    objects = pointList.addDevice({"instance": deviceInstance, "objectName": "Device", "vendorname": "Example",
+                                   "vendoridentifier": 0})
+    for objectInstance in range(objectCount):
+        objects.append(("analogInput", {"instance": objectInstance, "objectName": "AI %d" % objectInstance,
+                                        "presentValue": 20.0, "units": 62, "covIncrement": 1.0}))
+    example.IndexDevice(objects)
+
+    # Random walk of +-0.1 per update
+    analogInput = bacnet_objectType["analogInput"]
+    presentValue = bacnet_propertyIdentifier["presentValue"]
+    values = [20.0] * objectCount
+    updates = []
+    for _ in range(updateCount):
+        objectInstance = random.randrange(objectCount)
+        values[objectInstance] += random.choice((-0.1, 0.1))
+        updates.append((deviceInstance, analogInput, objectInstance, presentValue, values[objectInstance]))
+
+    calls = [0]
+
+    def CountValueUpdated(deviceInstance, objectType, objectInstance, propertyIdentifier):
+        calls[0] += 1
+    restype, argtypes = casbacnetstack_functions["BACnetStack_ValueUpdated"]
+    prototype = ctypes.CFUNCTYPE(restype, *argtypes)
+    counter = prototype(CountValueUpdated)
+    valueUpdated = prototype(ctypes.cast(counter, ctypes.c_void_p).value)
+
+    # One accessor set and one ValueUpdated call per update
+    start = time.time()
+    index = example.propertyIndex["real"]
+    for deviceInstance, objectType, objectInstance, propertyIdentifier, value in updates:
+        index[(deviceInstance, objectType, objectInstance, propertyIdentifier)].set(value, False, 0)
+        valueUpdated(deviceInstance, objectType, objectInstance, propertyIdentifier)
+    duration = time.time() - start
+    print("per update:   updates=%d valueUpdatedCalls=%d time=%.3fs" % (updateCount, calls[0], duration))
+
+    calls[0] = 0
+    batcher = BACnetServerUpdates.ChangeBatcher(example.propertyIndex, valueUpdated, presentValue,
+                                                bacnet_propertyIdentifier["covincrement"])
+    start = time.time()
+    for offset in range(0, updateCount, batchSize):
+        batcher.apply(updates[offset:offset + batchSize])
+    duration = time.time() - start
+    print("batched:      updates=%d valueUpdatedCalls=%d time=%.3fs" % (updateCount, calls[0], duration))
+    print("Batcher: " + batcher.summary())
+
+
+def BenchmarkIngest(objectCount, updateCount, linesPerDatagram=100):
+    """Throughput and lag of updates sent to a UNIX domain socket field source, committed by the event loop."""
+    for index in example.propertyIndex.values():
+        index.clear()
+    example.devices.clear()
+    example.pointStore = BACnetServerPointStore.PointStore()
+
+    deviceInstance = 400000
+    pointList = BACnetServerProvisioning.PointList()
+    objects = pointList.addDevice({"instance": deviceInstance, "objectName": "Device", "vendorname": "Example",
+                                   "vendoridentifier": 0})
+    for objectInstance in range(objectCount):
+        objects.append(("analogInput", {"instance": objectInstance, "objectName": "AI %d" % objectInstance,
+                                        "presentValue": 20.0, "units": 62, "covIncrement": 1.0}))
+    example.IndexDevice(objects)
+
+    batcher = BACnetServerUpdates.ChangeBatcher(example.propertyIndex, lambda *key: None,
+                                                bacnet_propertyIdentifier["presentValue"],
+                                                bacnet_propertyIdentifier["covincrement"])
+    coalescer = BACnetServerFieldSources.Coalescer()
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "ingest.sock")
+    source = BACnetServerFieldSources.UnixSocketSource(path)
+    source.start(coalescer)
+    while not os.path.exists(path):
+        time.sleep(0.01)
+
+    def Send():
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        for offset in range(0, updateCount, linesPerDatagram):
+            now = time.time()
+            lines = "".join("%d,analogInput,%d,presentValue,%.2f,%.6f\n" % (
+                deviceInstance, random.randrange(objectCount), random.uniform(0.0, 100.0), now)
+                for _ in range(min(linesPerDatagram, updateCount - offset)))
+            while True:
+                try:
+                    sender.sendto(lines.encode("utf-8"), path)
+                    break
+                except socket.error:
+                    # The socket buffer is full, let the source catch up
+                    time.sleep(0.001)
+        sender.close()
+
+    # The event loop commits the coalesced updates before every (empty) tick, like the example does
+    eventLoop = BACnetServerEventLoop.EventLoop(lambda: coalescer.commit(batcher.apply), maxIdleInterval=0.1)
+    eventLoop.addSocket(coalescer.wakeup.socket)
+    sender = threading.Thread(target=Send)
+    start = time.time()
+    sender.start()
+    while coalescer.received < updateCount and (sender.is_alive() or coalescer.hasPending() or
+                                                time.time() - start < 60):
+        eventLoop.runOnce()
+    coalescer.commit(batcher.apply)
+    duration = time.time() - start
+    sender.join()
+    source.stop()
+    source.thread.join()
+    shutil.rmtree(directory, ignore_errors=True)
+
+    print("updates=%d time=%.3fs updatesPerSecond=%.0f" % (coalescer.received, duration,
+                                                            coalescer.received / duration))
+    print("Coalescer: " + coalescer.summary())
+    print("Event loop: " + eventLoop.stats.summary())
+
+
+def BenchmarkPersist(objectCount, calls):
+    """Cost of CallbackSetPropertyReal with and without the persistent store, and the warm start restore time."""
+    for index in example.propertyIndex.values():
+        index.clear()
+    example.devices.clear()
+    example.pointStore = BACnetServerPointStore.PointStore()
+
+    deviceInstance = 400000
+    pointList = BACnetServerProvisioning.PointList()
+    objects = pointList.addDevice({"instance": deviceInstance, "objectName": "Device", "vendorname": "Example",
+                                   "vendoridentifier": 0})
+    for objectInstance in range(objectCount):
+        objects.append(("analogValue", {"instance": objectInstance, "objectName": "AV %d" % objectInstance,
+                                        "presentValue": 0.0, "units": 62, "covIncrement": 1.0}))
+    example.IndexDevice(objects)
+
+    presentValue = bacnet_propertyIdentifier["presentValue"]
+    argumentList = [(deviceInstance, bacnet_objectType["analogValue"], random.randrange(objectCount), presentValue,
+                     random.uniform(0.0, 100.0), False, 0, 16, None) for _ in range(calls)]
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "state.dat")
+    example.persistentStore = None
+    print("memory only: %.0f ns/write" % TimeCalls(example.CallbackSetPropertyReal, argumentList))
+    example.persistentStore = BACnetServerPersistence.PersistentStore(path)
+    print("persistent:  %.0f ns/write" % TimeCalls(example.CallbackSetPropertyReal, argumentList))
+    start = time.time()
+    example.persistentStore.flush()
+    print("flush:       %.3f ms" % ((time.time() - start) * 1000.0))
+    print("Persistent store: " + example.persistentStore.summary())
+    example.persistentStore.close()
+    example.persistentStore = None
+
+    start = time.time()
+    store = BACnetServerPersistence.PersistentStore(path)
+    restored = example.RestorePersistedValues(store.items())
+    print("warm start:  values=%d time=%.3f ms" % (restored, (time.time() - start) * 1000.0))
+    store.close()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def BenchmarkWriteLog(objectCount, writeCount, writesPerTick=100, commandedFraction=0.1):
+    """Cost of logging writes with one commit (fsync) per tick, compared with one per write, and the startup replay
+    time compared with restoring a JSON snapshot of every writable property. The writes go to a fraction of the
+    objects, the setpoints operators command."""
+    for index in example.propertyIndex.values():
+        index.clear()
+    example.devices.clear()
+    example.pointStore = BACnetServerPointStore.PointStore()
+
+    deviceInstance = 400000
+    pointList = BACnetServerProvisioning.PointList()
+    objects = pointList.addDevice({"instance": deviceInstance, "objectName": "Device", "vendorname": "Example",
+                                   "vendoridentifier": 0})
+    for objectInstance in range(objectCount):
+        objects.append(("analogValue", {"instance": objectInstance, "objectName": "AV %d" % objectInstance,
+                                        "presentValue": 0.0, "units": 62, "covIncrement": 1.0}))
+    example.IndexDevice(objects)
+
+    presentValue = bacnet_propertyIdentifier["presentValue"]
+    commandedCount = max(1, int(objectCount * commandedFraction))
+    argumentList = [(deviceInstance, bacnet_objectType["analogValue"], random.randrange(commandedCount),
+                     presentValue, random.uniform(0.0, 100.0), False, 0, random.randint(1, 16), None)
+                    for _ in range(writeCount)]
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "writes.log")
+    example.persistentStore = None
+
+    # Group commit, like the example: the writes of a tick share one commit
+    example.writeLog = BACnetServerWriteLog.WriteAheadLog(path)
+    start = time.time()
+    for offset in range(0, writeCount, writesPerTick):
+        for arguments in argumentList[offset:offset + writesPerTick]:
+            example.CallbackSetPropertyReal(*arguments)
+        example.writeLog.commit()
+    duration = time.time() - start
+    print("group commit: writes=%d writesPerTick=%d %.0f ns/write" % (writeCount, writesPerTick,
+                                                                         duration * 1e9 / writeCount))
+    print("Write log: " + example.writeLog.summary())
+    example.writeLog.close()
+
+    # One commit per write, for a fraction of the writes
+    singleCount = max(1, writeCount // 100)
+    example.writeLog = BACnetServerWriteLog.WriteAheadLog(path + ".single")
+    start = time.time()
+    for arguments in argumentList[:singleCount]:
+        example.CallbackSetPropertyReal(*arguments)
+        example.writeLog.commit()
+    duration = time.time() - start
+    print("commit each:  writes=%d %.0f ns/write" % (singleCount, duration * 1e9 / singleCount))
+    example.writeLog.close()
+    example.writeLog = None
+
+    # Startup: replay and compact the log, and restore the written values
+    start = time.time()
+    writeLog = BACnetServerWriteLog.WriteAheadLog(path)
+    restored = example.RestorePersistedValues(writeLog.items())
+    print("replay:       records=%d values=%d time=%.3f ms" % (writeLog.replayed, restored,
+                                                              (time.time() - start) * 1000.0))
+    writeLog.close()
+
+    # Startup from a snapshot of every writable property
+    snapshotPath = os.path.join(directory, "snapshot.json")
+    with open(snapshotPath, "w") as snapshotFile:
+        json.dump([(dataType, key, accessor.get(False, 0))
+                   for dataType, index in example.propertyIndex.items() if dataType != "characterString"
+                   for key, accessor in index.items() if accessor.writable], snapshotFile)
+    start = time.time()
+    with open(snapshotPath) as snapshotFile:
+        snapshot = json.load(snapshotFile)
+    restored = example.RestorePersistedValues((dataType, tuple(key), value) for dataType, key, value in snapshot)
+    print("snapshot:     values=%d time=%.3f ms" % (restored, (time.time() - start) * 1000.0))
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def BenchmarkStack(objectCount, seconds, rates):
+    """Callbacks per second and latency per callback with the fake stack driving the registered callbacks."""
+    for index in example.propertyIndex.values():
+        index.clear()
+    example.devices.clear()
+    example.pointStore = BACnetServerPointStore.PointStore()
+    example.persistentStore = None
+    example.writeLog = None
+    # The fake stack polls CallbackReceiveMessage every tick
+    for port in example.ipPorts.ports:
+        port.socket.setblocking(False)
+
+    stack = BACnetServerFakeStack.FakeStack(BACnetServerFakeStack.ParseRates(rates), adapter=example.adapter)
+    example.RegisterCallbacks(stack)
+    path = os.path.join(tempfile.mkdtemp(), "points.json")
+    WritePointList(path, objectCount)
+    pointList = BACnetServerProvisioning.Load(path)
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    BACnetServerProvisioning.Provision(stack, pointList, example.IndexDevice)
+
+    print("objects=%d seconds=%.1f rates=%s backend=%s" % (len(stack.objects), seconds, stack.rates,
+                                                           example.adapter.adapterBackend))
+    stack.run(seconds, tickInterval=0.001)
+    print("Fake stack: " + stack.summary())
+    print("%-28s %10s %10s %10s %10s %10s" % ("callback", "calls", "false", "p50 us", "p99 us", "max us"))
+    for name, calls, failures, p50, p99, maximum in stack.report():
+        print("%-28s %10d %10d %10.1f %10.1f %10.1f" % (name, calls, failures, p50 * 1e6, p99 * 1e6, maximum * 1e6))
+
+
+def BenchmarkInstrument(calls):
+    """Cost of the callback instrumentation, disabled and enabled, for a CallbackGetPropertyReal called through
+    ctypes like the CAS BACnet Stack does."""
+    example.IndexDatabase(example.db)
+    deviceInstance = example.db["device"]["instance"]
+    value = ctypes.c_float()
+    argumentList = [(deviceInstance, bacnet_objectType["analogInput"], example.db["analogInput"]["instance"],
+                     bacnet_propertyIdentifier["presentValue"], ctypes.byref(value), False, 0)] * calls
+
+    instrumentation = BACnetServerInstrumentation.Instrumentation()
+    plain = fpCallbackGetPropertyReal(example.CallbackGetPropertyReal)
+    wrapped = fpCallbackGetPropertyReal(instrumentation.wrap(example.CallbackGetPropertyReal))
+    plainTime = TimeCalls(plain, argumentList)
+    disabledTime = TimeCalls(wrapped, argumentList)
+    instrumentation.enabled = True
+    enabledTime = TimeCalls(wrapped, argumentList)
+    print("not wrapped: %.0f ns/call" % plainTime)
+    print("disabled:    %.0f ns/call (+%.0f ns)" % (disabledTime, disabledTime - plainTime))
+    print("enabled:     %.0f ns/call (+%.0f ns)" % (enabledTime, enabledTime - plainTime))
+    for instrument in instrumentation.report():
+        print(instrument.summary())
+
+
+def BenchmarkStartup(runs):
+    """Time from process start to the main loop, by startup phase, running the example with the fake stack."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BACnetServerExample.py")
+    environment = dict(os.environ, BACNET_FAKE_STACK="", BACNET_STATE_FILE="", BACNET_WRITE_LOG="")
+    phaseTimes = {}
+    phaseOrder = []
+    spawnTimes = []
+    for run in range(runs):
+        start = time.time()
+        process = subprocess.Popen([sys.executable, "-u", script], stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, env=environment, cwd=tempfile.gettempdir())
+        try:
+            for line in iter(process.stdout.readline, b""):
+                line = line.decode("utf-8", "replace")
+                if line.startswith("FYI: Startup phases: "):
+                    wallTime = (time.time() - start) * 1000.0
+                    phases = BACnetServerStartup.ParseSummary(line[len("FYI: Startup phases: "):])
+                    for phase, milliseconds in phases:
+                        if phase not in phaseTimes:
+                            phaseOrder.append(phase)
+                            phaseTimes[phase] = []
+                        phaseTimes[phase].append(milliseconds)
+                    # Interpreter startup, before the first line of the example runs
+                    spawnTimes.append(wallTime - dict(phases).get("total", 0.0))
+                    break
+            else:
+                print("The example exited before entering its main loop")
+                return
+        finally:
+            process.kill()
+            process.wait()
+
+    print("runs=%d" % runs)
+    print("%-12s %10s %10s %10s" % ("phase", "median ms", "min ms", "max ms"))
+    for phase, times in [("interpreter", spawnTimes)] + [(phase, phaseTimes[phase]) for phase in phaseOrder]:
+        times = sorted(times)
+        print("%-12s %10.1f %10.1f %10.1f" % (phase, times[len(times) // 2], times[0], times[-1]))
+
+
+def BenchmarkAdapters(objectCount, seconds, rates, backends=("ctypes", "cffi")):
+    """Callbacks per second of the stack benchmark with each adapter backend, each run in its own process with the
+    same interpreter (so it compares the backends under PyPy when run with PyPy)."""
+    script = os.path.abspath(__file__)
+    print("interpreter=%s objects=%d seconds=%.1f rates=%s" % (sys.executable, objectCount, seconds, rates))
+    print("%-8s %20s %24s %14s %14s" % ("backend", "callbacks/second", "busy callbacks/second", "GetReal p50 us",
+                                        "GetReal p99 us"))
+    for backend in backends:
+        process = subprocess.Popen([sys.executable, "-u", script, "stack", "--objects", str(objectCount),
+                                    "--seconds", str(seconds), "--rates", rates],
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   env=dict(os.environ, BACNET_ADAPTER=backend))
+        output = process.communicate()[0].decode("utf-8", "replace")
+        summary = {}
+        latencies = ("-", "-")
+        for line in output.splitlines():
+            if line.startswith("Fake stack: "):
+                summary = dict(item.partition("=")[::2] for item in line[len("Fake stack: "):].split()
+                               if "=" in item)
+            elif line.startswith("GetPropertyReal "):
+                latencies = tuple(line.split()[4:6])
+        if process.returncode != 0 or "callbacksPerSecond" not in summary:
+            print("%-8s failed: %s" % (backend, (output.strip().splitlines() or ["no output"])[-1]))
+            continue
+        print("%-8s %20s %24s %14s %14s" % (backend, summary["callbacksPerSecond"],
+                                            summary["busyCallbacksPerSecond"], latencies[0], latencies[1]))
+
+
+def RoutedReadProperty(deviceInstance):
+    """A BACnet/IP ReadProperty of the presentValue of analogInput 0, routed to a virtual device on the virtual
+    network of the example (BACNET_VIRTUAL_NETWORK)."""
+    npdu = (b"\x01\x24" + struct.pack("!HB", example.virtualNetwork, 4) +
+            bytes(example.VirtualAddress(deviceInstance)) + b"\xff\x00\x05\x01\x0c\x0c\x00\x00\x00\x00\x19\x55")
+    return b"\x81\x0a" + struct.pack("!H", 4 + len(npdu)) + npdu
+
+
+def BenchmarkShards(workerCounts, deviceCount, seconds, rates, datagramRate=200.0):
+    """Callbacks per second of the example with the fake stack, gateway devices and BACNET_WORKERS set to each worker
+    count. The fake stack rates are the total, split between the workers, so with rates above what one core can serve
+    the callbacks per second show how the workers scale with cores. Routed requests for random devices are sent to
+    the loopback interface meanwhile, to show how many were steered to another worker."""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "BACnetServerExample.py")
+    firstDevice = example.db["device"]["instance"] + 1
+    totalRates = BACnetServerFakeStack.ParseRates(rates)
+    print("devices=%d seconds=%.1f rates=%s cores=%d" % (deviceCount, seconds, totalRates,
+                                                           multiprocessing.cpu_count()))
+    print("%7s %20s %8s %10s %10s %10s %12s" % ("workers", "callbacks/second", "speedup", "datagrams", "received",
+                                                "steered", "forwardedIn"))
+    baseline = None
+    for workerCount in workerCounts:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(("127.0.0.1", 0))
+        udpPort = probe.getsockname()[1]
+        probe.close()
+        workerRates = ",".join("%s=%s" % (name, rate / workerCount) for name, rate in totalRates.items())
+        environment = dict(os.environ, BACNET_WORKERS=str(workerCount), BACNET_GATEWAY_DEVICES=str(deviceCount),
+                           BACNET_FAKE_STACK=workerRates, BACNET_INTERFACES="lo:%d" % udpPort, BACNET_STATE_FILE="",
+                           BACNET_WRITE_LOG="")
+        process = subprocess.Popen([sys.executable, "-u", script], stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, env=environment, cwd=tempfile.gettempdir())
+        output = []
+        started = threading.Event()
+
+        def Read():
+            for line in iter(process.stdout.readline, b""):
+                output.append(line.decode("utf-8", "replace").rstrip())
+                if sum(1 for entry in output if entry.startswith("FYI: Entering main loop")) >= workerCount:
+                    started.set()
+        reader = threading.Thread(target=Read)
+        reader.daemon = True
+        reader.start()
+        if not started.wait(60.0):
+            process.kill()
+            print("%7d failed: the workers did not start" % workerCount)
+            continue
+
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sent = 0
+        end = time.time() + seconds
+        while time.time() < end:
+            sender.sendto(RoutedReadProperty(random.randint(firstDevice, firstDevice + deviceCount - 1)),
+                          ("127.0.0.1", udpPort))
+            sent += 1
+            time.sleep(1.0 / datagramRate)
+        sender.close()
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+        reader.join(5.0)
+
+        total = [line for line in output if line.startswith("FYI: Shards: total ")]
+        if not total:
+            print("%7d failed: no shard report" % workerCount)
+            continue
+        values = dict(item.partition("=")[::2] for item in total[-1].split() if "=" in item)
+        callbacksPerSecond = float(values["callbacksPerSecond"])
+        baseline = baseline or callbacksPerSecond
+        print("%7d %20.0f %8.2f %10d %10s %10s %12s" % (workerCount, callbacksPerSecond, callbacksPerSecond / baseline,
+                                                        sent, values["received"], values["steered"],
+                                                        values["forwardedIn"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="BACnet Server Example benchmarks")
+    parser.add_argument("benchmark", choices=["devices", "provision", "store", "updates", "ingest", "persist",
+                                              "writelog", "stack", "instrument", "startup", "adapters", "shards"])
+    parser.add_argument("--calls", type=int, default=100000, help="Callback calls per measurement")
+    parser.add_argument("--objects", type=int, default=None,
+                        help="Objects in the point list (default 50,000) or point store (default 100,000)")
+    parser.add_argument("--seconds", type=float, default=5.0,
+                        help="Duration of the stack benchmark, for each backend of the adapters benchmark")
+    parser.add_argument("--runs", type=int, default=5, help="Example runs of the startup benchmark")
+    parser.add_argument("--workers", default="1,2,4", help="Worker counts of the shards benchmark")
+    parser.add_argument("--devices", type=int, default=1000, help="Gateway devices of the shards benchmark")
+    parser.add_argument("--rates", default="readProperty=20000,readPropertyMultiple=1,writeProperty=500",
+                        help="Requests per second made by the fake stack")
+    args = parser.parse_args()
+
+    if args.benchmark == "devices":
+        BenchmarkDevices(args.calls)
+    elif args.benchmark == "provision":
+        BenchmarkProvision(args.objects or 50000)
+    elif args.benchmark == "store":
+        BenchmarkStore(args.objects or 100000, args.calls)
+    elif args.benchmark == "updates":
+        BenchmarkUpdates(args.objects or 10000, args.calls)
+    elif args.benchmark == "ingest":
+        BenchmarkIngest(args.objects or 10000, args.calls)
+    elif args.benchmark == "persist":
+        BenchmarkPersist(args.objects or 10000, args.calls)
+    elif args.benchmark == "writelog":
+        BenchmarkWriteLog(args.objects or 10000, args.calls)
+    elif args.benchmark == "stack":
+        BenchmarkStack(args.objects or 10000, args.seconds, args.rates)
+    elif args.benchmark == "instrument":
+        BenchmarkInstrument(args.calls)
+    elif args.benchmark == "startup":
+        BenchmarkStartup(args.runs)
+    elif args.benchmark == "adapters":
+        BenchmarkAdapters(args.objects or 10000, args.seconds, args.rates)
+    elif args.benchmark == "shards":
+        BenchmarkShards([int(count) for count in args.workers.split(",")], args.devices, args.seconds, args.rates)
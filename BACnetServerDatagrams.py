@@ -0,0 +1,360 @@
+#
+# BACnet Server Example Datagram Ingestion
+# Drains every pending datagram off the BACnet/IP socket into a bounded ring of preallocated buffers. The CAS BACnet
+# Stack then reads one datagram per CallbackReceiveMessage call from the ring, so bursts of Who-Is or COV traffic are
+# moved out of the kernel socket buffer before it overflows.
+#
+# Python does not expose recvmmsg(), so the ring is filled with a tight recvfrom_into() loop straight into the
+# preallocated slots. No per-datagram objects are allocated except the peer address.
+#
+# The ring has a single producer (fill) and a single consumer (receive) that each only advance their own counter, so
+# the ThreadedReceiver can fill it from a background thread without any locks.
+#
+# With timestamping on, every datagram carries the time the kernel received it (ArrivalTime), and the ring measures the
+# delay from then to the CAS BACnet Stack taking it: the time a request waits for the event loop, the receiver thread
+# and any datagrams ahead of it.
+#
+
+import ctypes
+import errno
+try:
+    import fcntl
+except ImportError:
+    # Not on Windows
+    fcntl = None
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from BACnetServerEventLoop import Wakeup
+
+# CAS BACnet Stack IP connection string: 4 byte IP address followed by a 2 byte UDP port, network byte order
+connectionStringStruct = struct.Struct("!4sH")
+
+# 1500 bytes covers the largest BACnet/IP datagram
+defaultSlotSize = 1500
+
+# Errors that just mean there is nothing (more) to read
+wouldBlockErrors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Linux ioctl returning the time the kernel received the last datagram read from a socket, as a struct timeval
+siocgstamp = 0x8906
+timevalStruct = struct.Struct("@ll")
+timevalBuffer = b"\x00" * timevalStruct.size
+
+
+def EnableArrivalTimes(sock):
+    # Has the kernel timestamp every datagram it receives for sock, from the first one on. Linux only. The first
+    # SIOCGSTAMP turns the timestamps on (and fails, nothing was received yet). SO_TIMESTAMP would not do: with it,
+    # the timestamps go to recvmsg() ancillary data only.
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(sock.fileno(), siocgstamp, timevalBuffer)
+        except (IOError, OSError):
+            pass
+
+
+def ArrivalTime(sock):
+    # When the kernel received the datagram just read from sock. The current time where the kernel does not say: not
+    # Linux, or a datagram received before timestamps were enabled (see EnableArrivalTimes).
+    if fcntl is not None:
+        try:
+            seconds, microseconds = timevalStruct.unpack(fcntl.ioctl(sock.fileno(), siocgstamp, timevalBuffer))
+            return seconds + microseconds * 1e-6
+        except (IOError, OSError):
+            pass
+    return time.time()
+
+
+def KernelDropCount(sock):
+    # Linux only. Returns the number of datagrams the kernel dropped for this socket because its receive buffer was
+    # full (the "drops" column of /proc/net/udp), or None if it is not available.
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+        with open("/proc/net/udp") as udpTable:
+            next(udpTable)
+            for line in udpTable:
+                fields = line.split()
+                if len(fields) > 12 and fields[9] == inode:
+                    return int(fields[12])
+    except (IOError, OSError, ValueError, StopIteration):
+        pass
+    return None
+
+
+def DatagramWaiting(sock):
+    # True if a datagram is queued in the kernel for sock. Does not block.
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (select.error, socket.error):
+        return False
+    return len(readable) > 0
+
+
+def DirectedBroadcastAddress(ipAddress, subnetMask):
+    """The directed broadcast address of a subnet as a dotted string, from 4 octet lists of the IP address and the
+    subnet mask: every host bit set."""
+    return ".".join(str((address & mask) | (~mask & 0xFF)) for address, mask in zip(ipAddress, subnetMask))
+
+
+class DatagramSender(object):
+    """Sends the datagrams of the CAS BACnet Stack and counts them. A failed send is counted instead of raised."""
+
+    def __init__(self, sock):
+        self.sock = sock
+
+        # Counters
+        self.sent = 0
+        self.bytesSent = 0
+        self.broadcasts = 0
+        self.errors = 0
+
+    def send(self, data, destination):
+        # Returns the number of bytes sent, 0 if the send failed
+        try:
+            length = self.sock.sendto(data, destination)
+        except socket.error:
+            self.errors += 1
+            return 0
+        self.sent += 1
+        self.bytesSent += length
+        return length
+
+    def broadcast(self, data, destinations):
+        # Sends one broadcast to every destination. Returns the number of bytes sent to the last one that succeeded.
+        self.broadcasts += 1
+        result = 0
+        for destination in destinations:
+            result = self.send(data, destination) or result
+        return result
+
+    def summary(self):
+        return "sent=%d bytesSent=%d broadcasts=%d errors=%d" % (self.sent, self.bytesSent, self.broadcasts,
+                                                                  self.errors)
+
+
+class DatagramRing(object):
+    """A bounded ring of preallocated datagram buffers filled from a non-blocking UDP socket."""
+
+    def __init__(self, sock, slots=256, slotSize=defaultSlotSize, memmove=None):
+        self.sock = sock
+        # memmove(destination, source, length) of the adapter backend the stack buffers come from
+        self.memmove = ctypes.memmove if memmove is None else memmove
+        self.size = slots
+        self.slotSize = slotSize
+        self.buffers = [(ctypes.c_uint8 * slotSize)() for _ in range(slots)]
+        self.lengths = [0] * slots
+        self.peers = [None] * slots
+        self.timestamps = [0.0] * slots
+        self.timestamping = False
+        # steer(buffer, length, peer): called for every datagram read off the socket when set. A datagram it returns
+        # False for is dropped from the ring (see BACnetServerSharding, which hands it to another worker).
+        self.steer = None
+        self.peerCache = {}
+        # Total number of datagrams written into, and read from, the ring. Only the producer advances produced and
+        # only the consumer advances consumed.
+        self.produced = 0
+        self.consumed = 0
+
+        # Counters
+        self.received = 0
+        self.bytesReceived = 0
+        self.drains = 0
+        self.largestBatch = 0
+        self.highWater = 0
+        # Number of times the ring filled up while datagrams were still queued in the kernel. Counted once until the
+        # backlog is drained, however many fills find the ring full meanwhile.
+        self.overflows = 0
+        self.overflowing = False
+        self.errors = 0
+        self.steered = 0
+        # Seconds between the kernel receiving a datagram and the stack taking it from the ring. Only measured when
+        # timestamping is enabled.
+        self.queueDelayTotal = 0.0
+        self.queueDelayMax = 0.0
+
+    @property
+    def count(self):
+        # Number of datagrams waiting in the ring
+        return self.produced - self.consumed
+
+    def setReceiveBufferSize(self, size):
+        # Asks the kernel for a larger socket receive buffer. Returns the size the kernel actually granted.
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+        except socket.error:
+            self.errors += 1
+        return self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+    def packPeer(self, addr):
+        peer = self.peerCache.get(addr)
+        if peer is None:
+            if len(self.peerCache) >= 1024:
+                self.peerCache.clear()
+            peer = self.peerCache[addr] = connectionStringStruct.pack(socket.inet_aton(addr[0]), addr[1])
+        return peer
+
+    def fill(self):
+        # Producer. Reads every pending datagram off the socket into the ring. Stops when the socket would block or
+        # the ring is full, in which case the remaining datagrams stay queued in the kernel. An overflow is counted then
+        # if there are any, unless the ring has been full with datagrams held back since an earlier fill.
+        batch = 0
+        sock = self.sock
+        steer = self.steer
+        produced = self.produced
+        while True:
+            if produced - self.consumed >= self.size:
+                if DatagramWaiting(sock):
+                    if not self.overflowing:
+                        self.overflowing = True
+                        self.overflows += 1
+                else:
+                    self.overflowing = False
+                break
+            slot = produced % self.size
+            buffer = self.buffers[slot]
+            try:
+                length, addr = sock.recvfrom_into(buffer, self.slotSize)
+            except socket.error as error:
+                if error.errno not in wouldBlockErrors:
+                    self.errors += 1
+                else:
+                    # Drained
+                    self.overflowing = False
+                break
+            peer = self.packPeer(addr)
+            if steer is not None and not steer(buffer, length, peer):
+                self.steered += 1
+                continue
+            self.lengths[slot] = length
+            self.peers[slot] = peer
+            if self.timestamping:
+                self.timestamps[slot] = ArrivalTime(sock)
+            produced += 1
+            # Publish the datagram to the consumer
+            self.produced = produced
+            batch += 1
+
+        if batch:
+            self.drains += 1
+            self.received += batch
+            if batch > self.largestBatch:
+                self.largestBatch = batch
+            depth = produced - self.consumed
+            if depth > self.highWater:
+                self.highWater = depth
+        return batch
+
+    def pop(self, message, maxMessageLength, connectionString):
+        # Consumer. Moves the oldest datagram into the CAS BACnet Stack buffers. Returns its length, or 0 if the ring
+        # is empty.
+        consumed = self.consumed
+        if consumed == self.produced:
+            return 0
+        slot = consumed % self.size
+        length = min(self.lengths[slot], maxMessageLength)
+        self.memmove(message, self.buffers[slot], length)
+        self.memmove(connectionString, self.peers[slot], 6)
+        if self.timestamping:
+            delay = max(0.0, time.time() - self.timestamps[slot])
+            self.queueDelayTotal += delay
+            if delay > self.queueDelayMax:
+                self.queueDelayMax = delay
+        # Hand the slot back to the producer
+        self.consumed = consumed + 1
+        self.bytesReceived += length
+        return length
+
+    def receive(self, message, maxMessageLength, connectionString):
+        # Called from CallbackReceiveMessage. Refills the ring from the socket once it is empty.
+        if self.produced == self.consumed and self.fill() == 0:
+            return 0
+        return self.pop(message, maxMessageLength, connectionString)
+
+    def queueDelayAverage(self):
+        return self.queueDelayTotal / self.consumed if self.consumed else 0.0
+
+    def summary(self):
+        text = "received=%d depth=%d highWater=%d largestBatch=%d overflows=%d errors=%d kernelDrops=%s" % (
+            self.received, self.count, self.highWater, self.largestBatch, self.overflows, self.errors,
+            KernelDropCount(self.sock))
+        if self.steer is not None:
+            text += " steered=%d" % self.steered
+        if self.timestamping:
+            text += " queueDelayAvg=%.6f queueDelayMax=%.6f" % (self.queueDelayAverage(), self.queueDelayMax)
+        return text
+
+
+class ThreadedReceiver(DatagramRing):
+    """A DatagramRing filled by a dedicated receiver thread, so slow Python work in the stack callbacks does not delay
+    reading the socket. Every datagram is timestamped so the queueing delay can be measured.
+
+    The event loop should wait on wakeupSocket instead of the UDP socket. The receiver thread writes one byte to it
+    when the ring goes from empty to non-empty. While the ring is full the receiver thread waits for the stack to take
+    a datagram the same way, through the space wakeup."""
+
+    def __init__(self, sock, slots=1024, slotSize=defaultSlotSize, pollInterval=0.5, memmove=None):
+        DatagramRing.__init__(self, sock, slots, slotSize, memmove)
+        self.timestamping = True
+        self.pollInterval = pollInterval
+        self.running = False
+        self.thread = None
+        self.wakeup = Wakeup()
+        self.wakeupSocket = self.wakeup.socket
+        # Signalled by the consumer while waitingForSpace, after taking a datagram from the full ring
+        self.space = Wakeup()
+        self.waitingForSpace = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="BACnetReceiver")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while self.running:
+            try:
+                readable, _, _ = select.select([self.sock], [], [], self.pollInterval)
+            except (select.error, socket.error):
+                self.errors += 1
+                continue
+            if not readable:
+                continue
+            self.fill()
+            if self.produced != self.consumed:
+                self.wakeup.signal()
+            if self.count >= self.size:
+                self.waitForSpace()
+
+    def waitForSpace(self):
+        # The ring is full. Sleeps until the stack takes a datagram (or pollInterval passes), instead of polling the
+        # socket, which stays readable. The count is checked again after announcing the wait, so a datagram taken in
+        # between is not missed.
+        self.space.clear()
+        self.waitingForSpace = True
+        try:
+            if self.count >= self.size:
+                select.select([self.space.socket], [], [], self.pollInterval)
+        except (select.error, socket.error):
+            pass
+        self.waitingForSpace = False
+
+    def receive(self, message, maxMessageLength, connectionString):
+        # Never reads the socket, only the ring. Does not block.
+        length = self.pop(message, maxMessageLength, connectionString)
+        if length and self.waitingForSpace:
+            self.space.signal()
+        if length == 0 and self.wakeup.signalled:
+            # The ring is empty. A datagram that arrives after this is signalled again, or seen by the event loop's
+            # pending work check.
+            self.wakeup.clear()
+        return length
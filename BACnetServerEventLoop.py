@@ -0,0 +1,205 @@
+#
+# BACnet Server Example Event Loop
+# Replaces the fixed "tick then sleep 100ms" polling loop. The loop waits until one of the BACnet sockets is
+# readable or the next timer is due, then calls BACnetStack_Tick right away. While a socket stays readable the stack
+# is ticked again immediately (up to maxTicksPerWake times) so bursts are not limited to one datagram per wakeup.
+# When the site is idle the loop sleeps until the next timer, or at most maxIdleInterval so the CAS BACnet Stack
+# still gets regular ticks for its own timers (APDU timeouts, COV lifetimes, ...).
+#
+# Work that is already queued in user space (see addPendingWork) keeps the loop ticking as if a socket was readable.
+# Other threads that queue work wake the loop up through a Wakeup.
+#
+
+import errno
+import heapq
+import math
+import select
+import socket
+import time
+
+
+class EventLoopStats(object):
+    """Tick rate statistics of an EventLoop. The delay from a datagram's arrival to the tick that takes it is measured
+    by the datagram rings (see BACnetServerDatagrams), which know when it arrived."""
+    __slots__ = ("startTime", "ticks", "wakeups", "readableWakeups", "timerWakeups", "idleWakeups",
+                 "tickTimeTotal", "tickTimeMax", "lastTickTime")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.startTime = time.time()
+        self.ticks = 0
+        self.wakeups = 0
+        self.readableWakeups = 0
+        self.timerWakeups = 0
+        self.idleWakeups = 0
+        # Seconds spent in BACnetStack_Tick
+        self.tickTimeTotal = 0.0
+        self.tickTimeMax = 0.0
+        # When the last tick finished, 0.0 before the first one
+        self.lastTickTime = 0.0
+
+    def ticksPerSecond(self):
+        elapsed = time.time() - self.startTime
+        return self.ticks / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        return ("ticks=%d ticksPerSecond=%.1f wakeups=%d (readable=%d timer=%d idle=%d) "
+                "tickTimeAvg=%.6f tickTimeMax=%.6f" % (
+                    self.ticks, self.ticksPerSecond(), self.wakeups, self.readableWakeups, self.timerWakeups,
+                    self.idleWakeups, self.tickTimeTotal / self.ticks if self.ticks else 0.0, self.tickTimeMax))
+
+
+class Wakeup(object):
+    """Lets another thread wake the event loop up. Register wakeup.socket with EventLoop.addSocket(), call signal()
+    from the other thread after queueing work, and clear() from the event loop before taking the queued work."""
+
+    def __init__(self):
+        self.socket, self.writer = socket.socketpair()
+        self.socket.setblocking(False)
+        self.writer.setblocking(False)
+        self.signalled = False
+
+    def signal(self):
+        # Only the first signal after a clear() writes to the socket
+        if not self.signalled:
+            self.signalled = True
+            try:
+                self.writer.send(b"\x00")
+            except socket.error:
+                pass
+
+    def clear(self):
+        # Re-arms the wakeup before draining it, so work queued in between still signals (or is picked up by the
+        # caller right after)
+        self.signalled = False
+        try:
+            while self.socket.recv(64):
+                pass
+        except socket.error:
+            pass
+
+
+class EventLoop(object):
+    """Calls tick() whenever a registered socket is readable or a timer is due."""
+
+    def __init__(self, tick, maxIdleInterval=1.0, maxTicksPerWake=64):
+        self.tick = tick
+        self.maxIdleInterval = maxIdleInterval
+        self.maxTicksPerWake = maxTicksPerWake
+        self.stats = EventLoopStats()
+        self.running = False
+        self.sockets = {}
+        self.timers = []
+        self.timerSequence = 0
+        self.pendingWork = []
+        self.epoll = select.epoll() if hasattr(select, "epoll") else None
+
+    def close(self):
+        if self.epoll is not None:
+            self.epoll.close()
+
+    def addSocket(self, sock):
+        self.sockets[sock.fileno()] = sock
+        if self.epoll is not None:
+            self.epoll.register(sock.fileno(), select.EPOLLIN)
+
+    def removeSocket(self, sock):
+        if self.sockets.pop(sock.fileno(), None) is not None and self.epoll is not None:
+            self.epoll.unregister(sock.fileno())
+
+    def addPendingWork(self, hasPendingWork):
+        # hasPendingWork() returns True while there is queued work (e.g. received datagrams) for the stack.
+        self.pendingWork.append(hasPendingWork)
+
+    def hasPendingWork(self):
+        for hasPendingWork in self.pendingWork:
+            if hasPendingWork():
+                return True
+        return False
+
+    def addTimer(self, interval, callback, repeat=True):
+        # Calls callback() every interval seconds, starting interval seconds from now. Only once if not repeat.
+        self.timerSequence += 1
+        heapq.heappush(self.timers, (time.time() + interval, self.timerSequence, interval if repeat else None,
+                                     callback))
+
+    def poll(self, timeout):
+        # Returns True if at least one socket is readable. The timeout is rounded up to whole milliseconds, the poll
+        # resolution, so a timer that is almost due does not turn into a busy loop.
+        timeout = math.ceil(timeout * 1000.0) / 1000.0
+        try:
+            if self.epoll is not None:
+                return len(self.epoll.poll(timeout)) > 0
+            readable, _, _ = select.select(list(self.sockets.values()), [], [], timeout)
+            return len(readable) > 0
+        except (IOError, OSError, select.error) as error:
+            # Python 2 does not retry a poll interrupted by a signal with a Python handler (SIGUSR1, SIGTERM, ...).
+            # The handler has run by now; return as if the poll timed out and let runOnce() recompute the timeout.
+            if error.args[0] != errno.EINTR:
+                raise
+            return False
+
+    def runTimers(self, now):
+        ran = False
+        while self.timers and self.timers[0][0] <= now:
+            due, sequence, interval, callback = heapq.heappop(self.timers)
+            if interval is not None:
+                # Reschedule from the due time so the timer does not drift, but never in the past
+                nextDue = due + interval
+                if nextDue <= now:
+                    nextDue = now + interval
+                heapq.heappush(self.timers, (nextDue, sequence, interval, callback))
+            callback()
+            ran = True
+        return ran
+
+    def runTick(self):
+        stats = self.stats
+        start = time.time()
+        self.tick()
+        end = time.time()
+        duration = end - start
+        stats.lastTickTime = end
+        stats.ticks += 1
+        stats.tickTimeTotal += duration
+        if duration > stats.tickTimeMax:
+            stats.tickTimeMax = duration
+
+    def runOnce(self):
+        stats = self.stats
+        now = time.time()
+        timeout = self.maxIdleInterval
+        if self.timers:
+            timeout = max(0.0, min(timeout, self.timers[0][0] - now))
+        if self.pendingWork and self.hasPendingWork():
+            timeout = 0.0
+
+        readable = self.poll(timeout) or (self.pendingWork and self.hasPendingWork())
+        now = time.time()
+        stats.wakeups += 1
+        timersRan = self.runTimers(now)
+        if readable:
+            stats.readableWakeups += 1
+        elif timersRan:
+            stats.timerWakeups += 1
+        else:
+            stats.idleWakeups += 1
+
+        # Tick right away. While datagrams keep arriving, keep ticking without sleeping.
+        self.runTick()
+        ticks = 1
+        while readable and ticks < self.maxTicksPerWake:
+            readable = self.poll(0) or (self.pendingWork and self.hasPendingWork())
+            if readable:
+                self.runTick()
+                ticks += 1
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.runOnce()
+
+    def stop(self):
+        self.running = False
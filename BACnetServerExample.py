@@ -1,15 +1,45 @@
 # CAS BACnet Stack Python Server Example 
 # https://github.com/chipkin/BACnetServerExamplePython 
 #
-import ctypes
-import io
+import time  # Sleep function
+
+# Startup is timed from here, see BACnetServerStartup
+startupStartTime = time.time()
+
+import collections
+import copy
+import os
 
-import pathlib
-import netifaces
-import dns.resolver  # Package name: dnspython
+import signal
 import socket
-import time  # Sleep function
-from CASBACnetStackAdapter import *  # Contains all the Enumerations, and callback prototypes
+import struct
+import binascii
+
+# The CAS BACnet Stack adapter backend. BACNET_ADAPTER=ctypes (the default) uses CASBACnetStackAdapter, cffi uses
+# CASBACnetStackAdapterCffi, which has cheaper callbacks and also runs under PyPy. Both have the same callback
+# prototypes, BACnetStack_* functions, enumerations and memory helpers (NULL, MemoryMove, StringAt, NewArray).
+adapterName = os.environ.get("BACNET_ADAPTER", "ctypes")
+if adapterName == "cffi":
+    import CASBACnetStackAdapterCffi as adapter
+    from CASBACnetStackAdapterCffi import *  # Contains all the Enumerations, and callback prototypes
+elif adapterName == "ctypes":
+    import CASBACnetStackAdapter as adapter
+    from CASBACnetStackAdapter import *  # Contains all the Enumerations, and callback prototypes
+else:
+    raise ValueError("Unknown BACNET_ADAPTER: " + adapterName)
+import BACnetServerDatagrams
+import BACnetServerEventLoop
+import BACnetServerInstrumentation
+import BACnetServerInterfaces
+import BACnetServerLogging
+import BACnetServerPointStore
+import BACnetServerProvisioning
+import BACnetServerStartup
+import BACnetServerUpdates
+# The optional subsystems (BACnetServerFakeStack, BACnetServerFieldSources, BACnetServerMetrics,
+# BACnetServerPersistence, BACnetServerSharding, BACnetServerWriteLog) are imported where they are enabled, so
+# startup does not pay for the ones that are off.
+from BACnetServerLogging import LEVEL_ERROR, LEVEL_DEBUG, LEVEL_TRACE
 
 bacnet_server_example_python27_version = "1.0.0"
 
@@ -104,7 +134,7 @@ db = {
         "ipLength": 4,
         "ipAddress": [0, 0, 0, 0],
         "ipDefaultGateway": [0, 0, 0, 0],
-        "ipDnsServer": [0, 0, 0, 0],
+        "ipDnsServer": [],  # One octet list per DNS server, set by ApplyNetworkSettings
         "ipNumOfDns": 0,
         "ipSubnetMask": [0, 0, 0, 0],
         "FdBbmdAddressHostIp": [192, 168, 1, 4],
@@ -116,10 +146,69 @@ db = {
 
 # Globals
 # -----------------------------------------------------------------------------
-udpSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-udpSocket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-
-lastTimeValueWasUpdated = 0
+# One BACnet/IP port (socket, receive ring and Network Port object) per entry of BACNET_INTERFACES, a comma separated
+# list of interface[:udpPort] entries, by default the default interface on the BACnetIPUDPPort of db. All ports are
+# served by the same event loop. See BACnetServerInterfaces.
+#
+# Every pending datagram is drained off the sockets into rings of preallocated buffers, and moved from there into the
+# CAS BACnet Stack buffer with a single memmove.
+# Set BACNET_RECEIVE_THREAD=1 to fill the rings from dedicated receiver threads instead of from BACnetStack_Tick, so
+# slow property callbacks do not delay reading the sockets. Either way the rings measure the delay from the arrival of
+# each datagram to the stack receiving it.
+receiveThread = os.environ.get("BACNET_RECEIVE_THREAD", "0") not in ("", "0")
+
+
+def CreatePorts():
+    return BACnetServerInterfaces.PortSet(
+        BACnetServerInterfaces.BACnetIPPort(interface, udpPort, receiveThread, MemoryMove)
+        for interface, udpPort in BACnetServerInterfaces.ParseInterfaces(os.environ.get("BACNET_INTERFACES", ""),
+                                                                         db["networkPort"]["BACnetIPUDPPort"]))
+
+
+ipPorts = CreatePorts()
+
+# Broadcasts are sent out of every port to the directed broadcast address of its subnet, computed from the ipAddress
+# and ipSubnetMask of its Network Port by UpdateBroadcastAddresses(). The first port also sends them to the directed
+# broadcast addresses of any remote subnets in BACNET_BROADCAST_ADDRESSES (a comma separated list, for routed sites
+# without a BBMD).
+broadcastDistributionList = [address.strip() for address in os.environ.get("BACNET_BROADCAST_ADDRESSES", "").split(",")
+                             if address.strip()]
+
+# Requested size of the kernel socket receive buffers, so bursts are not dropped before the rings are drained
+udpSocketReceiveBufferSize = 1024 * 1024
+
+# Logging
+# Each callback logs to its own category. See BACnetServerLogging for how to enable them.
+logReceiveMessage = BACnetServerLogging.GetCategory("CallbackReceiveMessage")
+logSendMessage = BACnetServerLogging.GetCategory("CallbackSendMessage")
+logGetPropertyBitString = BACnetServerLogging.GetCategory("CallbackGetPropertyBitString")
+logGetPropertyBool = BACnetServerLogging.GetCategory("CallbackGetPropertyBool")
+logGetPropertyCharString = BACnetServerLogging.GetCategory("CallbackGetPropertyCharString")
+logGetPropertyDate = BACnetServerLogging.GetCategory("CallbackGetPropertyDate")
+logGetPropertyDouble = BACnetServerLogging.GetCategory("CallbackGetPropertyDouble")
+logGetPropertyEnumerated = BACnetServerLogging.GetCategory("CallbackGetPropertyEnumerated")
+logGetPropertyOctetString = BACnetServerLogging.GetCategory("CallbackGetPropertyOctetString")
+logGetPropertyInt = BACnetServerLogging.GetCategory("CallbackGetPropertyInt")
+logGetPropertyReal = BACnetServerLogging.GetCategory("CallbackGetPropertyReal")
+logGetPropertyTime = BACnetServerLogging.GetCategory("CallbackGetPropertyTime")
+logGetPropertyUInt = BACnetServerLogging.GetCategory("CallbackGetPropertyUInt")
+logSetPropertyEnumerated = BACnetServerLogging.GetCategory("CallbackSetPropertyEnumerated")
+logSetPropertyOctetString = BACnetServerLogging.GetCategory("CallbackSetPropertyOctetString")
+logSetPropertyReal = BACnetServerLogging.GetCategory("CallbackSetPropertyReal")
+logSetPropertyUInt = BACnetServerLogging.GetCategory("CallbackSetPropertyUInt")
+logReinitializeDevice = BACnetServerLogging.GetCategory("CallbackReinitializeDevice")
+logDeviceCommunicationControl = BACnetServerLogging.GetCategory("CallbackDeviceCommunicationControl")
+logLogDebugMessage = BACnetServerLogging.GetCategory("CallbackLogDebugMessage")
+logEventLoop = BACnetServerLogging.GetCategory("EventLoop")
+
+logFormatGetProperty = "device=%s object=%s:%s property=%s useArrayIndex=%s arrayIndex=%s"
+logFormatGetPropertyBuffer = "device=%s object=%s:%s property=%s maxElementCount=%s useArrayIndex=%s arrayIndex=%s"
+logFormatSetProperty = "device=%s object=%s:%s property=%s value=%s useArrayIndex=%s arrayIndex=%s priority=%s"
+
+# Bounded LRU of CAS BACnet Stack connection strings to the (ip, port) tuples passed to sendto, so replies to repeat
+# clients skip decoding the connection string.
+destinationCache = collections.OrderedDict()
+destinationCacheSize = 256
 
 
 def octetStringCopy(source, destination, length, offset=0):
@@ -127,6 +216,60 @@ def octetStringCopy(source, destination, length, offset=0):
         destination[i + offset] = source[i]
 
 
+# Copies a byte string into a CAS BACnet Stack output buffer with a single memmove, truncated to maxLength.
+# Returns the number of bytes copied.
+def bufferCopy(source, destination, maxLength):
+    length = min(len(source), maxLength)
+    MemoryMove(destination, source, length)
+    return length
+
+
+# Decodes a 6 byte CAS BACnet Stack connection string into an (ip, port) tuple, using the destination LRU.
+def connectionStringToDestination(connectionString):
+    key = StringAt(connectionString, 6)
+    destination = destinationCache.pop(key, None)
+    if destination is None:
+        ipAddress, udpPort = BACnetServerDatagrams.connectionStringStruct.unpack(key)
+        destination = (socket.inet_ntoa(ipAddress), udpPort)
+        if len(destinationCache) >= destinationCacheSize:
+            destinationCache.popitem(last=False)
+    destinationCache[key] = destination
+    return destination
+
+
+# Recomputes the broadcast addresses and routes of every port. Call it whenever the Network Port IP settings change.
+def UpdateBroadcastAddresses():
+    for index, port in enumerate(ipPorts.ports):
+        networkPort = port.networkPort
+        if networkPort is not None:
+            port.setAddress(networkPort["ipAddress"], networkPort["ipSubnetMask"],
+                            broadcastDistributionList if index == 0 else ())
+    ipPorts.clearRoutes()
+
+
+# DNS servers and default gateways are not needed to answer BACnet requests, so they are looked up on a background
+# thread after the first I-Am (dnspython takes a while to import) and filled into the Network Port objects when found.
+def DiscoverNetworkSettings():
+    # Runs on the background thread. Returns the DNS servers and the default gateways by interface name.
+    import dns.resolver  # Package name: dnspython
+    dnsServers = [[int(octet) for octet in dnsServer.split(".")] for dnsServer in dns.resolver.Resolver().nameservers
+                  if "." in dnsServer and ":" not in dnsServer]
+    return dnsServers, BACnetServerInterfaces.DefaultGateways()
+
+
+def ApplyNetworkSettings(dnsServers, defaultGateways):
+    # Called on the event loop thread with the result of DiscoverNetworkSettings()
+    networkPortType = bacnet_objectType["networkPort"]
+    for port in ipPorts.ports:
+        networkPort = port.networkPort
+        networkPort["ipDefaultGateway"] = defaultGateways.get(port.interfaceName, [0, 0, 0, 0])
+        networkPort["ipNumOfDns"] = len(dnsServers)
+        networkPort["ipDnsServer"] = dnsServers
+        for propertyName in ("ipdefaultgateway", "ipdnsserver"):
+            InvalidateEncodedValue(db["device"]["instance"], networkPortType, networkPort["instance"],
+                                   bacnet_propertyIdentifier[propertyName])
+
+
 # Rebuilds string from ctype.c_uint_8 arrray
 def rebuildString(strPointer, length):
     rebuiltStr = ""
@@ -135,78 +278,398 @@ def rebuildString(strPointer, length):
     return rebuiltStr
 
 
+# Property index
+# -----------------------------------------------------------------------------
+# Every property served by this example is registered in a typed index keyed by
+# (deviceInstance, objectType, objectInstance, propertyIdentifier). Each GetProperty/SetProperty callback resolves
+# its property with a single dict lookup instead of walking if/elif chains. Objects are indexed by record, so any
+# number of objects of the same object type can be served.
+#
+# A property can be read through more than one callback (e.g. fdbbmdaddress is read as an enumerated, an
+# octet string and an unsigned integer) so there is one index per data type.
+propertyIndex = {
+    "bool": {},
+    "characterString": {},
+    "double": {},
+    "enumerated": {},
+    "octetString": {},
+    "real": {},
+    "signedInteger": {},
+    "unsignedInteger": {}}
+
+# Data type of the presentValue property for each object type served by the callbacks. The presentValue of
+# commandable objects (analogOutput, binaryOutput, multiStateOutput) is handled by the CAS BACnet Stack.
+presentValueDataType = {
+    "analogInput": "real",
+    "analogValue": "real",
+    "binaryInput": "enumerated",
+    "binaryValue": "enumerated",
+    "multiStateInput": "unsignedInteger",
+    "multiStateValue": "unsignedInteger",
+    "characterstringValue": "characterString",
+    "integerValue": "signedInteger",
+    "largeAnalogValue": "double",
+    "positiveIntegerValue": "unsignedInteger"}
+
+# Object types whose presentValue can be written through the SetProperty callbacks
+writablePresentValue = ("analogInput", "analogValue", "binaryValue", "multiStateValue")
+
+
+class FieldAccessor(object):
+    """Reads, and optionally writes, one field of an object record."""
+    __slots__ = ("record", "field", "writable", "onWrite")
+
+    def __init__(self, record, field, writable=False, onWrite=None):
+        self.record = record
+        self.field = field
+        self.writable = writable
+        self.onWrite = onWrite
+
+    def get(self, useArrayIndex, propertyArrayIndex):
+        return self.record[self.field]
+
+    def set(self, value, useArrayIndex, propertyArrayIndex):
+        self.record[self.field] = value
+        if self.onWrite is not None:
+            self.onWrite(self.record)
+        return True
+
+
+class ConstantAccessor(object):
+    """Returns a fixed value. Used for properties that have no field in the object record."""
+    __slots__ = ("value", "writable")
+
+    def __init__(self, value):
+        self.value = value
+        self.writable = False
+
+    def get(self, useArrayIndex, propertyArrayIndex):
+        return self.value
+
+
+class ArrayElementAccessor(FieldAccessor):
+    """Reads one element of a BACnetARRAY field (propertyArrayIndex 1..N)."""
+    __slots__ = ()
+
+    def get(self, useArrayIndex, propertyArrayIndex):
+        array = self.record[self.field]
+        if useArrayIndex and 0 < propertyArrayIndex <= len(array):
+            return array[propertyArrayIndex - 1]
+        return None
+
+
+class ArraySizeAccessor(FieldAccessor):
+    """Reads the size of a BACnetARRAY field (propertyArrayIndex 0)."""
+    __slots__ = ()
+
+    def get(self, useArrayIndex, propertyArrayIndex):
+        if useArrayIndex and propertyArrayIndex == 0:
+            return len(self.record[self.field])
+        return None
+
+
+class ArrayIndexFieldAccessor(FieldAccessor):
+    """Reads a field that the CAS BACnet Stack requests with a fixed propertyArrayIndex (e.g. the port portion of
+    fdbbmdaddress)."""
+    __slots__ = ("arrayIndex",)
+
+    def __init__(self, record, field, arrayIndex, writable=False, onWrite=None):
+        FieldAccessor.__init__(self, record, field, writable, onWrite)
+        self.arrayIndex = arrayIndex
+
+    def get(self, useArrayIndex, propertyArrayIndex):
+        if useArrayIndex and propertyArrayIndex == self.arrayIndex:
+            return self.record[self.field]
+        return None
+
+
+class OctetListAccessor(FieldAccessor):
+    """Reads a list of octet lists (e.g. ipDnsServer) as one flat octet string."""
+    __slots__ = ()
+
+    def get(self, useArrayIndex, propertyArrayIndex):
+        return [octet for octets in self.record[self.field] for octet in octets]
+
+
+def MarkChangesPending(record):
+    record["changesPending"] = True
+
+
+def IndexProperty(dataType, deviceInstance, objectType, objectInstance, propertyName, accessor):
+    propertyIndex[dataType][(deviceInstance, objectType, objectInstance,
+                             bacnet_propertyIdentifier[propertyName])] = accessor
+
+
+def IndexObject(deviceInstance, objectTypeName, record, store=None):
+    """Registers every property of an object record in the property index. With a point store, the numeric values
+    are moved into the store and the text properties into a PointMetadata record, so the record itself is no longer
+    needed (or updated) afterwards. Device and Network Port records are always served from the record."""
+    objectType = bacnet_objectType[objectTypeName]
+    objectInstance = record["instance"]
+    if objectTypeName in ("device", "networkPort"):
+        store = None
+    texts = record if store is None else BACnetServerPointStore.PointMetadata(record)
+
+    def add(dataType, propertyName, accessor):
+        IndexProperty(dataType, deviceInstance, objectType, objectInstance, propertyName, accessor)
+
+    def value(dataType, field, writable=False):
+        # A value property, served from the point store if there is one
+        if store is None:
+            return FieldAccessor(record, field, writable)
+        if dataType == "characterString":
+            return ConstantAccessor(record[field])
+        return store.accessor(dataType, record[field], writable)
+
+    add("characterString", "objectname", FieldAccessor(texts, "objectName"))
+
+    # Undefined reliability. Assume no-fault-detected (0)
+    if "reliability" in record:
+        add("enumerated", "reliability", value("enumerated", "reliability"))
+    else:
+        add("enumerated", "reliability", ConstantAccessor(bacnet_reliability["no-fault-detected"]))
+
+    if objectTypeName in presentValueDataType and "presentValue" in record:
+        add(presentValueDataType[objectTypeName], "presentValue",
+            value(presentValueDataType[objectTypeName], "presentValue",
+                  writable=objectTypeName in writablePresentValue))
+    if "covIncrement" in record:
+        add("real", "covincrement", value("real", "covIncrement", writable=True))
+    if "units" in record:
+        add("enumerated", "units", value("enumerated", "units"))
+    if "activeText" in record:
+        add("characterString", "activetext", FieldAccessor(texts, "activeText"))
+    if "inactiveText" in record:
+        add("characterString", "inactivetext", FieldAccessor(texts, "inactiveText"))
+    if "numberOfStates" in record:
+        add("unsignedInteger", "numberofstates", value("unsignedInteger", "numberOfStates"))
+    if "stateText" in record:
+        add("characterString", "statetext", ArrayElementAccessor(texts, "stateText"))
+        add("unsignedInteger", "statetext", ArraySizeAccessor(texts, "stateText"))
+
+    if objectTypeName == "device":
+        add("characterString", "vendorname", FieldAccessor(record, "vendorname"))
+        add("unsignedInteger", "vendoridentifier", FieldAccessor(record, "vendoridentifier"))
+    elif objectTypeName == "networkPort":
+        add("bool", "changespending", FieldAccessor(record, "changesPending"))
+        add("unsignedInteger", "bacnetipudpport", FieldAccessor(record, "BACnetIPUDPPort"))
+        add("octetString", "ipaddress", FieldAccessor(record, "ipAddress"))
+        add("octetString", "ipdefaultgateway", FieldAccessor(record, "ipDefaultGateway"))
+        add("octetString", "ipsubnetmask", FieldAccessor(record, "ipSubnetMask"))
+        add("octetString", "ipdnsserver", OctetListAccessor(record, "ipDnsServer"))
+        add("unsignedInteger", "ipdnsserver", ArraySizeAccessor(record, "ipDnsServer"))
+        add("enumerated", "fdbbmdaddress", FieldAccessor(record, "FdBbmdAddressHostType"))
+        add("octetString", "fdbbmdaddress",
+            FieldAccessor(record, "FdBbmdAddressHostIp", writable=True, onWrite=MarkChangesPending))
+        add("unsignedInteger", "fdbbmdaddress",
+            ArrayIndexFieldAccessor(record, "FdBbmdAddressPort", casbacnetstack_fdBbmdAddressOffset["port"],
+                                    writable=True, onWrite=MarkChangesPending))
+        add("unsignedInteger", "fdsubscriptionlifetime",
+            FieldAccessor(record, "FdSubscriptionLifetime", writable=True, onWrite=MarkChangesPending))
+
+
+def IndexDevice(objects):
+    """Indexes a device given as a list of (objectTypeName, record) pairs, starting with its device object. The
+    values are kept in pointStore."""
+    deviceInstance = objects[0][1]["instance"]
+    device = devices[deviceInstance] = {"networkPorts": []}
+    for objectTypeName, record in objects:
+        if objectTypeName == "device":
+            device["device"] = record
+        elif objectTypeName == "networkPort":
+            device["networkPorts"].append(record)
+        IndexObject(deviceInstance, objectTypeName, record, pointStore)
+
+
+def IndexDatabase(database):
+    """Indexes the device and every object of an example database."""
+    IndexDevice([("device", database["device"])] +
+                [(objectTypeName, record) for objectTypeName, record in database.items() if objectTypeName != "device"])
+
+
+# Devices
+# -----------------------------------------------------------------------------
+# Values of every indexed object, one typed array per data type. Set to None to serve the values from the object
+# records instead.
+pointStore = BACnetServerPointStore.PointStore()
+
+# Every device served by this process, keyed by device instance, with its device record and its networkPort records
+# (one per BACnet/IP port of the gateway device, none for virtual devices).
+# The objects of each device are in the property index, which is keyed by device instance as well, so the callbacks
+# dispatch to the right device with the same single dict lookup no matter how many devices are hosted.
+devices = {}
+
+# Gateway mode. The object types of db that every virtual device gets a copy of.
+virtualDeviceObjectTypes = ("analogInput", "binaryInput", "multiStateInput", "analogValue", "binaryValue",
+                            "multiStateValue")
+
+
+def CreateVirtualDevice(deviceInstance, template=None):
+    """Returns a new database for a virtual device, with its own copy of the objects of the template (db)."""
+    template = db if template is None else template
+    database = {"device": {
+        "instance": deviceInstance,
+        "objectName": "Device " + str(deviceInstance),
+        "vendorname": template["device"]["vendorname"],
+        "vendoridentifier": template["device"]["vendoridentifier"]}}
+    for objectTypeName in virtualDeviceObjectTypes:
+        database[objectTypeName] = copy.deepcopy(template[objectTypeName])
+    return database
+
+
+# The devices other than db (the virtual devices and those of the point list) are on a virtual network behind the
+# gateway device, which routes to it. Clients reach them with requests that have the network number as DNET and the
+# MAC address of the device as DADR. Set BACNET_VIRTUAL_NETWORK to choose the network number (1 to 65534), it must not
+# be used by any other network of the site.
+virtualNetwork = int(os.environ.get("BACNET_VIRTUAL_NETWORK", "1000"))
+
+
+def VirtualAddress(deviceInstance):
+    # The MAC address of a device on the virtual network: its device instance, 4 octets big endian
+    return bytearray(struct.pack("!I", deviceInstance))
+
+
+def RouterAnnouncement(network):
+    # A broadcast I-Am-Router-To-Network network layer message for one network
+    return struct.pack("!BBHBBBH", 0x81, 0x0B, 9, 0x01, 0x80, 0x01, network)
+
+
+def RouteVirtualDevices(stack):
+    """Adds every hosted device other than db to the virtual network of the stack. Returns the number added."""
+    addRoutedDevice = stack.BACnetStack_AddRoutedDevice
+    macAddress = NewArray("uint8_t", 4)
+    added = 0
+    for deviceInstance in sorted(devices):
+        if deviceInstance == db["device"]["instance"]:
+            continue
+        octetStringCopy(VirtualAddress(deviceInstance), macAddress, 4)
+        if addRoutedDevice(deviceInstance, virtualNetwork, macAddress, 4):
+            added += 1
+        else:
+            print("Error: Failed to add device " + str(deviceInstance) + " to the virtual network")
+    return added
+
+
+# Encoded value cache
+# -----------------------------------------------------------------------------
+# Character strings and octet strings are encoded to bytes the first time they are read and copied into the CAS
+# BACnet Stack buffers from this cache afterwards. Entries are keyed like the property index, then by
+# propertyArrayIndex (-1 when no array index is used). Anything that changes one of these values must call
+# InvalidateEncodedValue.
+encodedValueCache = {
+    "characterString": {},
+    "octetString": {}}
+
+
+def GetEncodedValue(dataType, key, accessor, useArrayIndex, propertyArrayIndex):
+    arrayIndex = propertyArrayIndex if useArrayIndex else -1
+    entries = encodedValueCache[dataType].get(key)
+    if entries is None:
+        entries = encodedValueCache[dataType][key] = {}
+    elif arrayIndex in entries:
+        return entries[arrayIndex]
+
+    propertyValue = accessor.get(useArrayIndex, propertyArrayIndex)
+    if propertyValue is None:
+        # Not cached, so a client scanning array indexes past the end does not grow the cache
+        return None
+    if dataType == "characterString":
+        encoded = propertyValue.encode("utf-8")
+    else:
+        encoded = bytes(bytearray(propertyValue))
+    entries[arrayIndex] = encoded
+    return encoded
+
+
+def InvalidateEncodedValue(deviceInstance, objectType, objectInstance, propertyIdentifier):
+    key = (deviceInstance, objectType, objectInstance, propertyIdentifier)
+    for entries in encodedValueCache.values():
+        entries.pop(key, None)
+
+
+# Persistence
+# -----------------------------------------------------------------------------
+# Every value written through the SetProperty callbacks is kept in a memory mapped file (see
+# BACnetServerPersistence) and in a write-ahead log (see BACnetServerWriteLog), and restored at startup.
+persistentStore = None
+writeLog = None
+# The ChangeBatcher of the main loop (see BACnetServerUpdates), told about every write
+changeBatcher = None
+
+
+def PropertyWritten(dataType, key, value, priority):
+    # Called by the SetProperty callbacks after a write was accepted
+    if changeBatcher is not None:
+        changeBatcher.written(key)
+    if persistentStore is not None:
+        persistentStore.write(dataType, key, value)
+    if writeLog is not None:
+        # Committed to disk after the tick, see Tick()
+        writeLog.append(dataType, key, value, priority)
+
+
+def RestorePersistedValues(items):
+    """Applies (dataType, key, value) items of a persistent store or write log to the indexed properties. Returns the
+    number restored."""
+    restored = 0
+    for dataType, key, value in items:
+        accessor = propertyIndex[dataType].get(key)
+        if accessor is None or not accessor.writable:
+            continue
+        if dataType in encodedValueCache:
+            InvalidateEncodedValue(*key)
+        accessor.set(value, False, 0)
+        restored += 1
+
+    # The restored Network Port values are the ones in use after a restart, so there are no pending changes
+    for device in devices.values():
+        for networkPort in device["networkPorts"]:
+            networkPort["changesPending"] = False
+    return restored
+
+
 # Callbacks
 # -----------------------------------------------------------------------------
 def CallbackReceiveMessage(message, maxMessageLength, receivedConnectionString, maxConnectionStringLength,
                            receivedConnectionStringLength,
                            networkType):
-    try:
-        data, addr = udpSocket.recvfrom(maxMessageLength)
-        # if not data:
-        #     print("DEBUG: not data")
-        # A message was received.
-        print ("DEBUG: CallbackReceiveMessage. Message Received", addr, data, len(data) )
-
-        # Convert the received address to the CAS BACnet Stack connection string format.
-        ip_as_bytes = map(int, addr[0].split("."))
-        for i in range(len(ip_as_bytes)):
-            receivedConnectionString[i] = ip_as_bytes[i]
-        # UDP Port
-        receivedConnectionString[4] = int(addr[1] / 256)
-        receivedConnectionString[5] = addr[1] % 256
-        # New ConnectionString Length
-        receivedConnectionStringLength[0] = 6
-
-        # Convert the received data to a format that CAS BACnet Stack can process.
-        for i in range(len(data)):
-            message[i] = ord(data[i])
-
-        # Set the network type
-        networkType[0] = ctypes.c_uint8(casbacnetstack_networkType["ip"])
-        return int(len(data))
-    except socket.timeout:
-        # No message, We are not waiting for a incoming message so our socket returns a BlockingIOError. This is normal.
-        return int(0)
-    except io.BlockingIOError:
-        # No message, We are not waiting for a incoming message so our socket returns a BlockingIOError. This is normal.
-        return int(0)
-    except socket.error:
-        # No message, We are not waiting for a incoming message so our socket returns a BlockingIOError. This is normal.
-        return int(0)
-
-    # Catch all
-    return 0
+    # Move the oldest datagram and its address, already in the CAS BACnet Stack connection string format, into the
+    # CAS BACnet Stack buffers. The ports are taken in turn. A ring is refilled from its socket, or by its receiver
+    # thread, when it is empty.
+    length = ipPorts.receive(message, maxMessageLength, receivedConnectionString)
+    if length == 0:
+        # No message, We are not waiting for a incoming message. This is normal.
+        return 0
+
+    # New ConnectionString Length
+    receivedConnectionStringLength[0] = 6
+    # Set the network type
+    networkType[0] = casbacnetstack_networkType["ip"]
+
+    # A message was received.
+    if logReceiveMessage.debug:
+        logReceiveMessage.log(LEVEL_DEBUG, "Message Received. connectionString=%s length=%s",
+                              list(receivedConnectionString[0:6]), length)
+        if logReceiveMessage.trace:
+            logReceiveMessage.log(LEVEL_TRACE, "data=%s", binascii.hexlify(StringAt(message, length)))
+    return length
 
 
 def CallbackSendMessage(message, messageLength, connectionString, connectionStringLength, networkType, broadcast):
     # Currently we are only supporting IP
     if networkType != casbacnetstack_networkType["ip"]:
-        print("Error: Unsupported network type. networkType:", networkType)
+        logSendMessage.log(LEVEL_ERROR, "Unsupported network type. networkType=%s", networkType)
         return int(0)
 
     # Extract the Connection String from CAS BACnet Stack into an IP address and port.
-    udpPort = connectionString[4] * 256 + connectionString[5]
+    destination = connectionStringToDestination(connectionString)
     if broadcast:
-        # Use broadcast IP address
-        # ToDo: Get the subnet mask and apply it to the IP address
-        print("DEBUG:   ToDo: Broadcast this message. Local IP: ", db["networkPort"]["ipAddress"], "Subnet: ",
-              db["networkPort"]["ipSubnetMask"],
-              "Broadcast IP: ????")
-        ipAddress = str(connectionString[0]) + "." + str(connectionString[1]) + "." + str(connectionString[2]) + "." + \
-                    str(connectionString[3])
+        # Send out of every port to its precomputed directed broadcast addresses
+        # (the address the stack passed until the network settings are loaded)
+        return ipPorts.broadcast(StringAt(message, messageLength), destination)
 
-    else:
-        ipAddress = str(connectionString[0]) + "." + str(connectionString[1]) + "." + str(connectionString[2]) + "." + \
-                    str(connectionString[3])
-
-    # Extract the message from CAS BACnet Stack to a bytearray
-    data = bytearray(messageLength)
-    for i in range(len(data)):
-        data[i] = message[i]
-
-    # Send the message
-    udpSocket.sendto(data, (ipAddress, udpPort))
-    return int(messageLength)
+    # Extract the message from CAS BACnet Stack and send it from the port on the peer's subnet
+    return ipPorts.send(StringAt(message, messageLength), destination)
 
 
 def CallbackGetSystemTime():
@@ -215,26 +678,17 @@ def CallbackGetSystemTime():
 
 def CallbackGetPropertyReal(deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
                             propertyArrayIndex):
-    print("CallbackGetPropertyReal", deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
-          propertyArrayIndex)
-
-    if deviceInstance == db["device"]["instance"]:
-        # Check for PresentValue Property
-        if propertyIdentifier == bacnet_propertyIdentifier["presentValue"]:
-            if objectType == bacnet_objectType["analogInput"] and objectInstance == db["analogInput"]["instance"]:
-                value[0] = ctypes.c_float(db["analogInput"]["presentValue"])
-                return True
-            if objectType == bacnet_objectType["analogValue"] and objectInstance == db["analogValue"]["instance"]:
-                value[0] = ctypes.c_float(db["analogValue"]["presentValue"])
-                return True
-        # Check for covincrement Property
-        elif propertyIdentifier == bacnet_propertyIdentifier["covincrement"]:
-            if objectType == bacnet_objectType["analogInput"] and objectInstance == db["analogInput"]["instance"]:
-                value[0] = ctypes.c_float(db["analogInput"]["covIncrement"])
-                return True
-            if objectType == bacnet_objectType["analogValue"] and objectInstance == db["analogValue"]["instance"]:
-                value[0] = ctypes.c_float(db["analogValue"]["covIncrement"])
-                return True
+    if logGetPropertyReal.trace:
+        logGetPropertyReal.log(LEVEL_TRACE, logFormatGetProperty,
+                               deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
+                               propertyArrayIndex)
+
+    accessor = propertyIndex["real"].get((deviceInstance, objectType, objectInstance, propertyIdentifier))
+    if accessor is not None:
+        propertyValue = accessor.get(useArrayIndex, propertyArrayIndex)
+        if propertyValue is not None:
+            value[0] = propertyValue
+            return True
 
     # Return false. The CAS BACnet Stack will use a default value.
     return False
@@ -243,290 +697,38 @@ def CallbackGetPropertyReal(deviceInstance, objectType, objectInstance, property
 def CallbackGetPropertyCharString(deviceInstance, objectType, objectInstance, propertyIdentifier, value,
                                   valueElementCount, maxElementCount,
                                   encodingType, useArrayIndex, propertyArrayIndex):
-    print(
-        "CallbackGetPropertyCharString", deviceInstance, objectType, objectInstance, propertyIdentifier,
-        maxElementCount,
-        useArrayIndex,
-        propertyArrayIndex)
-
-    if deviceInstance == db["device"]["instance"]:
-        # Check for vendorname Property
-        if propertyIdentifier == bacnet_propertyIdentifier["vendorname"] and objectType == bacnet_objectType["device"]:
-            vendorname = db["device"]["vendorname"]
-            # Convert the vendorname from a string to a format that CAS BACnet Stack can process.
-            b_vendorname = vendorname.encode("utf-8")
-            for i in range(len(b_vendorname)):
-                value[i] = b_vendorname[i]
-            # Define how long the vendorname is
-            valueElementCount[0] = len(b_vendorname)
+    if logGetPropertyCharString.trace:
+        logGetPropertyCharString.log(LEVEL_TRACE, logFormatGetPropertyBuffer,
+                                     deviceInstance, objectType, objectInstance, propertyIdentifier, maxElementCount,
+                                     useArrayIndex, propertyArrayIndex)
+
+    key = (deviceInstance, objectType, objectInstance, propertyIdentifier)
+    accessor = propertyIndex["characterString"].get(key)
+    if accessor is not None:
+        # The string is encoded to a format that CAS BACnet Stack can process once, and cached.
+        encoded = GetEncodedValue("characterString", key, accessor, useArrayIndex, propertyArrayIndex)
+        if encoded is not None:
+            # Copy the string and define how long it is
+            valueElementCount[0] = bufferCopy(encoded, value, maxElementCount)
             return True
-        # Check for objectname Property
-        elif propertyIdentifier == bacnet_propertyIdentifier["objectname"]:
-            if objectType == bacnet_objectType["device"] and objectInstance == db["device"]["instance"]:
-                objectName = db["device"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["analogInput"] and objectInstance == db["analogInput"]["instance"]:
-                objectName = db["analogInput"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["binaryInput"] and objectInstance == db["binaryInput"]["instance"]:
-                objectName = db["binaryInput"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["multiStateInput"] \
-                    and objectInstance == db["multiStateInput"]["instance"]:
-                objectName = db["multiStateInput"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["analogOutput"] and objectInstance == db["analogOutput"]["instance"]:
-                objectName = db["analogOutput"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["analogValue"] and objectInstance == db["analogValue"]["instance"]:
-                objectName = db["analogValue"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["binaryOutput"] and objectInstance == db["binaryOutput"]["instance"]:
-                objectName = db["binaryOutput"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["binaryValue"] and objectInstance == db["binaryValue"]["instance"]:
-                objectName = db["binaryValue"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["multiStateOutput"] and objectInstance == db["multiStateOutput"][
-                "instance"]:
-                objectName = db["multiStateOutput"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["multiStateValue"] and objectInstance == db["multiStateValue"][
-                "instance"]:
-                objectName = db["multiStateValue"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["characterstringValue"] \
-                    and objectInstance == db["characterstringValue"]["instance"]:
-                objectName = db["characterstringValue"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["integerValue"] and objectInstance == db["integerValue"]["instance"]:
-                objectName = db["integerValue"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["largeAnalogValue"] \
-                    and objectInstance == db["largeAnalogValue"]["instance"]:
-                objectName = db["largeAnalogValue"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["positiveIntegerValue"] \
-                    and objectInstance == db["positiveIntegerValue"]["instance"]:
-                objectName = db["positiveIntegerValue"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_objectName)
-                return True
-            elif objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                objectName = db["networkPort"]["objectName"]
-                # Convert the Object Name from a string to a format that CAS BACnet Stack can process.
-                b_objectName = objectName.encode("utf-8")
-                for i in range(len(b_objectName)):
-                    value[i] = b_objectName[i]
-                # Define how long the Object Name  is
-                valueElementCount[0] = len(b_objectName)
-                return True
-        # Check for PresentValue Property
-        elif propertyIdentifier == bacnet_propertyIdentifier["presentValue"]:
-            if objectType == bacnet_objectType["characterstringValue"] and objectInstance == db["characterstringValue"]["instance"]:
-                presentValue = db["characterstringValue"]["presentValue"]
-                b_presentValue = presentValue.encode("utf-8")
-                for i in range(len(b_presentValue)):
-                    value[i] = b_presentValue[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_presentValue)
-                return True
-        # Check for StateText Property
-        elif propertyIdentifier == bacnet_propertyIdentifier["statetext"]:
-            if objectType == bacnet_objectType["multiStateInput"] and objectInstance == db["multiStateInput"]["instance"]:
-                if useArrayIndex:
-                    stateText = db["multiStateInput"]["stateText"][propertyArrayIndex - 1]
-                    b_stateText = stateText.encode("utf-8")
-                    for i in range(len(b_stateText)):
-                        value[i] = b_stateText[i]
-                    # Define how long the Object name is
-                    valueElementCount[0] = len(b_stateText)
-                    return True
-            elif objectType == bacnet_objectType["multiStateOutput"] and objectInstance == db["multiStateOutput"]["instance"]:
-                if useArrayIndex:
-                    stateText = db["multiStateOutput"]["stateText"][propertyArrayIndex - 1]
-                    b_stateText = stateText.encode("utf-8")
-                    for i in range(len(b_stateText)):
-                        value[i] = b_stateText[i]
-                    # Define how long the Object name is
-                    valueElementCount[0] = len(b_stateText)
-                    return True
-            elif objectType == bacnet_objectType["multiStateValue"] and objectInstance == db["multiStateValue"]["instance"]:
-                if useArrayIndex:
-                    stateText = db["multiStateValue"]["stateText"][propertyArrayIndex - 1]
-                    b_stateText = stateText.encode("utf-8")
-                    for i in range(len(b_stateText)):
-                        value[i] = b_stateText[i]
-                    # Define how long the Object name is
-                    valueElementCount[0] = len(b_stateText)
-                    return True
-        #Check for ActiveText Property
-        elif propertyIdentifier == bacnet_propertyIdentifier["activetext"]:
-            if objectType == bacnet_objectType["binaryInput"] and objectInstance == db["binaryInput"]["instance"]:
-                activeText = db["binaryInput"]["activeText"]
-                b_activeText = activeText.encode("utf-8")
-                for i in range(len(b_activeText)):
-                    value[i] = b_activeText[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_activeText)
-                return True
-            elif objectType == bacnet_objectType["binaryValue"] and objectInstance == db["binaryValue"]["instance"]:
-                activeText = db["binaryValue"]["activeText"]
-                b_activeText = activeText.encode("utf-8")
-                for i in range(len(b_activeText)):
-                    value[i] = b_activeText[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_activeText)
-                return True
-        #Check for InActiveText Property
-        elif propertyIdentifier == bacnet_propertyIdentifier["inactivetext"]:
-            if objectType == bacnet_objectType["binaryInput"] and objectInstance == db["binaryInput"]["instance"]:
-                activeText = db["binaryInput"]["inactiveText"]
-                b_activeText = activeText.encode("utf-8")
-                for i in range(len(b_activeText)):
-                    value[i] = b_activeText[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_activeText)
-                return True
-            elif objectType == bacnet_objectType["binaryValue"] and objectInstance == db["binaryValue"]["instance"]:
-                activeText = db["binaryValue"]["inactiveText"]
-                b_activeText = activeText.encode("utf-8")
-                for i in range(len(b_activeText)):
-                    value[i] = b_activeText[i]
-                # Define how long the Object name is
-                valueElementCount[0] = len(b_activeText)
-                return True
 
     # Return false. The CAS BACnet Stack will use a default value.
     return False
 
 
-def ValueToKey(enumeration, searchValue):
-    # https://www.geeksforgeeks.org/python-get-key-from-value-in-dictionary/
-    for key, value in enumeration.items():
-        if value == searchValue:
-            return key
-    return "key doesn't exist"
-
-
 def CallbackGetPropertyEnumerated(deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
                                   propertyArrayIndex):
-    print(
-        "CallbackGetPropertyEnumerated", deviceInstance, objectType, objectInstance, propertyIdentifier,
-        propertyArrayIndex)
-
-    if deviceInstance == db["device"]["instance"]:
-        # Check for presentValue Property
-        if propertyIdentifier == bacnet_propertyIdentifier["presentValue"]:
-            if objectType == bacnet_objectType["binaryInput"] and objectInstance == db["binaryInput"]["instance"]:
-                value[0] = ctypes.c_uint32(db["binaryInput"]["presentValue"])
-                return True
-            elif objectType == bacnet_objectType["binaryValue"] and objectInstance == db["binaryValue"]["instance"]:
-                value[0] = ctypes.c_uint32(db["binaryValue"]["presentValue"])
-                return True
-        # Check for units Property
-        elif propertyIdentifier == bacnet_propertyIdentifier["units"]:
-            if ValueToKey(bacnet_objectType, objectType) in db:
-                if "units" in db[ValueToKey(bacnet_objectType, objectType)]:
-                    value[0] = ctypes.c_uint32(db[ValueToKey(bacnet_objectType, objectType)]["units"])
-                    return True
-        # Check for reliability Property
-        elif propertyIdentifier == bacnet_propertyIdentifier["reliability"]:
-            if ValueToKey(bacnet_objectType, objectType) in db:
-                if "units" in db[ValueToKey(bacnet_objectType, objectType)]:
-                    value[0] = ctypes.c_uint32(db[ValueToKey(bacnet_objectType, objectType)]["reliability"])
-                    return True
-
-            # Undefined reliability. Assume no-fault-detected (0)
-            value[0] = ctypes.c_uint32(0)
+    if logGetPropertyEnumerated.trace:
+        logGetPropertyEnumerated.log(LEVEL_TRACE, logFormatGetProperty,
+                                     deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
+                                     propertyArrayIndex)
+
+    accessor = propertyIndex["enumerated"].get((deviceInstance, objectType, objectInstance, propertyIdentifier))
+    if accessor is not None:
+        propertyValue = accessor.get(useArrayIndex, propertyArrayIndex)
+        if propertyValue is not None:
+            value[0] = propertyValue
             return True
-        # Check for fdbbmdaddress Property, the port portion
-        elif propertyIdentifier == bacnet_propertyIdentifier["fdbbmdaddress"]:
-            if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                value[0] = db["networkPort"]["FdBbmdAddressHostType"]
-                return True
 
     # Return false. The CAS BACnet Stack will use a default value.
     return False
@@ -534,271 +736,179 @@ def CallbackGetPropertyEnumerated(deviceInstance, objectType, objectInstance, pr
 def CallbackGetPropertyBitString(deviceInstance, objectType, objectInstance, propertyIdentifier, value,
                                  valueElementCount, maxElementCount,
                                  useArrayIndex, propertyArrayIndex):
-    print(
-        "CallbackGetPropertyBitString", deviceInstance, objectType, objectInstance, propertyIdentifier, maxElementCount,
-        useArrayIndex,
-        propertyArrayIndex)
+    if logGetPropertyBitString.trace:
+        logGetPropertyBitString.log(LEVEL_TRACE, logFormatGetPropertyBuffer,
+                                    deviceInstance, objectType, objectInstance, propertyIdentifier, maxElementCount,
+                                    useArrayIndex, propertyArrayIndex)
     return False
 
 
 def CallbackGetPropertyBool(deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
                             propertyArrayIndex):
-    print("CallbackGetPropertyBool", deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
-          propertyArrayIndex)
-    if deviceInstance == db["device"]["instance"]:
-        if propertyIdentifier == bacnet_propertyIdentifier["changespending"]:
-            if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                value[0] = db["networkPort"]["changesPending"]
-                return True
+    if logGetPropertyBool.trace:
+        logGetPropertyBool.log(LEVEL_TRACE, logFormatGetProperty,
+                               deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
+                               propertyArrayIndex)
+
+    accessor = propertyIndex["bool"].get((deviceInstance, objectType, objectInstance, propertyIdentifier))
+    if accessor is not None:
+        propertyValue = accessor.get(useArrayIndex, propertyArrayIndex)
+        if propertyValue is not None:
+            value[0] = propertyValue
+            return True
     return False
 
 
 def CallbackGetPropertyDate(deviceInstance, objectType, objectInstance, propertyIdentifier, year, month, day, weekday,
                             useArrayIndex,
                             propertyArrayIndex):
-    print("CallbackGetPropertyDate", deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
-          propertyArrayIndex)
+    if logGetPropertyDate.trace:
+        logGetPropertyDate.log(LEVEL_TRACE, logFormatGetProperty,
+                               deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
+                               propertyArrayIndex)
     return False
 
 
 def CallbackGetPropertyDouble(deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
                               propertyArrayIndex):
-    print("CallbackGetPropertyDouble", deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
-          propertyArrayIndex)
-
-    if deviceInstance == db["device"]["instance"]:
-        if propertyIdentifier == bacnet_propertyIdentifier["presentValue"]:
-            if objectType == bacnet_objectType["largeAnalogValue"] and objectInstance == db["largeAnalogValue"][
-                "instance"]:
-                value[0] = ctypes.c_double(db["largeAnalogValue"]["presentValue"])
-                return True
+    if logGetPropertyDouble.trace:
+        logGetPropertyDouble.log(LEVEL_TRACE, logFormatGetProperty,
+                                 deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
+                                 propertyArrayIndex)
+
+    accessor = propertyIndex["double"].get((deviceInstance, objectType, objectInstance, propertyIdentifier))
+    if accessor is not None:
+        propertyValue = accessor.get(useArrayIndex, propertyArrayIndex)
+        if propertyValue is not None:
+            value[0] = propertyValue
+            return True
     return False
 
 
 def CallbackGetPropertyOctetString(deviceInstance, objectType, objectInstance, propertyIdentifier, value,
                                    valueElementCount, maxElementCount,
                                    useArrayIndex, propertyArrayIndex):
-    print("CallbackGetPropertyOctetString", deviceInstance, objectInstance, propertyIdentifier, maxElementCount,
-          useArrayIndex, propertyArrayIndex)
-    if propertyIdentifier == bacnet_propertyIdentifier["ipaddress"]:
-        if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-            valueElementCount[0] = db["networkPort"]["ipLength"]
-            octetStringCopy(db["networkPort"]["ipAddress"], value, valueElementCount[0])
-            print("DEBUG: IN GET IP: output =" + str(value[0]) + "." + str(value[1]) + "." + str(value[2]) + "." + str(
-                value[3]))
-            return True
-    elif propertyIdentifier == bacnet_propertyIdentifier["ipdefaultgateway"]:
-        if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-            valueElementCount[0] = db["networkPort"]["ipLength"]
-            octetStringCopy(db["networkPort"]["ipDefaultGateway"], value, valueElementCount[0])
-            return True
-    elif propertyIdentifier == bacnet_propertyIdentifier["ipsubnetmask"]:
-        if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-            valueElementCount[0] = db["networkPort"]["ipLength"]
-            octetStringCopy(db["networkPort"]["ipSubnetMask"], value, valueElementCount[0])
-            return True
-    elif propertyIdentifier == bacnet_propertyIdentifier["ipdnsserver"]:
-        if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-            valueElementCount[0] = db["networkPort"]["ipNumOfDns"] * 4
-            for i in range(db["networkPort"]["ipNumOfDns"]):
-                octetStringCopy(db["networkPort"]["ipDnsServer"][i], value, 4, i * 4)
-            return True
-    elif propertyIdentifier == bacnet_propertyIdentifier["fdbbmdaddress"]:
-        if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-            valueElementCount[0] = db["networkPort"]["ipLength"]
-            octetStringCopy(db["networkPort"]["FdBbmdAddressHostIp"], value, valueElementCount[0])
+    if logGetPropertyOctetString.trace:
+        logGetPropertyOctetString.log(LEVEL_TRACE, logFormatGetPropertyBuffer,
+                                      deviceInstance, objectType, objectInstance, propertyIdentifier, maxElementCount,
+                                      useArrayIndex, propertyArrayIndex)
+
+    key = (deviceInstance, objectType, objectInstance, propertyIdentifier)
+    accessor = propertyIndex["octetString"].get(key)
+    if accessor is not None:
+        encoded = GetEncodedValue("octetString", key, accessor, useArrayIndex, propertyArrayIndex)
+        if encoded is not None:
+            valueElementCount[0] = bufferCopy(encoded, value, maxElementCount)
             return True
     return False
 
 
 def CallbackGetPropertyInt(deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
                            propertyArrayIndex):
-    print("CallbackGetPropertyInt", deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
-          propertyArrayIndex)
-
-    if deviceInstance == db["device"]["instance"]:
-        if propertyIdentifier == bacnet_propertyIdentifier["presentValue"]:
-            if objectType == bacnet_objectType["integerValue"] and objectInstance == db["integerValue"]["instance"]:
-                value[0] = ctypes.c_int32(db["integerValue"]["presentValue"])
-                return True
-
+    if logGetPropertyInt.trace:
+        logGetPropertyInt.log(LEVEL_TRACE, logFormatGetProperty,
+                              deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
+                              propertyArrayIndex)
+
+    accessor = propertyIndex["signedInteger"].get((deviceInstance, objectType, objectInstance, propertyIdentifier))
+    if accessor is not None:
+        propertyValue = accessor.get(useArrayIndex, propertyArrayIndex)
+        if propertyValue is not None:
+            value[0] = propertyValue
+            return True
     return False
 
 
 def CallbackGetPropertyTime(deviceInstance, objectType, objectInstance, propertyIdentifier, hour, minute, second,
                             hundrethSeconds, useArrayIndex,
                             propertyArrayIndex):
-    print("CallbackGetPropertyTime", deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
-          propertyArrayIndex)
+    if logGetPropertyTime.trace:
+        logGetPropertyTime.log(LEVEL_TRACE, logFormatGetProperty,
+                               deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
+                               propertyArrayIndex)
     return False
 
 
 def CallbackGetPropertyUInt(deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
                             propertyArrayIndex):
-    print("CallbackGetPropertyUInt", deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
-          propertyArrayIndex)
-    if deviceInstance == db["device"]["instance"]:
-        # Check for vendoridentifier property
-        if propertyIdentifier == bacnet_propertyIdentifier["vendoridentifier"]:
-            if objectType == bacnet_objectType["device"]:
-                value[0] = ctypes.c_uint32(db["device"]["vendoridentifier"])
-                return True
-        # Check for bacnetipudpport property        
-        elif propertyIdentifier == bacnet_propertyIdentifier["bacnetipudpport"]:
-            if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                value[0] = db["networkPort"]["BACnetIPUDPPort"]
-                return True
-        # Network Port Object IP DNS Server Array Size property
-        elif propertyIdentifier == bacnet_propertyIdentifier["ipdnsserver"]:
-            if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                if useArrayIndex and propertyArrayIndex == 0:
-                    value[0] = db["networkPort"]["ipNumOfDns"]
-                    return True
-        # Check for fdbbmdaddress property
-        elif propertyIdentifier == bacnet_propertyIdentifier["fdbbmdaddress"]:
-            if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                if useArrayIndex and propertyArrayIndex == casbacnetstack_fdBbmdAddressOffset["port"]:
-                    value[0] = db["networkPort"]["FdBbmdAddressPort"]
-                    return True
-        # Check for fdsubscriptionlifetime property
-        elif propertyIdentifier == bacnet_propertyIdentifier["fdsubscriptionlifetime"]:
-            if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                value[0] = db["networkPort"]["FdSubscriptionLifetime"]
-                return True
-        # Check for PresentValue property
-        elif propertyIdentifier == bacnet_propertyIdentifier["presentValue"]:
-            if objectType == bacnet_objectType["multiStateInput"] and objectInstance == \
-                    db["multiStateInput"]["instance"]:
-                value[0] = ctypes.c_uint32(db["multiStateInput"]["presentValue"])
-                return True
-            elif objectType == bacnet_objectType["multiStateValue"] and objectInstance == \
-                    db["multiStateValue"]["instance"]:
-                value[0] = ctypes.c_uint32(db["multiStateValue"]["presentValue"])
-                return True
-            elif objectType == bacnet_objectType["positiveIntegerValue"] and objectInstance == \
-                    db["positiveIntegerValue"]["instance"]:
-                value[0] = ctypes.c_uint32(db["positiveIntegerValue"]["presentValue"])
-                return True
-        # Check for NumberOfStates property
-        elif propertyIdentifier == bacnet_propertyIdentifier["numberofstates"]:
-            if objectType == bacnet_objectType["multiStateInput"] and objectInstance == \
-                    db["multiStateInput"]["instance"]:
-                value[0] = ctypes.c_uint32(db["multiStateInput"]["numberOfStates"])
-                return True
-            elif objectType == bacnet_objectType["multiStateOutput"] and objectInstance == \
-                    db["multiStateOutput"]["instance"]:
-                value[0] = ctypes.c_uint32(db["multiStateOutput"]["numberOfStates"])
-                return True
-            elif objectType == bacnet_objectType["multiStateValue"] and objectInstance == \
-                    db["multiStateValue"]["instance"]:
-                value[0] = ctypes.c_uint32(db["multiStateValue"]["numberOfStates"])
-                return True
-        # Check for StateText array size (propertyArrayIndex = 0)
-        elif propertyIdentifier == bacnet_propertyIdentifier["statetext"]:
-            if objectType == bacnet_objectType["multiStateInput"] and objectInstance == db["multiStateInput"]["instance"]:
-                if useArrayIndex and propertyArrayIndex == 0:
-                    value[0] = len(db["multiStateInput"]["stateText"])
-                    return True
-            elif objectType == bacnet_objectType["multiStateOutput"] and objectInstance == db["multiStateOutput"]["instance"]:
-                if useArrayIndex and propertyArrayIndex == 0:
-                    value[0] = len(db["multiStateOutput"]["stateText"])
-                    return True
-            elif objectType == bacnet_objectType["multiStateValue"] and objectInstance == db["multiStateValue"]["instance"]:
-                if useArrayIndex and propertyArrayIndex == 0:
-                    value[0] = len(db["multiStateValue"]["stateText"])
-                    return True
+    if logGetPropertyUInt.trace:
+        logGetPropertyUInt.log(LEVEL_TRACE, logFormatGetProperty,
+                               deviceInstance, objectType, objectInstance, propertyIdentifier, useArrayIndex,
+                               propertyArrayIndex)
+
+    accessor = propertyIndex["unsignedInteger"].get((deviceInstance, objectType, objectInstance, propertyIdentifier))
+    if accessor is not None:
+        propertyValue = accessor.get(useArrayIndex, propertyArrayIndex)
+        if propertyValue is not None:
+            value[0] = propertyValue
+            return True
     return False
 
 
 def CallbackSetPropertyUInt(deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
                             propertyArrayIndex, priority,
                             errorCode):
-    print(
-        "CallbackSetPropertyUInt", deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
-        propertyArrayIndex,
-        priority, errorCode)
-    if deviceInstance == db["device"]["instance"]:
-        # Check for the fdbbmdaddress property, port portion
-        if propertyIdentifier == bacnet_propertyIdentifier["fdbbmdaddress"]:
-            if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                db["networkPort"]["FdBbmdAddressPort"] = value
-                db["networkPort"]["changesPending"] = True
-                return True
-        # Check for the fdsubscriptionlifetime property
-        elif propertyIdentifier == bacnet_propertyIdentifier["fdsubscriptionlifetime"]:
-            if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                db["networkPort"]["FdSubscriptionLifetime"] = value
-                db["networkPort"]["changesPending"] = True
-                return True
-        # Check for the PresentValue property
-        elif propertyIdentifier == bacnet_propertyIdentifier["presentValue"]:
-            if objectType == bacnet_objectType["multiStateValue"] and objectInstance == db["multiStateValue"][
-                "instance"]:
-                db["multiStateValue"]["presentValue"] = value
-                return True
+    if logSetPropertyUInt.trace:
+        logSetPropertyUInt.log(LEVEL_TRACE, logFormatSetProperty,
+                               deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
+                               propertyArrayIndex, priority)
+
+    key = (deviceInstance, objectType, objectInstance, propertyIdentifier)
+    accessor = propertyIndex["unsignedInteger"].get(key)
+    if accessor is not None and accessor.writable and accessor.set(value, useArrayIndex, propertyArrayIndex):
+        PropertyWritten("unsignedInteger", key, value, priority)
+        return True
     return False
 
 
 def CallbackSetPropertyReal(deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
                             propertyArrayIndex, priority,
                             errorCode):
-    print(
-        "CallbackSetPropertyReal", deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
-        propertyArrayIndex,
-        priority, errorCode)
-    if deviceInstance == db["device"]["instance"]:
-        # Check for the PresentValue property
-        if propertyIdentifier == bacnet_propertyIdentifier["presentValue"]:
-            if objectType == bacnet_objectType["analogInput"] and objectInstance == db["analogInput"]["instance"]:
-                db["analogInput"]["presentValue"] = value
-                return True
-            elif objectType == bacnet_objectType["analogValue"] and objectInstance == db["analogValue"]["instance"]:
-                db["analogValue"]["presentValue"] = value
-                return True
-        # Check for the covincrement property
-        elif propertyIdentifier == bacnet_propertyIdentifier["covincrement"]:
-            if objectType == bacnet_objectType["analogInput"] and objectInstance == db["analogInput"]["instance"]:
-                db["analogInput"]["covIncrement"] = value
-                return True
-            elif objectType == bacnet_objectType["analogValue"] and objectInstance == db["analogValue"]["instance"]:
-                db["analogValue"]["covIncrement"] = value
-                return True
+    if logSetPropertyReal.trace:
+        logSetPropertyReal.log(LEVEL_TRACE, logFormatSetProperty,
+                               deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
+                               propertyArrayIndex, priority)
+
+    key = (deviceInstance, objectType, objectInstance, propertyIdentifier)
+    accessor = propertyIndex["real"].get(key)
+    if accessor is not None and accessor.writable and accessor.set(value, useArrayIndex, propertyArrayIndex):
+        PropertyWritten("real", key, value, priority)
+        return True
     return False
 
 
 def CallbackSetPropertyEnumerated(deviceInstance, objectType, objectInstance, propertyIdentifier, value, useArrayIndex,
                                   propertyArrayIndex, priority,
                                   errorCode):
-    print(
-        "CallbackSetPropertyEnumerated", deviceInstance, objectType, objectInstance, propertyIdentifier, value,
-        useArrayIndex,
-        propertyArrayIndex,
-        priority, errorCode)
-    if deviceInstance == db["device"]["instance"]:
-        # Check for the PresentValue property
-        if propertyIdentifier == bacnet_propertyIdentifier["presentValue"]:
-            if objectType == bacnet_objectType["binaryValue"] and objectInstance == db["binaryValue"]["instance"]:
-                db["binaryValue"]["presentValue"] = value
-                return True
+    if logSetPropertyEnumerated.trace:
+        logSetPropertyEnumerated.log(LEVEL_TRACE, logFormatSetProperty,
+                                     deviceInstance, objectType, objectInstance, propertyIdentifier, value,
+                                     useArrayIndex, propertyArrayIndex, priority)
+
+    key = (deviceInstance, objectType, objectInstance, propertyIdentifier)
+    accessor = propertyIndex["enumerated"].get(key)
+    if accessor is not None and accessor.writable and accessor.set(value, useArrayIndex, propertyArrayIndex):
+        PropertyWritten("enumerated", key, value, priority)
+        return True
     return False
 
 
 def CallbackSetPropertyOctetString(deviceInstance, objectType, objectInstance, propertyIdentifier, value, length,
                                    useArrayIndex, propertyArray,
                                    priority, errorCode):
-    print(
-        "CallbackSetPropertyOctetString", deviceInstance, objectType, objectInstance, propertyIdentifier, value, length,
-        useArrayIndex,
-        propertyArray, priority, errorCode)
-    if deviceInstance == db["device"]["instance"]:
-        if propertyIdentifier == bacnet_propertyIdentifier["fdbbmdaddress"]:
-            if objectType == bacnet_objectType["networkPort"] and objectInstance == db["networkPort"]["instance"]:
-                db["networkPort"]["FdBbmdAddressHostIp"][0] = value[0]
-                db["networkPort"]["FdBbmdAddressHostIp"][1] = value[1]
-                db["networkPort"]["FdBbmdAddressHostIp"][2] = value[2]
-                db["networkPort"]["FdBbmdAddressHostIp"][3] = value[3]
-                db["networkPort"]["changesPending"] = False
-                return True
+    octets = list(value[0:length])
+    if logSetPropertyOctetString.trace:
+        logSetPropertyOctetString.log(LEVEL_TRACE, logFormatSetProperty,
+                                      deviceInstance, objectType, objectInstance, propertyIdentifier, octets,
+                                      useArrayIndex, propertyArray, priority)
+
+    key = (deviceInstance, objectType, objectInstance, propertyIdentifier)
+    accessor = propertyIndex["octetString"].get(key)
+    if accessor is not None and accessor.writable:
+        InvalidateEncodedValue(deviceInstance, objectType, objectInstance, propertyIdentifier)
+        if accessor.set(octets, useArrayIndex, propertyArray):
+            PropertyWritten("octetString", key, octets, priority)
+            return True
     return False
 
 
@@ -806,8 +916,9 @@ def CallbackReinitializeDevice(deviceInstance, reinitializedState, password, pas
     # Rebuild password from pointer reference
     derefedPassword = rebuildString(password, passwordLength)
 
-    print(
-        "CallbackReinitializeDevice", deviceInstance, reinitializedState, derefedPassword, passwordLength, errorCode[0])
+    if logReinitializeDevice.trace:
+        logReinitializeDevice.log(LEVEL_TRACE, "device=%s reinitializedState=%s passwordLength=%s",
+                                  deviceInstance, reinitializedState, passwordLength)
 
     # This callback is called when this BACnet Server device receives a ReinitializeDevice message
     # In this callback, you will handle the reinitializedState
@@ -827,26 +938,36 @@ def CallbackReinitializeDevice(deviceInstance, reinitializedState, password, pas
         errorCode[0] = bacnet_errorCode["password-failure"]
         return False
 
-    # In this example, only the NetworkPort Object FdBbmdAddress and FdSubscriptionLifetime properties are writable and
-    #   need to be stored in non-volatile memory.  For the purpose of this example, we will not storing these values in
-    #   non-volatile memory.
+    # In this example, the NetworkPort Object FdBbmdAddress and FdSubscriptionLifetime properties and the writable
+    #   presentValue and covIncrement properties are stored in non-volatile memory (the persistent store) as they are
+    #   written.
 
     # 1. Store values that must be stored in non-volatile memory (i.e. must survive a reboot)
+    if persistentStore is not None:
+        persistentStore.flush()
+    if writeLog is not None:
+        writeLog.commit()
 
     # 2. Apply any Network Port values that have been written to
     # If any validation on the Network Port values fails, set errorCode to INVALID_CONFIGURATION_DATA (46)
+    UpdateBroadcastAddresses()
 
     # 3. Set Network Port ChangesPending property to false
 
     # 4. Handle ReinitializedState. If ACTIVATE_CHANGES, no other action, return true
     #                               If WARM_START, prepare device for reboot, return true. and reboot
     # NOTE: Must return True first before rebooting so the stack sends the SimpleAck
+    # Only the gateway device (db) has Network Port objects, one per BACnet/IP port. Virtual devices have nothing to
+    # apply.
+    networkPorts = devices.get(deviceInstance, {}).get("networkPorts", ())
     if reinitializedState == casbacnetstack_reinitializeState["state-activate-changes"]:
-        db["networkPort"]["changesPending"] = False
+        for networkPort in networkPorts:
+            networkPort["changesPending"] = False
         return True
     elif reinitializedState == casbacnetstack_reinitializeState["state-warm-start"]:
         # Flag for reboot and handle reboot after stack responds with SimpleAck
-        db["networkPort"]["changesPending"] = False
+        for networkPort in networkPorts:
+            networkPort["changesPending"] = False
         errorCode[0] = 2
         return True
     else:
@@ -860,9 +981,10 @@ def CallbackDeviceCommunicationControl(deviceInstance, enableDisable, password,
     # Rebuild password from pointer reference
     derefedPassword = rebuildString(password, passwordLength)
 
-    print("CallbackDeviceCommunicationControl", deviceInstance, enableDisable, derefedPassword, passwordLength,
-          useTimeDuration, timeDuration,
-          errorCode[0])
+    if logDeviceCommunicationControl.trace:
+        logDeviceCommunicationControl.log(LEVEL_TRACE, "device=%s enableDisable=%s passwordLength=%s "
+                                                       "useTimeDuration=%s timeDuration=%s",
+                                          deviceInstance, enableDisable, passwordLength, useTimeDuration, timeDuration)
 
     # This callback is called when this BACnet Server device receives a DeviceCommunicationControl message
     # In this callback, you will handle the password. All other parameters are purely for logging to know
@@ -886,407 +1008,531 @@ def CallbackDeviceCommunicationControl(deviceInstance, enableDisable, password,
 def CallbackLogDebugMessage(message, messageLength, messageType):
     # Rebuild message from pointer reference
     derefedMessage = rebuildString(message, messageLength)
-    print("CallbackLogDebugMessage", derefedMessage, messageLength, messageType)
+    if logLogDebugMessage.trace:
+        logLogDebugMessage.log(LEVEL_TRACE, "message=%s messageLength=%s messageType=%s",
+                               derefedMessage, messageLength, messageType)
 
     if derefedMessage != "" and messageLength != 0:
-        print("CAS BACnet Stack DEBUG MESSAGE: ", derefedMessage)
+        if messageType == casbacnet_debugMessageType["Error"]:
+            logLogDebugMessage.log(LEVEL_ERROR, "CAS BACnet Stack DEBUG MESSAGE: %s", derefedMessage)
+        else:
+            logLogDebugMessage.log(LEVEL_DEBUG, "CAS BACnet Stack DEBUG MESSAGE: %s", derefedMessage)
 
 
-# Main application
+# Callback registration
 # -----------------------------------------------------------------------------
-if __name__ == "__main__":
-    print("FYI: CAS BACnet Stack Python2.7 Server Example v{}".format(bacnet_server_example_python27_version))
-    print("FYI: https://github.com/chipkin/BACnetServerExamplePython2.7")
+# Make sure you keep references to CFUNCTYPE() objects (ffi.callback() objects with the cffi backend) as long as they
+# are used from C code.
+# ctypes doesn't, and if you don"t, they may be garbage collected, crashing your program when
+# a callback is made
+#
+# Because of garbage collection, the callback objects are kept in registeredCallbacks.
+registeredCallbacks = []
 
-    # 1. Load the CAS BACnet stack functions
-    # ---------------------------------------------------------------------------
-    # Load the shared library into ctypes
-    libpath = pathlib.Path().absolute() / libname
-    print("FYI: Libary path: ", libpath)
-    CASBACnetStack = ctypes.CDLL(str(libpath), mode=ctypes.RTLD_GLOBAL)
+# Every callback is registered with call counters and latency histograms (see BACnetServerInstrumentation). Set
+# BACNET_INSTRUMENT=1 to enable them at startup. They can be switched on and off at runtime.
+instrumentation = BACnetServerInstrumentation.Instrumentation(os.environ.get("BACNET_INSTRUMENT") == "1")
 
-    # Print the version information
-    print("FYI: CAS BACnet Stack version: " + str(CASBACnetStack.BACnetStack_GetAPIMajorVersion()) + "." +
-          str(CASBACnetStack.BACnetStack_GetAPIMinorVersion()) +
-          "." + str(CASBACnetStack.BACnetStack_GetAPIPatchVersion()) + "." +
-          str(CASBACnetStack.BACnetStack_GetAPIBuildVersion()))
-    print("FYI: CAS BACnet Stack python adapter version:" + str(casbacnetstack_adapter_version))
 
-    # 2. Connect the UDP resource to the BACnet Port and get network info
-    # ---------------------------------------------------------------------------
-    print("FYI: Connecting UDP Resource to port=[" + str(db['networkPort']['BACnetIPUDPPort']) + "]")
-    HOST = ""  # Symbolic name meaning all available interfaces
-    udpSocket.bind((HOST, db["networkPort"]["BACnetIPUDPPort"]))
-    udpSocket.setblocking(False)
-
-    # Load network information into database
-
-    db["networkPort"]["ipAddress"] = [int(octet) for octet in
-                                      netifaces.ifaddresses(netifaces.interfaces()[0])[netifaces.AF_INET][0][
-                                          "addr"].split(".")]
-    db["networkPort"]["ipSubnetMask"] = [int(octet) for octet in
-                                         netifaces.ifaddresses(netifaces.interfaces()[0])[netifaces.AF_INET][0][
-                                             "netmask"].split(".")]
-    db["networkPort"]["ipDefaultGateway"] = [int(octet) for octet in
-                                             netifaces.gateways()["default"][netifaces.AF_INET][0].split(".")]
-    dnsServerOctetList = []
-    for dnsServer in dns.resolver.Resolver().nameservers:
-        dnsServerOctetList.append([int(octet) for octet in dnsServer.split(".")])
-    db["networkPort"]["ipNumOfDns"] = len(dnsServerOctetList)
-    db["networkPort"]["ipDnsServer"] = dnsServerOctetList
-
-    print("FYI: Local IP address: ", db["networkPort"]["ipAddress"])
+def RegisterCallbacks(stack):
+    """Registers the callback functions of this example with the CAS BACnet Stack, or with a stand-in that has the
+    same BACnetStack_* functions (see BACnetServerFakeStack)."""
 
-    # 3. Setup the callbacks
-    # ---------------------------------------------------------------------------
-    print("FYI: Registering the Callback Functions with the CAS BACnet Stack")
+    def register(name, prototype, function):
+        callback = prototype(instrumentation.wrap(function))
+        registeredCallbacks.append(callback)
+        getattr(stack, "BACnetStack_RegisterCallback" + name)(callback)
 
-    # Note:
-    # Make sure you keep references to CFUNCTYPE() objects as long as they are used from C code.
-    # ctypes doesn't, and if you don"t, they may be garbage collected, crashing your program when
-    # a callback is made
-    #
-    # Because of garbage collection, the pyCallback**** functions need to stay in scope.
-    
     # Core Callbacks
-    pyCallbackReceiveMessage = fpCallbackReceiveMessage(CallbackReceiveMessage)
-    CASBACnetStack.BACnetStack_RegisterCallbackReceiveMessage(pyCallbackReceiveMessage)
-    pyCallbackSendMessage = fpCallbackSendMessage(CallbackSendMessage)
-    CASBACnetStack.BACnetStack_RegisterCallbackSendMessage(pyCallbackSendMessage)
-    pyCallbackGetSystemTime = fpCallbackGetSystemTime(CallbackGetSystemTime)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetSystemTime(pyCallbackGetSystemTime)
+    register("ReceiveMessage", fpCallbackReceiveMessage, CallbackReceiveMessage)
+    register("SendMessage", fpCallbackSendMessage, CallbackSendMessage)
+    register("GetSystemTime", fpCallbackGetSystemTime, CallbackGetSystemTime)
 
     # GetProperty Callbacks
-    pyCallbackGetPropertyBitString = fpCallbackGetPropertyBitString(CallbackGetPropertyBitString)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyBitString(pyCallbackGetPropertyBitString)
-    pyCallbackGetPropertyBool = fpCallbackGetPropertyBool(CallbackGetPropertyBool)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyBool(pyCallbackGetPropertyBool)
-    pyCallbackGetPropertyCharString = fpCallbackGetPropertyCharString(CallbackGetPropertyCharString)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyCharacterString(pyCallbackGetPropertyCharString)
-    pyCallbackGetPropertyDate = fpCallbackGetPropertyDate(CallbackGetPropertyDate)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyDate(pyCallbackGetPropertyDate)
-    pyCallbackGetPropertyDouble = fpCallbackGetPropertyDouble(CallbackGetPropertyDouble)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyDouble(pyCallbackGetPropertyDouble)
-    pyCallbackGetPropertyEnum = fpCallbackGetPropertyEnum(CallbackGetPropertyEnumerated)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyEnumerated(pyCallbackGetPropertyEnum)
-    pyCallbackGetPropertyOctetString = fpCallbackGetPropertyOctetString(CallbackGetPropertyOctetString)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyOctetString(pyCallbackGetPropertyOctetString)
-    pyCallbackGetPropertyInt = fpCallbackGetPropertyInt(CallbackGetPropertyInt)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertySignedInteger(pyCallbackGetPropertyInt)
-    pyCallbackGetPropertyReal = fpCallbackGetPropertyReal(CallbackGetPropertyReal)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyReal(pyCallbackGetPropertyReal)
-    pyCallbackGetPropertyTime = fpCallbackGetPropertyTime(CallbackGetPropertyTime)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyTime(pyCallbackGetPropertyTime)
-    pyCallbackGetPropertyUInt = fpCallbackGetPropertyUInt(CallbackGetPropertyUInt)
-    CASBACnetStack.BACnetStack_RegisterCallbackGetPropertyUnsignedInteger(pyCallbackGetPropertyUInt)
+    register("GetPropertyBitString", fpCallbackGetPropertyBitString, CallbackGetPropertyBitString)
+    register("GetPropertyBool", fpCallbackGetPropertyBool, CallbackGetPropertyBool)
+    register("GetPropertyCharacterString", fpCallbackGetPropertyCharString, CallbackGetPropertyCharString)
+    register("GetPropertyDate", fpCallbackGetPropertyDate, CallbackGetPropertyDate)
+    register("GetPropertyDouble", fpCallbackGetPropertyDouble, CallbackGetPropertyDouble)
+    register("GetPropertyEnumerated", fpCallbackGetPropertyEnum, CallbackGetPropertyEnumerated)
+    register("GetPropertyOctetString", fpCallbackGetPropertyOctetString, CallbackGetPropertyOctetString)
+    register("GetPropertySignedInteger", fpCallbackGetPropertyInt, CallbackGetPropertyInt)
+    register("GetPropertyReal", fpCallbackGetPropertyReal, CallbackGetPropertyReal)
+    register("GetPropertyTime", fpCallbackGetPropertyTime, CallbackGetPropertyTime)
+    register("GetPropertyUnsignedInteger", fpCallbackGetPropertyUInt, CallbackGetPropertyUInt)
 
     # SetProperty Callbacks
-    pyCallbackSetPropertyEnumerated = fpCallbackSetPropertyEnum(CallbackSetPropertyEnumerated)
-    CASBACnetStack.BACnetStack_RegisterCallbackSetPropertyEnumerated(pyCallbackSetPropertyEnumerated)   
-    pyCallbackSetPropertyOctetString = fpCallbackSetPropertyOctetString(CallbackSetPropertyOctetString)
-    CASBACnetStack.BACnetStack_RegisterCallbackSetPropertyOctetString(pyCallbackSetPropertyOctetString)
-    pyCallbackSetPropertyReal = fpCallbackSetPropertyReal(CallbackSetPropertyReal)
-    CASBACnetStack.BACnetStack_RegisterCallbackSetPropertyReal(pyCallbackSetPropertyReal)
-    pyCallbackSetPropertyUInt = fpCallbackSetPropertyUInt(CallbackSetPropertyUInt)
-    CASBACnetStack.BACnetStack_RegisterCallbackSetPropertyUnsignedInteger(pyCallbackSetPropertyUInt)
+    register("SetPropertyEnumerated", fpCallbackSetPropertyEnum, CallbackSetPropertyEnumerated)
+    register("SetPropertyOctetString", fpCallbackSetPropertyOctetString, CallbackSetPropertyOctetString)
+    register("SetPropertyReal", fpCallbackSetPropertyReal, CallbackSetPropertyReal)
+    register("SetPropertyUnsignedInteger", fpCallbackSetPropertyUInt, CallbackSetPropertyUInt)
 
     # BACnet Service Callbacks
-    pyCallbackReinitializeDevice = fpCallbackReinitializeDevice(CallbackReinitializeDevice)
-    CASBACnetStack.BACnetStack_RegisterCallbackReinitializeDevice(pyCallbackReinitializeDevice)
-    pyCallbackDeviceCommunicationControl = fpCallbackDeviceCommunicationControl(CallbackDeviceCommunicationControl)
-    CASBACnetStack.BACnetStack_RegisterCallbackDeviceCommunicationControl(pyCallbackDeviceCommunicationControl)
-    # pyCallbackLogDebugMessage = fpCallbackLogDebugMessage(CallbackLogDebugMessage)
-    # CASBACnetStack.BACnetStack_RegisterCallbackLogDebugMessage(pyCallbackLogDebugMessage)
-
-    # 4. Setup the BACnet device
-    # ---------------------------------------------------------------------------
-    print("FYI: Setting up server Device. device.instance=[" + str(db['device']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddDevice(db["device"]["instance"]):
-        print("Error: Failed to add Device")
-        exit()
-
-    # Enable optional BACnet services.
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["readPropertyMultiple"], True)
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["writeProperty"], True)
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["writePropertyMultiple"], True)
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["subscribeCov"], True)
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["subscribeCovProperty"], True)
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["reinitializeDevice"], True)
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["deviceCommunicationControl"], True)
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["iAm"], True)
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["confirmedTextMessage"], True)
-    CASBACnetStack.BACnetStack_SetServiceEnabled(db["device"]["instance"], casbacnetstack_service["unconfirmedTextMessage"], True)
-
-    # Add Objects
-    # ---------------------------------------
-
-    # AnalogInput (AI)
-    # ---------------------------------------
-    print("FYI: Adding AnalogInput. AnalogInput.instance=[" + str(db['analogInput']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["analogInput"],
-                                                db["analogInput"]["instance"]):
-        print("Error: Failed to add analogInput")
-        exit()
-
-    # Enable optional properties
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["analogInput"],
-                                                  db["analogInput"]["instance"],
-                                                  bacnet_propertyIdentifier["covincrement"], True)
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["analogInput"],
-                                                  db["analogInput"]["instance"],
-                                                  bacnet_propertyIdentifier["reliability"], True)
-
-    # Make analogInput subscribable
-    CASBACnetStack.BACnetStack_SetPropertySubscribable(db["device"]["instance"], bacnet_objectType["analogInput"],
-                                                    db["analogInput"]["instance"],
-                                                    bacnet_propertyIdentifier["presentValue"], True)
-
-    # Make covIncrement writable
-    CASBACnetStack.BACnetStack_SetPropertyWritable(db["device"]["instance"], bacnet_objectType["analogInput"],
-            db["analogInput"]["instance"], bacnet_propertyIdentifier["covincrement"], True)
-
-    # BinaryInput (BI)
-    # ---------------------------------------
-    print("FYI: Adding BinaryInput. BinaryInput.instance=[" + str(db['binaryInput']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["binaryInput"],
-                                                db["binaryInput"]["instance"]):
-        print("Error: Failed to add binaryInput")
-        exit()
-
-    # Enable Optional Properties
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["binaryInput"],
-                                                  db["binaryInput"]["instance"],
-                                                  bacnet_propertyIdentifier["activetext"], True)
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["binaryInput"],
-                                                  db["binaryInput"]["instance"],
-                                                  bacnet_propertyIdentifier["inactivetext"], True)
-
-    # Make binaryInput subscribable
-    CASBACnetStack.BACnetStack_SetPropertySubscribable(db["device"]["instance"], bacnet_objectType["binaryInput"],
-                                                    db["binaryInput"]["instance"],
-                                                    bacnet_propertyIdentifier["presentValue"], True)
-
-    # MultiStateInput (MSI)
-    # ---------------------------------------
-    print("FYI: Adding MultiStateInput. MultiStateInput.instance=[" + str(db['multiStateInput']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["multiStateInput"],
-                                                db["multiStateInput"]["instance"]):
-        print("Error: Failed to add MultiStateInput")
-        exit()
+    register("ReinitializeDevice", fpCallbackReinitializeDevice, CallbackReinitializeDevice)
+    register("DeviceCommunicationControl", fpCallbackDeviceCommunicationControl, CallbackDeviceCommunicationControl)
+    # register("LogDebugMessage", fpCallbackLogDebugMessage, CallbackLogDebugMessage)
 
-    # Enable Optional Properties
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["multiStateInput"],
-                                                  db["multiStateInput"]["instance"],
-                                                  bacnet_propertyIdentifier["statetext"], True)
-
-    # Make multiStateInput subscribable
-    CASBACnetStack.BACnetStack_SetPropertySubscribable(db["device"]["instance"], bacnet_objectType["multiStateInput"],
-                                                    db["multiStateInput"]["instance"],
-                                                    bacnet_propertyIdentifier["presentValue"], True)
-
-    # AnalogOutput (AO)
-    # ---------------------------------------
-    print("FYI: Adding analogOutput. analogOutput.instance=[" + str(db['analogOutput']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["analogOutput"],
-                                                db["analogOutput"]["instance"]):
-        print("Error: Failed to add analogOutput")
-        exit()
 
-    # AnalogValue (AV)
-    # ---------------------------------------
-    print("FYI: Adding analogValue. analogValue.instance=[" + str(db['analogValue']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["analogValue"],
-                                                db["analogValue"]["instance"]):
-        print("Error: Failed to add analogValue")
-        exit()
-
-    # Enable optional properties
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["analogValue"],
-                                                  db["analogValue"]["instance"],
-                                                  bacnet_propertyIdentifier["reliability"], True)
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["analogValue"],
-                                                  db["analogValue"]["instance"],
-                                                  bacnet_propertyIdentifier["covincrement"], True)
-    # Make analogValue PresentValue Writable
-    if not CASBACnetStack.BACnetStack_SetPropertyWritable(db["device"]["instance"], bacnet_objectType["analogValue"],
-            db["analogValue"]["instance"], bacnet_propertyIdentifier["presentValue"], True):
-        print("Error: Failed to set analogValue.presentValue to writable")
-
-    # Make covIncrement writable
-    CASBACnetStack.BACnetStack_SetPropertyWritable(db["device"]["instance"], bacnet_objectType["analogValue"],
-            db["analogValue"]["instance"], bacnet_propertyIdentifier["covincrement"], True)
-   
-    # Make analogValue subscribable
-    CASBACnetStack.BACnetStack_SetPropertySubscribable(db["device"]["instance"], bacnet_objectType["analogValue"],
-                                                    db["analogValue"]["instance"],
-                                                    bacnet_propertyIdentifier["presentValue"], True)
-
-    # BinaryOutput (BO)
-    # ---------------------------------------
-    print("FYI: Adding binaryOutput. binaryOutput.instance=[" + str(db['binaryOutput']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["binaryOutput"],
-                                                db["binaryOutput"]["instance"]):
-        print("Error: Failed to add binaryOutput")
-        exit()
+# Main application
+# -----------------------------------------------------------------------------
+if __name__ == "__main__":
+    # Time spent in each startup phase, printed when the main loop is entered
+    startupTimer = BACnetServerStartup.StartupTimer(startupStartTime)
+    startupTimer.mark("imports")
 
-    # BinaryValue (BV)
-    # ---------------------------------------
-    print("FYI: Adding binaryValue. binaryValue.instance=[" + str(db['binaryValue']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["binaryValue"],
-                                                db["binaryValue"]["instance"]):
-        print("Error: Failed to add binaryValue")
-        exit()
+    print("FYI: CAS BACnet Stack Python2.7 Server Example v{}".format(bacnet_server_example_python27_version))
+    print("FYI: https://github.com/chipkin/BACnetServerExamplePython2.7")
 
-    # Enable Optional Properties
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["binaryValue"],
-                                                  db["binaryValue"]["instance"],
-                                                  bacnet_propertyIdentifier["activetext"], True)
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["binaryValue"],
-                                                  db["binaryValue"]["instance"],
-                                                  bacnet_propertyIdentifier["inactivetext"], True)
-
-    # Make binaryValue PresentValue Writable
-    if not CASBACnetStack.BACnetStack_SetPropertyWritable(db["device"]["instance"], bacnet_objectType["binaryValue"],
-                                                          db["binaryValue"]["instance"],
-                                                          bacnet_propertyIdentifier["presentValue"], True):
-        print("Error: Failed to set binaryValue.presentValue to writable")
-
-    # Make binaryValue subscribable
-    CASBACnetStack.BACnetStack_SetPropertySubscribable(db["device"]["instance"], bacnet_objectType["binaryValue"],
-                                                    db["binaryValue"]["instance"],
-                                                    bacnet_propertyIdentifier["presentValue"], True)   
-
-    # MultiStateOutput (MSO)
-    # ---------------------------------------
-    print("FYI: Adding multiStateOutput. multiStateOutput.instance=[" + str(db['multiStateOutput']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["multiStateOutput"],
-                                                db["multiStateOutput"]["instance"]):
-        print("Error: Failed to add multiStateOutput")
+    # Set BACNET_WORKERS=N to spread the devices over N worker processes, each with its own CAS BACnet Stack, on the
+    # same BACnet/IP ports (see BACnetServerSharding). This process becomes their supervisor, which restarts a worker
+    # that exits (also with BACNET_WORKERS=1). The workers are forked before any thread is started and open their own
+    # sockets and files, with the shard index appended to the file names.
+    shard = None
+    if not 0 < virtualNetwork < 0xFFFF:
+        print("Error: Invalid BACNET_VIRTUAL_NETWORK. Not a network number: " + str(virtualNetwork))
         exit()
+    workerCount = int(os.environ.get("BACNET_WORKERS", "0"))
+    if workerCount > 0:
+        import BACnetServerSharding
+        ipPorts.close()
+        supervisor = BACnetServerSharding.Supervisor(workerCount, db["device"]["instance"], virtualNetwork,
+                                                     MemoryMove)
+        # Only returns in the workers
+        shard = supervisor.run()
+        ipPorts = CreatePorts()
+        print("FYI: Worker " + str(shard.index) + " of " + str(workerCount) + " pid=" + str(os.getpid()))
+        startupTimer.mark("fork")
+    fileSuffix = shard.suffix if shard is not None else ""
+
+    # Log levels and the asynchronous log sink are configured with the BACNET_LOG and BACNET_LOG_ASYNC environment
+    # variables. See BACnetServerLogging.
+    BACnetServerLogging.ConfigureFromEnvironment()
 
-    # Enable Optional Properties
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["multiStateOutput"],
-                                                  db["multiStateOutput"]["instance"],
-                                                  bacnet_propertyIdentifier["statetext"], True)
-
-    # MultiStateValue (MSV)
-    # ---------------------------------------
-    print("FYI: Adding multiStateOutput. multiStateValue.instance=[" + str(db['multiStateValue']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["multiStateValue"],
-                                                db["multiStateValue"]["instance"]):
-        print("Error: Failed to add multiStateValue")
-        exit()
-    
-    # Enable Optional Properties
-    CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["multiStateValue"],
-                                                  db["multiStateValue"]["instance"],
-                                                  bacnet_propertyIdentifier["statetext"], True)
-
-    # Make  multiStateValue PresentValue Writable
-    if not CASBACnetStack.BACnetStack_SetPropertyWritable(db["device"]["instance"],
-                                                          bacnet_objectType["multiStateValue"],
-                                                          db["multiStateValue"]["instance"],
-                                                          bacnet_propertyIdentifier["presentValue"], True):
-        print ("Error: Failed to set multiStateValue.presentValue to writable")
-
-    # Make multiStateValue subscribable
-    CASBACnetStack.BACnetStack_SetPropertySubscribable(db["device"]["instance"], bacnet_objectType["multiStateValue"],
-                                                    db["multiStateValue"]["instance"],
-                                                    bacnet_propertyIdentifier["presentValue"], True)    
-
-    # CharacterStringValue (CSV)
-    # ---------------------------------------
-    print("FYI: Adding characterstringValue. characterstringValue.instance=[" + str(
-        db['characterstringValue']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["characterstringValue"],
-                                                db["characterstringValue"]["instance"]):
-        print("Error: Failed to add characterstringValue")
-        exit()
+    # 1. Load the CAS BACnet stack functions
+    # ---------------------------------------------------------------------------
+    # Set BACNET_FAKE_STACK to a list of request rates (see BACnetServerFakeStack), or to an empty string for the
+    # default rates, to run against a stand-in that drives the callbacks instead of the CAS BACnet Stack library
+    fakeStackRates = os.environ.get("BACNET_FAKE_STACK")
+    if fakeStackRates is not None:
+        import BACnetServerFakeStack
+        print("FYI: Using the fake CAS BACnet Stack. rates=" + str(BACnetServerFakeStack.ParseRates(fakeStackRates)))
+        CASBACnetStack = BACnetServerFakeStack.FakeStack(BACnetServerFakeStack.ParseRates(fakeStackRates),
+                                                         adapter=adapter)
+    else:
+        # Load the shared library with the adapter backend, with the argument and result types of its functions
+        # declared
+        libpath = os.path.join(os.path.abspath(os.getcwd()), libname)
+        print("FYI: Libary path: ", libpath)
+        CASBACnetStack, missingFunctions = LoadCASBACnetStack(libpath)
+        if missingFunctions:
+            print("FYI: Functions not in this CAS BACnet Stack version: " + ", ".join(missingFunctions))
 
-    # IntegerValue (IV)
-    # ---------------------------------------
-    print("FYI: Adding integerValue. integerValue.instance=[" + str(db['integerValue']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["integerValue"],
-                                                db["integerValue"]["instance"]):
-        print("Error: Failed to add integerValue")
-        exit()
+    # Print the version information
+    print("FYI: CAS BACnet Stack version: " + str(CASBACnetStack.BACnetStack_GetAPIMajorVersion()) + "." +
+          str(CASBACnetStack.BACnetStack_GetAPIMinorVersion()) +
+          "." + str(CASBACnetStack.BACnetStack_GetAPIPatchVersion()) + "." +
+          str(CASBACnetStack.BACnetStack_GetAPIBuildVersion()))
+    print("FYI: CAS BACnet Stack python adapter version:" + str(casbacnetstack_adapter_version) + " backend=" +
+          adapterBackend)
+    startupTimer.mark("stack")
 
-    # LargeAnalogValue (LAV)
-    # ---------------------------------------
-    print("FYI: Adding largeAnalogValue. largeAnalogValue.instance=[" + str(db['largeAnalogValue']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["largeAnalogValue"],
-                                                db["largeAnalogValue"]["instance"]):
-        print("Error: Failed to add largeAnalogValue")
-        exit()
+    # 2. Connect the UDP resources to the BACnet ports and get network info
+    # ---------------------------------------------------------------------------
+    # A UDP port used by more than one entry is bound per interface
+    udpPortUsers = collections.Counter(port.udpPort for port in ipPorts.ports)
+    for index, port in enumerate(ipPorts.ports):
+        try:
+            port.resolve()
+        except ValueError as error:
+            print("Error: Failed to find the interface of BACnet/IP port " + port.name + ". " + str(error))
+            exit()
+
+        # The first port is the Network Port object of db. Every other port gets its own copy, with the next
+        # instance number.
+        if index == 0:
+            networkPort = db["networkPort"]
+        else:
+            networkPort = copy.deepcopy(db["networkPort"])
+            networkPort["instance"] = db["networkPort"]["instance"] + index
+            networkPort["objectName"] = db["networkPort"]["objectName"] + " " + str(index + 1)
+            networkPort["BACnetIPUDPPort"] = port.udpPort
+        port.networkPort = networkPort
+
+        # Load network information into database. The default gateway and DNS servers follow after the first I-Am,
+        # see DiscoverNetworkSettings().
+        networkPort["ipAddress"] = port.ipAddress
+        networkPort["ipSubnetMask"] = port.subnetMask
+
+        print("FYI: Connecting UDP Resource to port=[" + str(port.udpPort) + "] interface=[" +
+              str(port.interfaceName) + "]")
+        try:
+            boundTo = port.bind(udpPortUsers[port.udpPort] > 1, reusePort=shard is not None)
+        except socket.error as error:
+            print("Error: Failed to bind BACnet/IP port " + port.name + ". " + str(error))
+            exit()
+        port.socket.setblocking(False)
+        print("FYI: Bound to=[" + boundTo + "] local IP address: " + str(port.ipAddress) + " UDP receive buffer size: " +
+              str(port.ring.setReceiveBufferSize(udpSocketReceiveBufferSize)))
+        if receiveThread:
+            port.ring.start()
+    if receiveThread:
+        print("FYI: Receiving from background threads")
+
+    UpdateBroadcastAddresses()
+    for port in ipPorts.ports:
+        print("FYI: Broadcast addresses of " + port.name + ": " + ", ".join(port.broadcastAddresses))
+    # Unicast datagrams for the devices of other workers are forwarded to them, and theirs come in from them
+    if shard is not None:
+        shard.attach(ipPorts)
+    startupTimer.mark("network")
 
-    # PositiveIntegerValue (PIV)
-    # ---------------------------------------
-    print("FYI: Adding positiveIntegerValue. positiveIntegerValue.instance=[" + str(
-        db['positiveIntegerValue']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddObject(db["device"]["instance"], bacnet_objectType["positiveIntegerValue"],
-                                                db["positiveIntegerValue"]["instance"]):
-        print("Error: Failed to add positiveIntegerValue")
-        exit()
+    # 3. Setup the callbacks
+    # ---------------------------------------------------------------------------
+    print("FYI: Registering the Callback Functions with the CAS BACnet Stack")
+    RegisterCallbacks(CASBACnetStack)
+    startupTimer.mark("callbacks")
 
-    # NetworkPort (NP)
-    # ---------------------------------------
-    print("FYI: Adding networkPort. networkPort.instance=[" + str(db['networkPort']['instance']) + "]")
-    if not CASBACnetStack.BACnetStack_AddNetworkPortObject(db["device"]["instance"], db["networkPort"]["instance"],
-                                                           casbacnetstack_networkType["ipv4"],
-                                                           casbacnetstack_protocolLevel["bacnet-application"],
-                                                           casbacnetstack_network_port_lowest_protocol_level):
-        print("Error: Failed to add networkPort")
+    # 4. Setup the BACnet devices
+    # ---------------------------------------------------------------------------
+    # The example database (db) is provisioned like any other point list. See BACnetServerProvisioning for the
+    # properties enabled, made subscribable and made writable for each object type.
+    provisioningReport = BACnetServerProvisioning.ProvisioningReport()
+    pointList = BACnetServerProvisioning.FromDatabase(db)
+    # The Network Port objects of any other BACnet/IP ports belong to the device of db as well
+    for port in ipPorts.ports[1:]:
+        pointList.devices[0].append(("networkPort", port.networkPort))
+
+    # Gateway mode. Set BACNET_GATEWAY_DEVICES=N to also host N virtual devices, numbered from the device instance of
+    # db plus one. Each gets its own copy of the db objects.
+    gatewayDeviceCount = int(os.environ.get("BACNET_GATEWAY_DEVICES", "0"))
+    if gatewayDeviceCount > 0:
+        print("FYI: Adding " + str(gatewayDeviceCount) + " virtual devices")
+        for deviceInstance in range(db["device"]["instance"] + 1, db["device"]["instance"] + 1 + gatewayDeviceCount):
+            pointList.addDatabase(CreateVirtualDevice(deviceInstance))
+
+    # Set BACNET_POINT_LIST to a JSON or CSV point list to add the devices and objects it defines
+    pointListPath = os.environ.get("BACNET_POINT_LIST")
+    try:
+        if pointListPath:
+            print("FYI: Loading point list. path=[" + pointListPath + "]")
+            pointList.extend(BACnetServerProvisioning.Load(pointListPath, provisioningReport))
+        # Devices on the virtual network, of every shard
+        virtualDeviceCount = len(pointList.devices) - 1
+        # A worker only hosts the devices of its shard
+        if shard is not None:
+            pointList.devices = [objects for objects in pointList.devices if shard.owns(objects[0][1]["instance"])]
+        BACnetServerProvisioning.Validate(pointList, provisioningReport)
+        # Registers every device and object with the CAS BACnet Stack, then indexes their properties so the callbacks
+        # can find them
+        BACnetServerProvisioning.Provision(CASBACnetStack, pointList, IndexDevice, provisioningReport)
+    except (ValueError, IOError) as error:
+        # ProvisioningError is a ValueError, as are JSON syntax errors
+        print("Error: Failed to provision devices. " + str(error))
         exit()
-    if not CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["networkPort"],
-                                                         db["networkPort"]["instance"],
-                                                         bacnet_propertyIdentifier["fdbbmdaddress"], True):
-        print("Error: Failed to enable fdBbmdAddress")
-    if not CASBACnetStack.BACnetStack_SetPropertyEnabled(db["device"]["instance"], bacnet_objectType["networkPort"],
-                                                         db["networkPort"]["instance"],
-                                                         bacnet_propertyIdentifier["fdsubscriptionlifetime"], True):
-        print("Error: Failed to enable fdSubscriptionLifetime")
-    if not CASBACnetStack.BACnetStack_SetPropertyWritable(db["device"]["instance"], bacnet_objectType["networkPort"],
-                                                          db["networkPort"]["instance"],
-                                                          bacnet_propertyIdentifier["fdbbmdaddress"], True):
-        print("Error: Failed to set fdBbmdAddress to writable")
-    if not CASBACnetStack.BACnetStack_SetPropertyWritable(db["device"]["instance"], bacnet_objectType["networkPort"],
-                                                          db["networkPort"]["instance"],
-                                                          bacnet_propertyIdentifier["fdsubscriptionlifetime"], True):
-        print("Error: Failed to set fdSubscriptionLifetime to writable")
+    print("FYI: Provisioned " + provisioningReport.summary())
+    print("FYI: Objects per type: " + str(provisioningReport.objectTypes))
+    # The stack routes the requests for the virtual network to the devices on it, see virtualNetwork
+    if virtualDeviceCount > 0:
+        if getattr(CASBACnetStack, "BACnetStack_AddRoutedDevice", None) is None:
+            print("Error: This CAS BACnet Stack version does not route, the devices other than " +
+                  str(db["device"]["instance"]) + " can not be reached")
+        else:
+            print("FYI: Routing to " + str(RouteVirtualDevices(CASBACnetStack)) + " devices on virtual network " +
+                  str(virtualNetwork))
+    print("FYI: Point store: " + pointStore.summary())
+    # The values are in the point store now, so the point list records can be freed
+    del pointList
+    startupTimer.mark("provision")
+
+    # Restore the values written through BACnet before the last shutdown. Set BACNET_STATE_FILE to choose the file,
+    # or to an empty string to not keep them.
+    statePath = os.environ.get("BACNET_STATE_FILE", "BACnetServerExampleState.dat")
+    if statePath:
+        import BACnetServerPersistence
+        statePath += fileSuffix
+        startTime = time.time()
+        persistentStore = BACnetServerPersistence.PersistentStore(statePath)
+        restored = RestorePersistedValues(persistentStore.items())
+        print("FYI: Restored " + str(restored) + " values from " + statePath + " in " +
+              str(round((time.time() - startTime) * 1000.0, 3)) + " ms")
+
+    # Replay the write-ahead log of BACnet writes on top. It is committed every tick, so it has the writes the
+    # memory mapped file may not have flushed. Set BACNET_WRITE_LOG to choose the file, or to an empty string to not
+    # keep a log.
+    writeLogPath = os.environ.get("BACNET_WRITE_LOG", "BACnetServerExampleWrites.log")
+    if writeLogPath:
+        import BACnetServerWriteLog
+        writeLogPath += fileSuffix
+        startTime = time.time()
+        writeLog = BACnetServerWriteLog.WriteAheadLog(writeLogPath)
+        restored = RestorePersistedValues(writeLog.items())
+        print("FYI: Replayed " + str(writeLog.replayed) + " log records, restored " + str(restored) + " values from " +
+              writeLogPath + " in " + str(round((time.time() - startTime) * 1000.0, 3)) + " ms")
+    startupTimer.mark("restore")
 
     # 5. Send I-Am of this device
     # ---------------------------------------------------------------------------
-    print("FYI: Sending I-AM broadcast")
-    addressString = (ctypes.c_uint8 * 6)()
-    octetStringCopy(db["networkPort"]["ipAddress"], addressString, 4)
-    addressString[4] = int(db["networkPort"]["BACnetIPUDPPort"] / 256)
-    addressString[5] = db["networkPort"]["BACnetIPUDPPort"] % 256
-
-    if not CASBACnetStack.BACnetStack_SendIAm(ctypes.c_uint32(db["device"]["instance"]),
-                                              ctypes.cast(addressString, ctypes.POINTER(ctypes.c_uint8)),
-                                              ctypes.c_uint8(6), ctypes.c_uint8(casbacnetstack_networkType["ip"]),
-                                              ctypes.c_bool(True),
-                                              ctypes.c_uint16(65535), None, ctypes.c_uint8(0)):
-        print("Error: Failed to send I-Am")
+    # With several workers, by the worker that hosts it
+    if db["device"]["instance"] in devices:
+        print("FYI: Sending I-AM broadcast")
+        addressString = NewArray("uint8_t", 6)
+        octetStringCopy(db["networkPort"]["ipAddress"], addressString, 4)
+        addressString[4] = int(db["networkPort"]["BACnetIPUDPPort"] / 256)
+        addressString[5] = db["networkPort"]["BACnetIPUDPPort"] % 256
+
+        if not CASBACnetStack.BACnetStack_SendIAm(db["device"]["instance"], addressString, 6,
+                                                  casbacnetstack_networkType["ip"], True, 65535, NULL, 0):
+            print("Error: Failed to send I-Am")
+        # Tell the routers and clients on the BACnet/IP network that the virtual network is reached through this
+        # address
+        if virtualDeviceCount > 0:
+            print("FYI: Sending I-Am-Router-To-Network broadcast. network=" + str(virtualNetwork))
+            ipPorts.broadcast(RouterAnnouncement(virtualNetwork),
+                              ("255.255.255.255", db["networkPort"]["BACnetIPUDPPort"]))
+    startupTimer.mark("iam")
+
+    networkDiscovery = BACnetServerStartup.BackgroundTask(DiscoverNetworkSettings, "BACnetDiscovery")
+    networkDiscovery.start()
 
     # 6. Start the main loop
     # ---------------------------------------------------------------------------
-    print("FYI: Entering main loop...")
-    while True:
-        # Call the DLLs loop function which checks for messages and processes them.
+    # Point value changes are applied in batches. The batcher notifies the stack (BACnetStack_ValueUpdated) only
+    # about the changes that could trigger a COV notification, see BACnetServerUpdates.
+    changeBatcher = BACnetServerUpdates.ChangeBatcher(propertyIndex, CASBACnetStack.BACnetStack_ValueUpdated,
+                                                      bacnet_propertyIdentifier["presentValue"],
+                                                      bacnet_propertyIdentifier["covincrement"])
+
+    # Set BACNET_FIELD_SOURCES to start field sources (see BACnetServerFieldSources). The simulated poller updates
+    # every analog presentValue. Their values are collected by the coalescer on their own threads, and committed to
+    # the point store as one batch before every tick.
+    # Every worker runs the field sources and applies the updates for its own devices. Its UNIX domain socket sources
+    # have the shard index appended to their path, and its commands get the shard as BACNET_SHARD=index/workers.
+    fieldCoalescer = None
+    fieldSources = []
+    fieldSourcesSpec = os.environ.get("BACNET_FIELD_SOURCES", "")
+    if fieldSourcesSpec:
+        import BACnetServerFieldSources
+        fieldCoalescer = BACnetServerFieldSources.Coalescer()
+        try:
+            fieldSources = BACnetServerFieldSources.CreateSources(
+                fieldSourcesSpec,
+                [key for key in propertyIndex["real"] if key[3] == bacnet_propertyIdentifier["presentValue"]],
+                fileSuffix)
+        except ValueError as error:
+            print("Error: Invalid BACNET_FIELD_SOURCES. " + str(error))
+            exit()
+
+    def Tick():
+        if fieldCoalescer is not None:
+            fieldCoalescer.commit(changeBatcher.apply)
         CASBACnetStack.BACnetStack_Tick()
-
-        # Sleep between loops. Give some time to other application
-        time.sleep(0.1)
-
-        # Every x seconds increment the AnalogInput presentValue property by 0.1
-        if lastTimeValueWasUpdated + 1 < time.time():
-            lastTimeValueWasUpdated = time.time()
-            db["analogInput"]["presentValue"] += 0.1
-            # Notify the stack that this data point was updated so the stack can check for logic
-            # 		that may need to run on the data.  Example: check if COV (change of value) occurred.
-            if CASBACnetStack.BACnetStack_ValueUpdated is not None:
-                CASBACnetStack.BACnetStack_ValueUpdated(db["device"]["instance"], bacnet_objectType["analogInput"],
-                                                        db["analogInput"]["instance"],
-                                                        bacnet_propertyIdentifier["presentValue"])
-            print("FYI: Updating AnalogInput (0) PresentValue: ", round(db["analogInput"]["presentValue"], 1))
+        # Group commit: one fsync for every BACnet write of this tick
+        if writeLog is not None:
+            writeLog.commit()
+
+    # The event loop calls the DLLs loop function, which checks for messages and processes them, as soon as a
+    # message arrives, a field value is updated or a timer is due, and sleeps otherwise.
+    eventLoop = BACnetServerEventLoop.EventLoop(Tick)
+    if fieldCoalescer is not None:
+        eventLoop.addSocket(fieldCoalescer.wakeup.socket)
+    for port in ipPorts.ports:
+        # A receiver thread owns its socket and wakes the loop up when its ring goes from empty to non-empty
+        eventLoop.addSocket(port.readinessSocket)
+    if shard is not None:
+        eventLoop.addSocket(shard.ring.sock)
+    # Keep ticking while datagrams are waiting in a ring, even if the sockets themselves have been drained
+    eventLoop.addPendingWork(ipPorts.hasPending)
+
+    for fieldSource in fieldSources:
+        print("FYI: Starting field source " + fieldSource.name)
+        fieldSource.start(fieldCoalescer)
+
+    # Every x seconds increment the AnalogInput presentValue property by 0.1
+    # The value lives in the point store, so it is read through its property index accessor
+    analogInputKey = (db["device"]["instance"], bacnet_objectType["analogInput"], db["analogInput"]["instance"],
+                      bacnet_propertyIdentifier["presentValue"])
+    analogInputPresentValue = propertyIndex["real"].get(analogInputKey)
+
+    def UpdateAnalogInput():
+        changeBatcher.apply([analogInputKey + (analogInputPresentValue.get(False, 0) + 0.1,)])
+        print("FYI: Updating AnalogInput (0) PresentValue: ", round(analogInputPresentValue.get(False, 0), 1))
+    if analogInputPresentValue is not None:
+        eventLoop.addTimer(1.0, UpdateAnalogInput)
+
+    # Bring points with changes suppressed by the COV increment deadband up to date now and then, for COV
+    # subscriptions made since they were last forwarded
+    eventLoop.addTimer(10.0, changeBatcher.forwardSuppressed)
+
+    # The fake stack makes its requests from BACnetStack_Tick, so tick at least every millisecond, as the stack
+    # benchmark does
+    if fakeStackRates is not None:
+        eventLoop.addTimer(0.001, lambda: None)
+
+    # Fill in the DNS servers and default gateways once the background discovery has found them
+    def TakeNetworkSettings():
+        if not networkDiscovery.take():
+            eventLoop.addTimer(0.1, TakeNetworkSettings, repeat=False)
+            return
+        if networkDiscovery.error is not None:
+            print("Error: Failed to discover the DNS servers and default gateways. " + str(networkDiscovery.error))
+            return
+        ApplyNetworkSettings(*networkDiscovery.result)
+        print("FYI: Discovered the DNS servers and default gateways in " +
+              str(round(networkDiscovery.duration * 1000.0, 3)) + " ms")
+    eventLoop.addTimer(0.1, TakeNetworkSettings, repeat=False)
+
+    # Written values are in the mapped file right away, make them durable every few seconds
+    if persistentStore is not None:
+        eventLoop.addTimer(5.0, persistentStore.flush)
+
+    # Report the tick rate of the event loop, and the receive latency of the ports
+    def LogEventLoopStats():
+        logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "%s", eventLoop.stats.summary())
+        for port in ipPorts.ports:
+            logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "BACnet/IP port %s", port.summary())
+        logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "Updates: %s", changeBatcher.summary())
+        if fieldCoalescer is not None:
+            logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "Field sources: %s", fieldCoalescer.summary())
+        for fieldSource in fieldSources:
+            logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "Field source %s", fieldSource.summary())
+        if persistentStore is not None:
+            logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "Persistent store: %s", persistentStore.summary())
+        if writeLog is not None:
+            logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "Write log: %s", writeLog.summary())
+        if fakeStackRates is not None:
+            logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "Fake stack: %s", CASBACnetStack.summary())
+        if shard is not None:
+            logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "Shard: %s", shard.summary())
+        for instrument in instrumentation.report():
+            logEventLoop.log(BACnetServerLogging.LEVEL_INFO, "Callback %s", instrument.summary())
+    eventLoop.addTimer(60.0, LogEventLoopStats)
+
+    # Set BACNET_METRICS to "host:port" or "unix:<path>" to serve metrics and a health check from a background thread
+    # (see BACnetServerMetrics). The health check fails when BACnetStack_Tick has not run for
+    # BACNET_HEALTH_MAX_TICK_AGE seconds.
+    maxTickAge = float(os.environ.get("BACNET_HEALTH_MAX_TICK_AGE", "5"))
+
+    def CollectMetrics():
+        metrics = BACnetServerMetrics.MetricsText()
+        stats = eventLoop.stats
+        metrics.add("bacnet_ticks_total", stats.ticks, "BACnetStack_Tick calls", "counter")
+        metrics.add("bacnet_ticks_per_second", stats.ticksPerSecond(), "Average BACnetStack_Tick rate")
+        metrics.add("bacnet_tick_duration_seconds_sum", stats.tickTimeTotal, "Seconds spent in ticks", "counter")
+        metrics.add("bacnet_tick_duration_seconds_max", stats.tickTimeMax, "Longest tick")
+        if stats.lastTickTime:
+            metrics.add("bacnet_last_tick_age_seconds", time.time() - stats.lastTickTime,
+                        "Seconds since the last tick finished")
+        # The samples of a metric must be listed together
+        for port in ipPorts.ports:
+            metrics.add("bacnet_datagrams_received_total", port.ring.received, "Datagrams received", "counter",
+                        {"port": port.name})
+        for port in ipPorts.ports:
+            metrics.add("bacnet_bytes_received_total", port.ring.bytesReceived, "Bytes passed to the stack", "counter",
+                        {"port": port.name})
+        for port in ipPorts.ports:
+            metrics.add("bacnet_datagrams_sent_total", port.sender.sent, "Datagrams sent", "counter",
+                        {"port": port.name})
+        for port in ipPorts.ports:
+            metrics.add("bacnet_bytes_sent_total", port.sender.bytesSent, "Bytes sent", "counter", {"port": port.name})
+        for port in ipPorts.ports:
+            metrics.add("bacnet_socket_errors_total", port.ring.errors, "Socket errors", "counter",
+                        {"port": port.name, "direction": "receive"})
+            metrics.add("bacnet_socket_errors_total", port.sender.errors, None, "counter",
+                        {"port": port.name, "direction": "send"})
+        for port in ipPorts.ports:
+            metrics.add("bacnet_receive_latency_seconds_avg", port.ring.queueDelayAverage(),
+                        "Average seconds from a datagram's arrival to the stack receiving it", "gauge",
+                        {"port": port.name})
+        for port in ipPorts.ports:
+            metrics.add("bacnet_receive_latency_seconds_max", port.ring.queueDelayMax,
+                        "Longest time from a datagram's arrival to the stack receiving it", "gauge", {"port": port.name})
+        for port in ipPorts.ports:
+            metrics.add("bacnet_receive_overflows_total", port.ring.overflows,
+                        "Receive ring full with datagrams waiting", "counter", {"port": port.name})
+        for port in ipPorts.ports:
+            metrics.add("bacnet_kernel_drops_total", BACnetServerDatagrams.KernelDropCount(port.socket),
+                        "Datagrams dropped by the kernel", "counter", {"port": port.name})
+        metrics.add("bacnet_instrumentation_enabled", int(instrumentation.enabled), "Callback instrumentation on")
+        # The samples of a metric must be listed together
+        instruments = instrumentation.report()
+        for instrument in instruments:
+            metrics.add("bacnet_callback_calls_total", instrument.calls, "Callback calls", "counter",
+                        {"callback": instrument.name})
+        for instrument in instruments:
+            metrics.add("bacnet_callback_errors_total", instrument.errors, "Callback exceptions", "counter",
+                        {"callback": instrument.name})
+        for instrument in instruments:
+            metrics.add("bacnet_callback_seconds_sum", instrument.totalTime, "Seconds spent in callbacks", "counter",
+                        {"callback": instrument.name})
+        for instrument in instruments:
+            for quantile in (0.5, 0.99):
+                metrics.add("bacnet_callback_seconds", instrument.percentile(quantile),
+                            "Callback latency (upper bound of its histogram bucket)", "gauge",
+                            {"callback": instrument.name, "quantile": quantile})
+        metrics.add("bacnet_devices", len(devices), "Devices served")
+        metrics.add("bacnet_points", pointStore.pointCount() if pointStore is not None else None,
+                    "Values in the point store")
+        metrics.add("process_resident_memory_bytes", BACnetServerMetrics.ProcessResidentBytes(),
+                    "Resident memory size")
+        return metrics.text()
+
+    def CheckHealth():
+        lastTickTime = eventLoop.stats.lastTickTime
+        if not lastTickTime:
+            return False, "BACnetStack_Tick has not run yet"
+        age = time.time() - lastTickTime
+        if age > maxTickAge:
+            return False, "BACnetStack_Tick last ran %.1f seconds ago" % age
+        return True, "ok"
+
+    metricsAddress = os.environ.get("BACNET_METRICS")
+    if metricsAddress and shard is not None:
+        # Each worker serves its own metrics, on the next port or at the path with the shard index appended
+        metricsAddress = BACnetServerSharding.WorkerAddress(metricsAddress, shard.index)
+    if metricsAddress:
+        import BACnetServerMetrics
+        try:
+            metricsServer = BACnetServerMetrics.MetricsServer(metricsAddress, CollectMetrics, CheckHealth)
+        except (socket.error, ValueError) as error:
+            print("Error: Failed to start the metrics endpoint on " + metricsAddress + ". " + str(error))
+        else:
+            print("FYI: Serving metrics on " + metricsAddress)
+            metricsServer.start()
+
+    # Send SIGUSR1 to switch the callback instrumentation on or off
+    if hasattr(signal, "SIGUSR1"):
+        def ToggleInstrumentation(signalNumber, frame):
+            print("FYI: Callback instrumentation " + ("enabled" if instrumentation.toggle() else "disabled"))
+        signal.signal(signal.SIGUSR1, ToggleInstrumentation)
+
+    # Report the counters of this worker to the supervisor every second, and stop once the supervisor is gone
+    def ReportToSupervisor():
+        if shard.orphaned():
+            print("Error: The supervisor has exited. Stopping worker " + str(shard.index))
+            eventLoop.stop()
+        if fakeStackRates is not None:
+            callbacks = CASBACnetStack.callbackCount()
+        else:
+            callbacks = sum(instrument.calls for instrument in instrumentation.report())
+        shard.report(ipPorts, devices=len(devices), points=pointStore.pointCount() if pointStore is not None else 0,
+                     ticks=eventLoop.stats.ticks, callbacks=callbacks)
+    if shard is not None:
+        shard.table.update(shard.index, startTime=time.time())
+        eventLoop.addTimer(1.0, ReportToSupervisor)
+
+    startupTimer.mark("loop")
+    print("FYI: Startup phases: " + startupTimer.summary())
+    print("FYI: Entering main loop...")
+    try:
+        eventLoop.run()
+    except KeyboardInterrupt:
+        # A worker is interrupted when the supervisor stops it (see BACnetServerSharding.InterruptWorker)
+        if shard is None:
+            raise
+    finally:
+        if shard is not None:
+            ReportToSupervisor()
+        if persistentStore is not None:
+            persistentStore.close()
+        if writeLog is not None:
+            writeLog.close()
@@ -0,0 +1,312 @@
+#
+# BACnet Server Example Fake Stack
+# A stand-in for the CAS BACnet Stack library with the same BACnetStack_* functions, for benchmarking the Python side
+# of the example on machines without the licensed library.
+#
+# It does not speak BACnet. It remembers the devices and objects registered with it and, from BACnetStack_Tick,
+# calls the registered callbacks the way the CAS BACnet Stack does for a configurable rate of requests:
+#
+#     readProperty          GetProperty of the presentValue of a random object
+#     readPropertyMultiple  GetProperty of the objectName and presentValue of every object (a full scan by a client)
+#     writeProperty         SetProperty of the presentValue of a random object with a writable presentValue
+#
+# Every tick also polls CallbackReceiveMessage and CallbackGetSystemTime, and checks COV: for every point reported
+# with BACnetStack_ValueUpdated (or written) since the last tick, the presentValue is read again, as the stack does to
+# decide on a COV notification. The callbacks are called through their registered callback objects, so the argument
+# conversion of the adapter backend (ctypes, or cffi, see CASBACnetStackAdapterCffi) is part of every measurement.
+#
+# The rates are requests per second, given as "readProperty=1000,readPropertyMultiple=0.5,writeProperty=10". The
+# example uses this stack instead of the CAS BACnet Stack library when BACNET_FAKE_STACK is set to such a rate list.
+#
+
+import collections
+import random
+import time
+import timeit
+
+import CASBACnetStackAdapter
+from CASBACnetStackAdapter import *
+
+# Not a CAS BACnet Stack version, reported by BACnetStack_GetAPI*Version
+apiVersion = (0, 0, 0, 0)
+
+defaultRates = {"readProperty": 100.0, "readPropertyMultiple": 0.1, "writeProperty": 1.0}
+
+# GetProperty and SetProperty callbacks of the presentValue of each object type with a presentValue served by the
+# callbacks
+presentValueCallbacks = {
+    "analogInput": ("GetPropertyReal", "SetPropertyReal"),
+    "analogValue": ("GetPropertyReal", "SetPropertyReal"),
+    "binaryInput": ("GetPropertyEnumerated", "SetPropertyEnumerated"),
+    "binaryValue": ("GetPropertyEnumerated", "SetPropertyEnumerated"),
+    "multiStateInput": ("GetPropertyUnsignedInteger", "SetPropertyUnsignedInteger"),
+    "multiStateValue": ("GetPropertyUnsignedInteger", "SetPropertyUnsignedInteger"),
+    "characterstringValue": ("GetPropertyCharacterString", None),
+    "integerValue": ("GetPropertySignedInteger", None),
+    "largeAnalogValue": ("GetPropertyDouble", None),
+    "positiveIntegerValue": ("GetPropertyUnsignedInteger", None)}
+presentValueCallbacksByType = dict((bacnet_objectType[name], callbacks)
+                                   for name, callbacks in presentValueCallbacks.items())
+
+maxCharacterStringLength = 256
+writePriority = 8
+
+# Seconds of requests a tick makes at most. A stack asked for more requests than it can serve runs at its capacity
+# instead of falling further behind with every tick.
+maxCatchUp = 0.1
+
+
+def ParseRates(spec):
+    """Parses a "request=rate,..." list. An empty list means the default rates."""
+    rates = dict(defaultRates) if not spec.strip() else {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        name, _, rate = item.partition("=")
+        name = name.strip()
+        if name not in defaultRates:
+            raise ValueError("Unknown fake stack request: " + name)
+        rates[name] = float(rate)
+    return rates
+
+
+def Percentile(samples, fraction):
+    # samples must be sorted
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))] if samples else 0.0
+
+
+class CallbackStats(object):
+    """Call count and latency samples of one callback."""
+    __slots__ = ("calls", "failures", "samples")
+
+    def __init__(self):
+        self.calls = 0
+        # Calls that returned False or 0 (for CallbackReceiveMessage: no message waiting)
+        self.failures = 0
+        self.samples = []
+
+
+class FakeStack(object):
+    """The BACnetStack_* functions used by the example, driving the registered callbacks from BACnetStack_Tick."""
+
+    def __init__(self, rates=None, maxSamples=1000000, adapter=None):
+        # adapter: the adapter backend module the callbacks were made with, CASBACnetStackAdapter by default
+        self.adapter = CASBACnetStackAdapter if adapter is None else adapter
+        self.rates = dict(defaultRates if rates is None else rates)
+        self.maxSamples = maxSamples
+        self.callbacks = {}
+        # Registered objects: (deviceInstance, objectType, objectInstance)
+        self.objects = []
+        # Registered objects with a writable presentValue
+        self.writable = []
+        # Routed devices: (network number, MAC address) by device instance
+        self.routedDevices = {}
+        self.covPending = set()
+        self.stats = collections.defaultdict(CallbackStats)
+        self.requests = collections.defaultdict(int)
+        # Requests due but not made yet, by request, carried over between ticks
+        self.due = dict((name, 0.0) for name in defaultRates)
+        self.lastTick = None
+        self.ticks = 0
+        self.busyTime = 0.0
+        self.startTime = time.time()
+
+        # Buffers the callbacks write their values into. A single value is an array of one, passed as a pointer to it.
+        newArray = self.adapter.NewArray
+        self.real = newArray("float", 1)
+        self.double = newArray("double", 1)
+        self.uint32 = newArray("uint32_t", 1)
+        self.int32 = newArray("int32_t", 1)
+        self.length = newArray("uint32_t", 1)
+        self.encoding = newArray("uint8_t", 1)
+        self.characterString = newArray("char", maxCharacterStringLength)
+        self.message = newArray("uint8_t", 1497)
+        self.connectionString = newArray("uint8_t", 6)
+        self.connectionStringLength = newArray("uint8_t", 1)
+        self.networkType = newArray("uint8_t", 1)
+        self.errorCode = newArray("uint32_t", 1)
+
+    def __getattr__(self, name):
+        # BACnetStack_RegisterCallback<Name>(callback)
+        if name.startswith("BACnetStack_RegisterCallback"):
+            callbackName = name[len("BACnetStack_RegisterCallback"):]
+
+            def register(callback):
+                self.callbacks[callbackName] = callback
+            return register
+        raise AttributeError(name)
+
+    # Versions
+    def BACnetStack_GetAPIMajorVersion(self):
+        return apiVersion[0]
+
+    def BACnetStack_GetAPIMinorVersion(self):
+        return apiVersion[1]
+
+    def BACnetStack_GetAPIPatchVersion(self):
+        return apiVersion[2]
+
+    def BACnetStack_GetAPIBuildVersion(self):
+        return apiVersion[3]
+
+    # Provisioning
+    def BACnetStack_AddDevice(self, deviceInstance):
+        self.objects.append((deviceInstance, bacnet_objectType["device"], deviceInstance))
+        return True
+
+    def BACnetStack_AddObject(self, deviceInstance, objectType, objectInstance):
+        self.objects.append((deviceInstance, objectType, objectInstance))
+        return True
+
+    def BACnetStack_AddNetworkPortObject(self, deviceInstance, objectInstance, networkType, protocolLevel,
+                                         lowestProtocolLevel):
+        self.objects.append((deviceInstance, bacnet_objectType["networkPort"], objectInstance))
+        return True
+
+    def BACnetStack_SetServiceEnabled(self, deviceInstance, service, enabled):
+        return True
+
+    def BACnetStack_SetPropertyEnabled(self, deviceInstance, objectType, objectInstance, propertyIdentifier, enabled):
+        return True
+
+    def BACnetStack_SetPropertySubscribable(self, deviceInstance, objectType, objectInstance, propertyIdentifier,
+                                            subscribable):
+        return True
+
+    def BACnetStack_SetPropertyWritable(self, deviceInstance, objectType, objectInstance, propertyIdentifier,
+                                        writable):
+        if writable and propertyIdentifier == bacnet_propertyIdentifier["presentValue"] and \
+                presentValueCallbacksByType.get(objectType, (None, None))[1] is not None:
+            self.writable.append((deviceInstance, objectType, objectInstance))
+        return True
+
+    # Routing
+    def BACnetStack_AddRoutedDevice(self, deviceInstance, network, macAddress, macAddressLength):
+        self.routedDevices[deviceInstance] = (network, bytes(bytearray(macAddress[0:macAddressLength])))
+        return True
+
+    # Runtime
+    def BACnetStack_SendIAm(self, *args):
+        return True
+
+    def BACnetStack_ValueUpdated(self, deviceInstance, objectType, objectInstance, propertyIdentifier):
+        self.covPending.add((deviceInstance, objectType, objectInstance))
+
+    def BACnetStack_Tick(self):
+        start = time.time()
+        if self.lastTick is None:
+            # Rates and callbacks per second count from the first tick
+            self.lastTick = self.startTime = start
+        elapsed = min(start - self.lastTick, maxCatchUp)
+        self.lastTick = start
+        self.ticks += 1
+
+        self.call("GetSystemTime")
+        self.call("ReceiveMessage", self.message, len(self.message), self.connectionString,
+                  len(self.connectionString), self.connectionStringLength, self.networkType)
+        for name in ("readProperty", "readPropertyMultiple", "writeProperty"):
+            due = self.due[name] + self.rates.get(name, 0.0) * elapsed
+            count = int(due)
+            self.due[name] = due - count
+            for _ in range(count):
+                self.request(name)
+        self.checkCov()
+        self.busyTime += time.time() - start
+
+    # Requests
+    def call(self, name, *arguments):
+        # Calls a registered callback, recording its latency
+        callback = self.callbacks.get(name)
+        if callback is None:
+            return False
+        stats = self.stats[name]
+        start = timeit.default_timer()
+        result = callback(*arguments)
+        duration = timeit.default_timer() - start
+        stats.calls += 1
+        if not result:
+            stats.failures += 1
+        if len(stats.samples) < self.maxSamples:
+            stats.samples.append(duration)
+        return result
+
+    def readPresentValue(self, deviceInstance, objectType, objectInstance):
+        callbacks = presentValueCallbacksByType.get(objectType)
+        if callbacks is None:
+            return False
+        return self.readProperty(callbacks[0], deviceInstance, objectType, objectInstance,
+                                 bacnet_propertyIdentifier["presentValue"])
+
+    def readProperty(self, name, deviceInstance, objectType, objectInstance, propertyIdentifier):
+        if name == "GetPropertyCharacterString":
+            return self.call(name, deviceInstance, objectType, objectInstance, propertyIdentifier,
+                             self.characterString, self.length, maxCharacterStringLength, self.encoding, False, 0)
+        value = {"GetPropertyReal": self.real, "GetPropertyDouble": self.double,
+                 "GetPropertySignedInteger": self.int32}.get(name, self.uint32)
+        return self.call(name, deviceInstance, objectType, objectInstance, propertyIdentifier, value, False, 0)
+
+    def request(self, name):
+        """Makes one request of the given kind."""
+        self.requests[name] += 1
+        if name == "readProperty":
+            if self.objects:
+                self.readPresentValue(*random.choice(self.objects))
+        elif name == "readPropertyMultiple":
+            objectName = bacnet_propertyIdentifier["objectname"]
+            for deviceInstance, objectType, objectInstance in self.objects:
+                self.readProperty("GetPropertyCharacterString", deviceInstance, objectType, objectInstance,
+                                  objectName)
+                self.readPresentValue(deviceInstance, objectType, objectInstance)
+        elif name == "writeProperty":
+            if self.writable:
+                self.writePresentValue(*random.choice(self.writable))
+        else:
+            raise ValueError("Unknown fake stack request: " + name)
+
+    def writePresentValue(self, deviceInstance, objectType, objectInstance):
+        name = presentValueCallbacksByType[objectType][1]
+        if name == "SetPropertyReal":
+            value = random.uniform(0.0, 100.0)
+        elif name == "SetPropertyEnumerated":
+            value = random.randint(0, 1)
+        else:
+            value = random.randint(1, 3)
+        if self.call(name, deviceInstance, objectType, objectInstance, bacnet_propertyIdentifier["presentValue"],
+                     value, False, 0, writePriority, self.errorCode):
+            self.covPending.add((deviceInstance, objectType, objectInstance))
+
+    def checkCov(self):
+        if not self.covPending:
+            return
+        pending, self.covPending = self.covPending, set()
+        for deviceInstance, objectType, objectInstance in pending:
+            self.readPresentValue(deviceInstance, objectType, objectInstance)
+
+    def run(self, duration, tickInterval=0.0):
+        """Ticks for duration seconds, sleeping tickInterval seconds between ticks."""
+        end = time.time() + duration
+        while time.time() < end:
+            self.BACnetStack_Tick()
+            if tickInterval:
+                time.sleep(tickInterval)
+
+    # Reporting
+    def report(self):
+        """Returns (callback, calls, failures, p50, p99, max) tuples, latencies in seconds, busiest callback first."""
+        report = []
+        for name, stats in self.stats.items():
+            samples = sorted(stats.samples)
+            report.append((name, stats.calls, stats.failures, Percentile(samples, 0.5), Percentile(samples, 0.99),
+                           samples[-1] if samples else 0.0))
+        report.sort(key=lambda entry: entry[1], reverse=True)
+        return report
+
+    def callbackCount(self):
+        return sum(stats.calls for stats in self.stats.values())
+
+    def summary(self):
+        calls = self.callbackCount()
+        elapsed = time.time() - self.startTime
+        return "ticks=%d callbacks=%d callbacksPerSecond=%.0f busyCallbacksPerSecond=%.0f requests=%s" % (
+            self.ticks, calls, calls / elapsed if elapsed > 0 else 0.0,
+            calls / self.busyTime if self.busyTime > 0 else 0.0, dict(self.requests))
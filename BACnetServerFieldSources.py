@@ -0,0 +1,315 @@
+#
+# BACnet Server Example Field Sources
+# Feeds point values from the field into the point store. Every source runs on its own thread and puts its updates
+# into a Coalescer. The Coalescer keeps only the latest value of each point, and the event loop commits everything
+# it holds as one batch (through the ChangeBatcher) right before BACnetStack_Tick, so the stack never sees a half
+# applied set of updates and a point that changes many times between two ticks costs one store write.
+#
+# Text sources (file tail, UNIX domain socket, subprocess) use one update per line:
+#
+#     deviceInstance,objectType,objectInstance,propertyIdentifier,value[,timestamp]
+#     389001,analogInput,0,presentValue,21.5,1697040000.125
+#
+# Object types and properties are given by name or number. The timestamp (seconds since the epoch) is when the value
+# was read in the field. It defaults to the time the line was received and is used to measure the lag from the field
+# to BACnet.
+#
+# Sources are configured with the BACNET_FIELD_SOURCES environment variable, a comma separated list of:
+#     tail:<path>         Follow a file, like tail -f
+#     unix:<path>         Receive datagrams on a UNIX domain socket
+#     exec:<command>      Run a command and read its stdout. Must be last, the command is the rest of the list.
+#     simulate:<seconds>  Poll simulated Modbus style registers for every analog presentValue
+#
+
+import math
+import os
+import random
+import socket
+import threading
+import time
+
+import BACnetServerLogging
+from BACnetServerEventLoop import Wakeup
+from CASBACnetStackAdapter import *
+
+logFieldSources = BACnetServerLogging.GetCategory("FieldSources")
+
+
+class Coalescer(object):
+    """Collects updates from the source threads, keeping the latest value of each point until commit()."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.wakeup = Wakeup()
+        self.startTime = time.time()
+
+        # Counters
+        self.received = 0
+        self.coalesced = 0
+        self.commits = 0
+        self.committed = 0
+        # Seconds from the source timestamp to the value being committed to the point store
+        self.lagTotal = 0.0
+        self.lagMax = 0.0
+
+    def put(self, key, value, timestamp):
+        # key: (deviceInstance, objectType, objectInstance, propertyIdentifier)
+        with self.lock:
+            if key in self.pending:
+                self.coalesced += 1
+            self.pending[key] = (value, timestamp)
+            self.received += 1
+        self.wakeup.signal()
+
+    def putMany(self, updates):
+        # updates: (key, value, timestamp) tuples
+        with self.lock:
+            pending = self.pending
+            for key, value, timestamp in updates:
+                if key in pending:
+                    self.coalesced += 1
+                pending[key] = (value, timestamp)
+                self.received += 1
+        self.wakeup.signal()
+
+    def hasPending(self):
+        return len(self.pending) > 0
+
+    def commit(self, apply):
+        """Takes everything pending and passes it to apply() as one batch of update tuples. Called on the event loop
+        thread. Returns the number of points committed."""
+        self.wakeup.clear()
+        if not self.pending:
+            return 0
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        apply([key + (value,) for key, (value, timestamp) in pending.items()])
+
+        now = time.time()
+        for value, timestamp in pending.values():
+            lag = now - timestamp
+            self.lagTotal += lag
+            if lag > self.lagMax:
+                self.lagMax = lag
+        self.commits += 1
+        self.committed += len(pending)
+        return len(pending)
+
+    def summary(self):
+        elapsed = time.time() - self.startTime
+        return ("received=%d updatesPerSecond=%.1f coalesced=%d commits=%d committed=%d lagAvg=%.6f lagMax=%.6f" % (
+            self.received, self.received / elapsed if elapsed > 0 else 0.0, self.coalesced, self.commits,
+            self.committed, self.lagTotal / self.committed if self.committed else 0.0, self.lagMax))
+
+
+# Parsing
+# ---------------------------------------------------------------------------
+def parseEnumeration(enumeration, text):
+    return int(text) if text.isdigit() else enumeration[text]
+
+
+def parseValue(text):
+    if "." in text or "e" in text or "E" in text or "n" in text:
+        return float(text)
+    return int(text)
+
+
+def ParseLine(line, receivedTime):
+    """Parses one update line. Returns (key, value, timestamp), or None for an empty or comment line. Raises
+    ValueError or KeyError for a malformed line."""
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    fields = line.split(",")
+    if len(fields) not in (5, 6):
+        raise ValueError("Expected 5 or 6 fields: " + line)
+    key = (int(fields[0]), parseEnumeration(bacnet_objectType, fields[1].strip()), int(fields[2]),
+           parseEnumeration(bacnet_propertyIdentifier, fields[3].strip()))
+    timestamp = float(fields[5]) if len(fields) == 6 else receivedTime
+    return key, parseValue(fields[4].strip()), timestamp
+
+
+# Sources
+# ---------------------------------------------------------------------------
+class FieldSource(object):
+    """Base class of the sources. Subclasses implement run(), which reads until self.running is False."""
+
+    def __init__(self, name):
+        self.name = name
+        self.coalescer = None
+        self.running = False
+        self.thread = None
+        self.lines = 0
+        self.errors = 0
+
+    def start(self, coalescer):
+        self.coalescer = coalescer
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="BACnetFieldSource " + self.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception as error:
+            # A failing source stops, but never takes the server down
+            self.errors += 1
+            self.running = False
+            logFieldSources.log(BACnetServerLogging.LEVEL_ERROR, "Field source %s stopped: %s", self.name, error)
+
+    def putLines(self, lines):
+        receivedTime = time.time()
+        updates = []
+        for line in lines:
+            try:
+                update = ParseLine(line, receivedTime)
+            except (ValueError, KeyError, IndexError):
+                self.errors += 1
+                continue
+            if update is not None:
+                updates.append(update)
+        self.lines += len(lines)
+        if updates:
+            self.coalescer.putMany(updates)
+
+    def summary(self):
+        return "%s: lines=%d errors=%d running=%s" % (self.name, self.lines, self.errors, self.running)
+
+
+class FileTailSource(FieldSource):
+    """Follows a file, like tail -f. Starts at the end of the file and starts over when it is truncated."""
+
+    def __init__(self, path, pollInterval=0.1):
+        FieldSource.__init__(self, "tail:" + path)
+        self.path = path
+        self.pollInterval = pollInterval
+
+    def run(self):
+        with open(self.path) as tailFile:
+            tailFile.seek(0, os.SEEK_END)
+            partial = ""
+            while self.running:
+                data = tailFile.read(65536)
+                if not data:
+                    if os.path.getsize(self.path) < tailFile.tell():
+                        tailFile.seek(0)
+                        partial = ""
+                    time.sleep(self.pollInterval)
+                    continue
+                lines = (partial + data).split("\n")
+                partial = lines.pop()
+                self.putLines(lines)
+
+
+class UnixSocketSource(FieldSource):
+    """Receives datagrams of one or more update lines on a UNIX domain socket."""
+
+    def __init__(self, path):
+        FieldSource.__init__(self, "unix:" + path)
+        self.path = path
+
+    def run(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self.path)
+            sock.settimeout(0.5)
+            while self.running:
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                self.putLines(data.decode("utf-8", "replace").split("\n"))
+        finally:
+            sock.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+class SubprocessSource(FieldSource):
+    """Runs a command and reads update lines from its stdout."""
+
+    def __init__(self, command):
+        FieldSource.__init__(self, "exec:" + command)
+        self.command = command
+        self.process = None
+
+    def run(self):
+        # Imported here, it is not needed unless a command is configured and takes a while to import
+        import subprocess
+        self.process = subprocess.Popen(self.command, shell=True, stdout=subprocess.PIPE)
+        try:
+            for line in iter(self.process.stdout.readline, b""):
+                if not self.running:
+                    break
+                self.putLines([line.decode("utf-8", "replace")])
+        finally:
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+            self.running = False
+
+    def stop(self):
+        FieldSource.stop(self)
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+
+class SimulatedPollerSource(FieldSource):
+    """A local stand-in for a Modbus style poller. Every interval it reads one holding register per point, a slow
+    sine wave plus noise scaled like a 16 bit register, and reports all of them as one batch."""
+
+    def __init__(self, keys, interval=1.0):
+        FieldSource.__init__(self, "simulate:" + str(interval))
+        self.keys = list(keys)
+        self.interval = interval
+
+    def readRegister(self, index, now):
+        raw = int(32768 + 16384 * math.sin(now / 60.0 + index) + random.randint(-64, 64))
+        return raw / 1000.0
+
+    def run(self):
+        nextPoll = time.time()
+        while self.running:
+            now = time.time()
+            self.coalescer.putMany([(key, self.readRegister(index, now), now) for index, key in enumerate(self.keys)])
+            self.lines += len(self.keys)
+            nextPoll += self.interval
+            time.sleep(max(0.0, nextPoll - time.time()))
+
+
+def CreateSources(spec, simulatedKeys=(), pathSuffix=""):
+    """Creates the sources of a BACNET_FIELD_SOURCES specification. simulatedKeys are the points the simulated
+    poller reports. pathSuffix is appended to the paths of UNIX domain socket sources. Raises ValueError for an unknown
+    or malformed source."""
+    sources = []
+    while spec:
+        item, _, spec = spec.partition(",")
+        item = item.strip()
+        if not item:
+            continue
+        kind, _, argument = item.partition(":")
+        if kind == "exec" and spec:
+            # The command may contain commas
+            argument, spec = argument + "," + spec, ""
+        if kind == "tail":
+            sources.append(FileTailSource(argument))
+        elif kind == "unix":
+            sources.append(UnixSocketSource(argument + pathSuffix))
+        elif kind == "exec":
+            sources.append(SubprocessSource(argument))
+        elif kind == "simulate":
+            try:
+                interval = float(argument or 1.0)
+            except ValueError:
+                raise ValueError("Invalid field source interval: " + item)
+            sources.append(SimulatedPollerSource(simulatedKeys, interval))
+        else:
+            raise ValueError("Unknown field source: " + item)
+    return sources
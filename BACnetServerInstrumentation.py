@@ -0,0 +1,115 @@
+#
+# BACnet Server Example Instrumentation
+# Call counters and latency histograms for the CAS BACnet Stack callbacks, to find out which callbacks dominate a tick.
+#
+# Every callback is registered through Instrumentation.wrap(). While instrumentation is disabled the wrapper costs one
+# attribute check and the extra Python call, so it can stay in place in production and be switched on at runtime
+# (see BACnetServerExample: BACNET_INSTRUMENT=1 at startup, SIGUSR1 to toggle).
+#
+# For every callback it keeps:
+# - calls, errors (exceptions raised) and falseResults (False or 0 returned: property not served, no message waiting)
+# - a latency histogram with power of two buckets: bucket n counts the calls that took less than 2**n ns and at
+#   least 2**(n-1) ns, found with a single int.bit_length()
+# - for the GetProperty and SetProperty callbacks, calls by (objectType, propertyIdentifier)
+#
+
+import timeit
+
+from CASBACnetStackAdapter import *
+
+histogramBuckets = 64
+propertyCallbackPrefixes = ("CallbackGetProperty", "CallbackSetProperty")
+
+
+class CallbackInstrument(object):
+    """Counters and latency histogram of one callback."""
+    __slots__ = ("name", "calls", "errors", "falseResults", "totalTime", "histogram", "byProperty")
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.errors = 0
+        self.falseResults = 0
+        self.totalTime = 0.0
+        self.histogram = [0] * histogramBuckets
+        self.byProperty = {}
+
+    def record(self, duration, result, propertyKey):
+        self.calls += 1
+        self.totalTime += duration
+        if not result:
+            self.falseResults += 1
+        self.histogram[min(histogramBuckets - 1, int(duration * 1e9).bit_length())] += 1
+        if propertyKey is not None:
+            byProperty = self.byProperty
+            byProperty[propertyKey] = byProperty.get(propertyKey, 0) + 1
+
+    def percentile(self, fraction):
+        # Upper bound of the histogram bucket of the given fraction of the calls, in seconds
+        threshold = fraction * self.calls
+        count = 0
+        for bucket, bucketCount in enumerate(self.histogram):
+            count += bucketCount
+            if count >= threshold and count > 0:
+                return (1 << bucket) / 1e9
+        return 0.0
+
+    def topProperties(self, count=5):
+        # The (objectType, propertyIdentifier) pairs with the most calls, by name
+        top = sorted(self.byProperty.items(), key=lambda item: item[1], reverse=True)[:count]
+        return [("%s.%s" % (bacnet_objectType.name(objectType, objectType),
+                             bacnet_propertyIdentifier.name(propertyIdentifier, propertyIdentifier)), calls)
+                for (objectType, propertyIdentifier), calls in top]
+
+    def summary(self):
+        return "%s calls=%d errors=%d falseResults=%d avg=%.1fus p50<%.1fus p99<%.1fus time=%.3fs top=%s" % (
+            self.name, self.calls, self.errors, self.falseResults,
+            self.totalTime * 1e6 / self.calls if self.calls else 0.0, self.percentile(0.5) * 1e6,
+            self.percentile(0.99) * 1e6, self.totalTime,
+            " ".join("%s=%d" % entry for entry in self.topProperties()))
+
+
+class Instrumentation(object):
+    """Wraps callback functions with counters. Switch it on and off with the enabled attribute."""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.instruments = {}
+
+    def wrap(self, function, name=None):
+        """Returns function wrapped with a CallbackInstrument, to be passed to the CFUNCTYPE prototype."""
+        name = function.__name__ if name is None else name
+        instrument = self.instruments[name] = CallbackInstrument(name)
+        propertyCallback = name.startswith(propertyCallbackPrefixes)
+        timer = timeit.default_timer
+
+        def instrumented(*args):
+            if not self.enabled:
+                return function(*args)
+            start = timer()
+            try:
+                result = function(*args)
+            except Exception:
+                instrument.errors += 1
+                raise
+            # args[1] is the objectType and args[3] the propertyIdentifier of the property callbacks
+            instrument.record(timer() - start, result, args[1:4:2] if propertyCallback else None)
+            return result
+        instrumented.__name__ = name
+        return instrumented
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        return self.enabled
+
+    def reset(self):
+        for instrument in self.instruments.values():
+            instrument.reset()
+
+    def report(self):
+        """The instruments that were called, the one with the most time spent first."""
+        return sorted((instrument for instrument in self.instruments.values() if instrument.calls),
+                      key=lambda instrument: instrument.totalTime, reverse=True)
@@ -0,0 +1,304 @@
+#
+# BACnet Server Example Interfaces
+# One BACnet/IP port (UDP socket, receive ring and Network Port object) per configured interface and UDP port, so a
+# device can serve several subnets, or several UDP ports of one subnet, from a single event loop.
+#
+# The ports are configured with BACNET_INTERFACES, a comma separated list of interface[:udpPort] entries. An
+# interface is given by name ("eth1") or by IPv4 address ("192.168.5.10"), an empty interface means the default one
+# (the interface of the default gateway). Without an entry the default UDP port (the BACnetIPUDPPort of the example
+# database) is used:
+#
+#     BACNET_INTERFACES="eth0,eth1:47809,192.168.5.10:47810"
+#
+# Interface aliases with a ":" in their name must be given by their IP address.
+#
+# Replies are sent from the port whose subnet holds the peer, so a client always sees the answer coming from the
+# address it sent its request to. Peers on no local subnet (routed, or through a BBMD) are answered from the port
+# they were last received on, and from the first port otherwise. Broadcasts are sent out of every port, to the
+# directed broadcast address of its own subnet.
+#
+# A UDP port used by only one entry is bound to all addresses, as before. A UDP port shared by several entries is
+# bound to each interface with SO_BINDTODEVICE (Linux, needs CAP_NET_RAW), or to the interface address where that is
+# not available. A socket bound to an address does not receive the broadcasts of its subnet on Linux.
+#
+# netifaces is imported on first use, so importing this module (e.g. from the benchmarks) does not need it.
+#
+
+import socket
+import struct
+
+import BACnetServerDatagrams
+
+# Not defined by the socket module of Python 2.7
+soBindToDevice = getattr(socket, "SO_BINDTODEVICE", 25)
+soReusePort = getattr(socket, "SO_REUSEPORT", 15)
+
+ipv4Struct = struct.Struct("!I")
+
+# Routes (peer IP address to port) kept before the route cache starts over
+maxRoutes = 4096
+
+
+def ParseInterfaces(spec, defaultUdpPort):
+    """Parses a BACNET_INTERFACES list into (interface, udpPort) pairs, interface None for the default interface. An
+    empty list means the default interface on the default UDP port."""
+    entries = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        interface, separator, udpPort = item.rpartition(":")
+        if not separator:
+            interface, udpPort = item, ""
+        try:
+            udpPort = int(udpPort) if udpPort.strip() else defaultUdpPort
+        except ValueError:
+            raise ValueError("Invalid UDP port in interface entry: " + item)
+        if not 0 < udpPort < 65536:
+            raise ValueError("Invalid UDP port in interface entry: " + item)
+        entry = (interface.strip() or None, udpPort)
+        if entry in entries:
+            raise ValueError("Duplicate interface entry: " + item)
+        entries.append(entry)
+    return entries or [(None, defaultUdpPort)]
+
+
+def Octets(address):
+    return [int(octet) for octet in address.split(".")]
+
+
+def OctetsToInt(octets):
+    return ipv4Struct.unpack(bytes(bytearray(octets)))[0]
+
+
+def ResolveInterface(interface):
+    """Returns (name, ipAddress, subnetMask) of an interface given by name or IPv4 address, or of the default
+    interface (the interface of the default gateway) for None. The addresses are 4 octet lists. Raises ValueError if
+    there is no such interface or it has no IPv4 address."""
+    import netifaces
+    names = netifaces.interfaces()
+    address = None
+    if interface is None:
+        default = netifaces.gateways().get("default", {}).get(netifaces.AF_INET)
+        if default is not None:
+            name = default[1]
+        else:
+            # No default route. The first interface with an IPv4 address, other than the loopback interface if
+            # there is another one.
+            candidates = [name for name in names if netifaces.ifaddresses(name).get(netifaces.AF_INET)]
+            if not candidates:
+                raise ValueError("No interface with an IPv4 address")
+            nonLoopback = [name for name in candidates
+                           if not netifaces.ifaddresses(name)[netifaces.AF_INET][0]["addr"].startswith("127.")]
+            name = (nonLoopback or candidates)[0]
+    elif interface in names:
+        name = interface
+    else:
+        # An IPv4 address of one of the interfaces
+        name = None
+        for candidate in names:
+            for candidateAddress in netifaces.ifaddresses(candidate).get(netifaces.AF_INET, []):
+                if candidateAddress.get("addr") == interface:
+                    name, address = candidate, candidateAddress
+                    break
+            if name is not None:
+                break
+        if name is None:
+            raise ValueError("No interface with the name or IPv4 address " + interface)
+
+    if address is None:
+        addresses = netifaces.ifaddresses(name).get(netifaces.AF_INET)
+        if not addresses:
+            raise ValueError("Interface " + name + " has no IPv4 address")
+        address = addresses[0]
+    return name, Octets(address["addr"]), Octets(address.get("netmask") or "255.255.255.255")
+
+
+def DefaultGateways():
+    """Returns the IPv4 default gateway of every interface that has one, as 4 octet lists by interface name."""
+    import netifaces
+    gateways = {}
+    for gateway in netifaces.gateways().get(netifaces.AF_INET, []):
+        if gateway[1] not in gateways:
+            gateways[gateway[1]] = Octets(gateway[0])
+    return gateways
+
+
+class BACnetIPPort(object):
+    """The socket, receive ring and sender of one BACnet/IP port, with the subnet it serves."""
+
+    def __init__(self, interface, udpPort, threaded=False, memmove=None):
+        # interface: name or IPv4 address, None for the default interface
+        self.interface = interface
+        self.udpPort = udpPort
+        self.name = "%s:%d" % (interface or "default", udpPort)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        # Every pending datagram is drained off the socket into this ring of preallocated buffers, and moved from there
+        # into the CAS BACnet Stack buffer with a single memmove (the MemoryMove of the adapter backend). A
+        # ThreadedReceiver fills it from its own thread.
+        self.threaded = threaded
+        if threaded:
+            self.ring = BACnetServerDatagrams.ThreadedReceiver(self.socket, memmove=memmove)
+        else:
+            self.ring = BACnetServerDatagrams.DatagramRing(self.socket, memmove=memmove)
+        # Measure the delay from a datagram's arrival to the stack receiving it
+        BACnetServerDatagrams.EnableArrivalTimes(self.socket)
+        self.ring.timestamping = True
+        self.sender = BACnetServerDatagrams.DatagramSender(self.socket)
+
+        # Set by resolve()
+        self.interfaceName = None
+        self.ipAddress = [0, 0, 0, 0]
+        self.subnetMask = [0, 0, 0, 0]
+        self.network = 0
+        self.mask = 0
+        # The Network Port object record of this port
+        self.networkPort = None
+        self.broadcastAddresses = []
+        self.broadcastDestinations = []
+
+    @property
+    def readinessSocket(self):
+        # The socket the event loop waits on for datagrams of this port
+        return self.ring.wakeupSocket if self.threaded else self.socket
+
+    def resolve(self):
+        """Looks up the address of the interface. Raises ValueError if it does not exist."""
+        self.interfaceName, ipAddress, subnetMask = ResolveInterface(self.interface)
+        self.setAddress(ipAddress, subnetMask)
+
+    def setAddress(self, ipAddress, subnetMask, extraBroadcastAddresses=()):
+        """Sets the subnet served by this port and recomputes its broadcast addresses: the directed broadcast address
+        of the subnet, then the extra addresses."""
+        self.ipAddress = list(ipAddress)
+        self.subnetMask = list(subnetMask)
+        self.mask = OctetsToInt(self.subnetMask)
+        self.network = OctetsToInt(self.ipAddress) & self.mask
+        addresses = [BACnetServerDatagrams.DirectedBroadcastAddress(self.ipAddress, self.subnetMask)]
+        for address in extraBroadcastAddresses:
+            if address not in addresses:
+                addresses.append(address)
+        self.broadcastAddresses = addresses
+        self.broadcastDestinations = [(address, self.udpPort) for address in addresses]
+
+    def bind(self, shared=False, reusePort=False):
+        # shared: another port uses the same UDP port, so this socket must only get the datagrams of its interface.
+        # reusePort: other processes bind the same address and port (see BACnetServerSharding).
+        if reusePort:
+            self.socket.setsockopt(socket.SOL_SOCKET, soReusePort, 1)
+        if not shared:
+            self.socket.bind(("", self.udpPort))
+            return "*"
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.socket.setsockopt(socket.SOL_SOCKET, soBindToDevice, self.interfaceName.encode("ascii") + b"\0")
+        except (socket.error, AttributeError):
+            # Not Linux, or not allowed
+            address = ".".join(str(octet) for octet in self.ipAddress)
+            self.socket.bind((address, self.udpPort))
+            return address
+        self.socket.bind(("", self.udpPort))
+        return self.interfaceName
+
+    def close(self):
+        self.socket.close()
+        if self.threaded:
+            for wakeup in (self.ring.wakeup, self.ring.space):
+                wakeup.socket.close()
+                wakeup.writer.close()
+
+    def contains(self, ipAddress):
+        # ipAddress as an int
+        return ipAddress & self.mask == self.network
+
+    def summary(self):
+        return "%s ip=%s mask=%s %s %s" % (self.name, ".".join(str(octet) for octet in self.ipAddress),
+                                          ".".join(str(octet) for octet in self.subnetMask), self.ring.summary(),
+                                          self.sender.summary())
+
+
+class PortSet(object):
+    """Receives from and sends through a list of BACnetIPPorts, choosing the port for each peer."""
+
+    def __init__(self, ports):
+        self.ports = list(ports)
+        # The rings the datagrams passed to the stack are taken from: the ring of every port, and any added
+        self.rings = [port.ring for port in self.ports]
+        self.next = 0
+        # Peer IP address to the port whose subnet holds it, None for peers on no local subnet
+        self.routes = {}
+
+    def receive(self, message, maxMessageLength, connectionString):
+        # Called from CallbackReceiveMessage. Takes one datagram from the rings in turn, so a busy port does not
+        # starve the others.
+        rings = self.rings
+        count = len(rings)
+        for offset in range(count):
+            index = (self.next + offset) % count
+            length = rings[index].receive(message, maxMessageLength, connectionString)
+            if length:
+                self.next = (index + 1) % count
+                return length
+        return 0
+
+    def hasPending(self):
+        for ring in self.rings:
+            if ring.count > 0:
+                return True
+        return False
+
+    def addRing(self, ring):
+        # A ring of datagrams that did not come in through a port of this set
+        self.rings.append(ring)
+
+    def close(self):
+        for port in self.ports:
+            port.close()
+
+    def local(self, ipAddress):
+        """The port whose subnet holds a peer IP address (dotted string), None for a peer on no local subnet."""
+        try:
+            return self.routes[ipAddress]
+        except KeyError:
+            pass
+        port = None
+        ipValue = ipv4Struct.unpack(socket.inet_aton(ipAddress))[0]
+        for candidate in self.ports:
+            # The most specific subnet wins
+            if candidate.contains(ipValue) and (port is None or candidate.mask > port.mask):
+                port = candidate
+        if len(self.routes) >= maxRoutes:
+            self.routes.clear()
+        self.routes[ipAddress] = port
+        return port
+
+    def route(self, destination):
+        """The port to send to an (ip, port) destination from."""
+        ports = self.ports
+        if len(ports) == 1:
+            return ports[0]
+        port = self.local(destination[0])
+        if port is not None:
+            return port
+        # Not on a local subnet. The port the peer's datagrams came in on, if any.
+        for candidate in ports:
+            if destination in candidate.ring.peerCache:
+                return candidate
+        return ports[0]
+
+    def clearRoutes(self):
+        # Call when the address of a port changes
+        self.routes.clear()
+
+    def send(self, data, destination):
+        return self.route(destination).sender.send(data, destination)
+
+    def broadcast(self, data, destination):
+        # Sends a broadcast out of every port to the broadcast addresses of its subnet. destination is the address the
+        # stack asked for, used by a port that has no address yet. Returns the number of bytes sent by the last port
+        # that succeeded.
+        result = 0
+        for port in self.ports:
+            result = port.sender.broadcast(data, port.broadcastDestinations or [destination]) or result
+        return result
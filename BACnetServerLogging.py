@@ -0,0 +1,196 @@
+#
+# BACnet Server Example Logging
+# Leveled logging for the CAS BACnet Stack callbacks. Every callback logs to its own category, and every category
+# keeps one precomputed flag per level, so a disabled log line costs a single attribute check:
+#
+#     if logGetPropertyReal.trace:
+#         logGetPropertyReal.log(LEVEL_TRACE, "device=%s object=%s:%s", deviceInstance, objectType, objectInstance)
+#
+# Messages are only formatted by the sink. The AsyncSink formats and writes them from a background thread so a slow
+# stdout pipe never blocks the BACnetStack_Tick loop.
+#
+# Levels can be configured with the BACNET_LOG environment variable, a comma separated list of a default level and
+# category=level pairs. Example: BACNET_LOG="info,CallbackReceiveMessage=trace,CallbackSendMessage=debug"
+# Set BACNET_LOG_ASYNC=1 to write from a background thread.
+#
+
+import os
+import sys
+import threading
+import time
+
+try:
+    import queue  # Python 3
+except ImportError:
+    import Queue as queue  # Python 2
+
+# Levels
+# ---------------------------------------------------------------------------
+LEVEL_ERROR = 40
+LEVEL_WARNING = 30
+LEVEL_INFO = 20
+LEVEL_DEBUG = 10
+LEVEL_TRACE = 5
+
+levelNames = {LEVEL_ERROR: "ERROR", LEVEL_WARNING: "WARNING", LEVEL_INFO: "INFO", LEVEL_DEBUG: "DEBUG",
+              LEVEL_TRACE: "TRACE"}
+levelValues = dict((name.lower(), level) for level, name in levelNames.items())
+
+
+def formatRecord(timestamp, level, category, message, args):
+    if args:
+        try:
+            message = message % args
+        except (TypeError, ValueError):
+            message = message + " " + repr(args)
+    return "%.3f %s %s: %s\n" % (timestamp, levelNames.get(level, level), category, message)
+
+
+# Sinks
+# ---------------------------------------------------------------------------
+class StreamSink(object):
+    """Formats and writes log records to a stream (stdout by default) on the calling thread."""
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def write(self, timestamp, level, category, message, args):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(formatRecord(timestamp, level, category, message, args))
+
+    def flush(self):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.flush()
+
+    def close(self):
+        self.flush()
+
+
+class AsyncSink(object):
+    """Queues log records and writes them to another sink from a background thread. Records are dropped, and
+    counted, when the queue is full rather than blocking the caller."""
+
+    def __init__(self, target=None, maxQueueSize=10000):
+        self.target = target if target is not None else StreamSink()
+        self.queue = queue.Queue(maxQueueSize)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run, name="BACnetServerLogging")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, timestamp, level, category, message, args):
+        try:
+            self.queue.put_nowait((timestamp, level, category, message, args))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            try:
+                self.target.write(*record)
+                if self.queue.empty():
+                    self.target.flush()
+            except Exception:
+                # Never let a failing sink kill the logging thread
+                pass
+
+    def flush(self):
+        # Best effort, wait for the background thread to catch up
+        while not self.queue.empty() and self.thread.is_alive():
+            time.sleep(0.001)
+        self.target.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.target.close()
+
+
+# Categories
+# ---------------------------------------------------------------------------
+class LogCategory(object):
+    """A named log category. The error/warning/info/debug/trace flags are recomputed whenever the level changes."""
+    __slots__ = ("name", "level", "error", "warning", "info", "debug", "trace")
+
+    def __init__(self, name, level):
+        self.name = name
+        self.setLevel(level)
+
+    def setLevel(self, level):
+        self.level = level
+        self.error = level <= LEVEL_ERROR
+        self.warning = level <= LEVEL_WARNING
+        self.info = level <= LEVEL_INFO
+        self.debug = level <= LEVEL_DEBUG
+        self.trace = level <= LEVEL_TRACE
+
+    def log(self, level, message, *args):
+        if level >= self.level:
+            sink.write(time.time(), level, self.name, message, args)
+
+
+defaultLevel = LEVEL_INFO
+categories = {}
+categoryLevels = {}
+sink = StreamSink()
+
+
+def GetCategory(name):
+    category = categories.get(name)
+    if category is None:
+        category = categories[name] = LogCategory(name, categoryLevels.get(name, defaultLevel))
+    return category
+
+
+def SetLevel(level, name=None):
+    # Sets the level of one category, or the default level of every category without its own level.
+    global defaultLevel
+    if name is not None:
+        categoryLevels[name] = level
+        GetCategory(name).setLevel(level)
+        return
+    defaultLevel = level
+    for categoryName, category in categories.items():
+        if categoryName not in categoryLevels:
+            category.setLevel(level)
+
+
+def SetSink(newSink):
+    global sink
+    oldSink = sink
+    sink = newSink
+    return oldSink
+
+
+def EnableAsyncSink(maxQueueSize=10000):
+    if not isinstance(sink, AsyncSink):
+        SetSink(AsyncSink(sink, maxQueueSize))
+    return sink
+
+
+def Configure(spec):
+    # spec: "level,category=level,..." Unknown levels are ignored.
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "=" in item:
+            name, levelName = item.split("=", 1)
+            level = levelValues.get(levelName.strip().lower())
+            if level is not None:
+                SetLevel(level, name.strip())
+        else:
+            level = levelValues.get(item.lower())
+            if level is not None:
+                SetLevel(level)
+
+
+def ConfigureFromEnvironment(environ=None):
+    environ = os.environ if environ is None else environ
+    if environ.get("BACNET_LOG"):
+        Configure(environ["BACNET_LOG"])
+    if environ.get("BACNET_LOG_ASYNC", "0") not in ("", "0"):
+        EnableAsyncSink()
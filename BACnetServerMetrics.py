@@ -0,0 +1,155 @@
+#
+# BACnet Server Example Metrics
+# A small metrics and health endpoint for running the example as a daemon, served from its own thread.
+#
+# The endpoint listens on a local TCP port ("127.0.0.1:9108") or a UNIX domain socket ("unix:/run/bacnet.sock") and
+# answers one request per connection:
+#
+#     GET /metrics   the metrics in the Prometheus text format
+#     GET /health    200 "ok", or 503 with the reason when the server is not healthy (e.g. no recent tick)
+#
+# Plain "metrics" or "health" lines (e.g. from "echo health | nc -U /run/bacnet.sock") are answered without HTTP
+# headers.
+#
+# The metrics are collected by a function given to the MetricsServer, called on the metrics thread. It only reads
+# counters that the event loop thread keeps anyway, so serving a scrape takes no time from the tick loop.
+#
+
+import os
+import socket
+import threading
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+maxRequestSize = 4096
+requestTimeout = 2.0
+
+
+def ProcessResidentBytes():
+    """Resident set size of this process in bytes, or None if it is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    if resource is not None:
+        # Peak, not current, resident size: kilobytes on Linux, bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+class MetricsText(object):
+    """Builds a Prometheus text format page."""
+
+    def __init__(self):
+        self.lines = []
+        self.described = set()
+
+    def add(self, name, value, description=None, metricType="gauge", labels=None):
+        # Values of None (not available) are left out
+        if value is None:
+            return
+        if name not in self.described:
+            self.described.add(name)
+            if description is not None:
+                self.lines.append("# HELP %s %s" % (name, description))
+            self.lines.append("# TYPE %s %s" % (name, metricType))
+        if labels:
+            name = "%s{%s}" % (name, ",".join('%s="%s"' % (key, str(labelValue).replace('"', '\\"'))
+                                              for key, labelValue in sorted(labels.items())))
+        self.lines.append("%s %s" % (name, repr(float(value)) if isinstance(value, float) else value))
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class MetricsServer(object):
+    """Serves collect() at /metrics and healthCheck() at /health from a background thread. collect() returns the
+    metrics text, healthCheck() returns (healthy, reason)."""
+
+    def __init__(self, address, collect, healthCheck):
+        self.address = address
+        self.collect = collect
+        self.healthCheck = healthCheck
+        self.running = False
+        self.thread = None
+        self.requests = 0
+        self.errors = 0
+
+        if address.startswith("unix:"):
+            self.path = address[len("unix:"):]
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.bind(self.path)
+        else:
+            self.path = None
+            host, _, port = address.rpartition(":")
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host or "127.0.0.1", int(port)))
+        self.sock.listen(8)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name="BACnetMetrics")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        # Wakes up now and then to notice stop()
+        self.sock.settimeout(0.5)
+        try:
+            while self.running:
+                try:
+                    connection, _ = self.sock.accept()
+                except socket.timeout:
+                    continue
+                try:
+                    connection.settimeout(requestTimeout)
+                    self.serve(connection)
+                except Exception:
+                    # A broken scrape never takes the server down
+                    self.errors += 1
+                finally:
+                    connection.close()
+        finally:
+            self.sock.close()
+            if self.path is not None and os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def serve(self, connection):
+        request = b""
+        while b"\n" not in request and len(request) < maxRequestSize:
+            data = connection.recv(maxRequestSize)
+            if not data:
+                break
+            request += data
+        line = request.split(b"\n", 1)[0].decode("latin-1").strip()
+        fields = line.split()
+        http = len(fields) >= 2 and fields[0] in ("GET", "HEAD")
+        path = (fields[1] if http else line).strip("/").split("?")[0]
+        self.requests += 1
+
+        if path == "metrics":
+            status, body = "200 OK", self.collect()
+        elif path == "health":
+            healthy, reason = self.healthCheck()
+            status, body = ("200 OK", "ok\n") if healthy else ("503 Service Unavailable", reason + "\n")
+        else:
+            status, body = "404 Not Found", "Not found. Use /metrics or /health.\n"
+
+        body = body.encode("utf-8")
+        if http:
+            header = ("HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n" % (status, len(body)))
+            connection.sendall(header.encode("latin-1") + (body if fields[0] == "GET" else b""))
+        else:
+            connection.sendall(body)
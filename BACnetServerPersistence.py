@@ -0,0 +1,149 @@
+#
+# BACnet Server Example Persistence
+# Keeps the values written through BACnet (WriteProperty) in a memory mapped file, so they survive a restart.
+#
+# The file is a small header followed by fixed size records, one per written property. Writing a value packs it
+# straight into its record in the mapped file, which is about one memory store. Durability comes from flush() (msync),
+# which the example calls from a timer, on ReinitializeDevice and on exit. At startup the file is mapped again and the
+# records are read with struct.unpack_from, there is nothing to parse.
+#
+# Record layout (32 bytes, little endian):
+#     uint8  dataType (0 = unused), pad, uint16 objectType, uint32 deviceInstance, uint32 objectInstance,
+#     uint32 propertyIdentifier, 16 byte value
+#
+
+import mmap
+import os
+import struct
+
+fileMagic = b"BACS"
+fileVersion = 1
+
+# magic, version, record size, record count
+headerStruct = struct.Struct("<4sHHI")
+headerSize = 16
+recordStruct = struct.Struct("<BxHIII")
+recordSize = 32
+valueOffset = recordStruct.size
+
+# Data type codes stored in the records and how their values are packed
+dataTypeCodes = {
+    "real": 1,
+    "double": 2,
+    "enumerated": 3,
+    "unsignedInteger": 4,
+    "signedInteger": 5,
+    "bool": 6,
+    "octetString": 7}
+dataTypeNames = dict((code, name) for name, code in dataTypeCodes.items())
+valueStructs = {
+    "real": struct.Struct("<d"),
+    "double": struct.Struct("<d"),
+    "enumerated": struct.Struct("<Q"),
+    "unsignedInteger": struct.Struct("<Q"),
+    "signedInteger": struct.Struct("<q"),
+    "bool": struct.Struct("<Q"),
+    # Length followed by up to 15 octets (IP addresses, ...)
+    "octetString": struct.Struct("<B15s")}
+maxOctetStringLength = 15
+
+
+def PackValue(buffer, offset, dataType, value):
+    # Packs a value of a property index data type into 16 bytes of a buffer
+    if dataType == "octetString":
+        octets = bytes(bytearray(value[:maxOctetStringLength]))
+        valueStructs[dataType].pack_into(buffer, offset, len(octets), octets)
+    else:
+        valueStructs[dataType].pack_into(buffer, offset, value)
+
+
+def UnpackValue(buffer, offset, dataType):
+    if dataType == "octetString":
+        length, octets = valueStructs[dataType].unpack_from(buffer, offset)
+        return list(bytearray(octets[:length]))
+    return valueStructs[dataType].unpack_from(buffer, offset)[0]
+
+
+class PersistentStore(object):
+    """Fixed size records in a memory mapped file, one per (dataType, key). The key is the property index key
+    (deviceInstance, objectType, objectInstance, propertyIdentifier)."""
+
+    def __init__(self, path, capacity=1024):
+        self.path = path
+        self.offsets = {}
+        self.count = 0
+        self.writes = 0
+        self.flushes = 0
+        self.dirty = False
+
+        exists = os.path.exists(path) and os.path.getsize(path) >= headerSize
+        self.file = open(path, "r+b" if exists else "w+b")
+        if exists:
+            capacity = max(capacity, (os.path.getsize(path) - headerSize) // recordSize)
+        self.map = None
+        self.capacity = 0
+        self.resize(capacity)
+
+        magic, version, size, count = headerStruct.unpack_from(self.map, 0)
+        if exists and magic == fileMagic and version == fileVersion and size == recordSize:
+            self.count = min(count, self.capacity)
+            for index in range(self.count):
+                offset = headerSize + index * recordSize
+                dataTypeCode, objectType, deviceInstance, objectInstance, propertyIdentifier = \
+                    recordStruct.unpack_from(self.map, offset)
+                if dataTypeCode in dataTypeNames:
+                    self.offsets[(dataTypeNames[dataTypeCode],
+                                  (deviceInstance, objectType, objectInstance, propertyIdentifier))] = offset
+        else:
+            # New, or not a file this version can read. Start over.
+            self.map[0:headerSize] = b"\x00" * headerSize
+            headerStruct.pack_into(self.map, 0, fileMagic, fileVersion, recordSize, 0)
+
+    def resize(self, capacity):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.file.truncate(headerSize + capacity * recordSize)
+        self.map = mmap.mmap(self.file.fileno(), headerSize + capacity * recordSize)
+        self.capacity = capacity
+
+    def allocate(self, dataType, key):
+        if self.count == self.capacity:
+            self.resize(self.capacity * 2)
+        offset = headerSize + self.count * recordSize
+        recordStruct.pack_into(self.map, offset, dataTypeCodes[dataType], key[1], key[0], key[2], key[3])
+        self.count += 1
+        headerStruct.pack_into(self.map, 0, fileMagic, fileVersion, recordSize, self.count)
+        self.offsets[(dataType, key)] = offset
+        return offset
+
+    def write(self, dataType, key, value):
+        offset = self.offsets.get((dataType, key))
+        if offset is None:
+            offset = self.allocate(dataType, key)
+        PackValue(self.map, offset + valueOffset, dataType, value)
+        self.writes += 1
+        self.dirty = True
+
+    def read(self, dataType, offset):
+        return UnpackValue(self.map, offset + valueOffset, dataType)
+
+    def items(self):
+        # Yields (dataType, key, value) for every stored value
+        for (dataType, key), offset in self.offsets.items():
+            yield dataType, key, self.read(dataType, offset)
+
+    def flush(self):
+        if self.dirty:
+            self.map.flush()
+            self.dirty = False
+            self.flushes += 1
+
+    def close(self):
+        self.flush()
+        self.map.close()
+        self.file.close()
+
+    def summary(self):
+        return "path=%s values=%d capacity=%d writes=%d flushes=%d" % (
+            self.path, self.count, self.capacity, self.writes, self.flushes)
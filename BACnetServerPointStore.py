@@ -0,0 +1,107 @@
+#
+# BACnet Server Example Point Store
+# Columnar storage for point values. Instead of one dict per object with a boxed Python float or int per property,
+# every value kind has one typed array (float32 for CallbackGetPropertyReal, double for CallbackGetPropertyDouble,
+# uint32 for enumerated and unsigned values, ...) and each value is addressed by a dense slot index into its column.
+#
+# Values that are rarely read and never change (object names, state texts, ...) are kept in PointMetadata records,
+# which use __slots__ instead of a per-object dict.
+#
+# The property index refers to a stored value through a ColumnAccessor, so the callbacks read a value with a single
+# array access.
+#
+
+import array
+import sys
+
+
+def uint32TypeCode():
+    # 'I' is 4 bytes on every common platform, but the C standard only promises 2
+    return "I" if array.array("I").itemsize >= 4 else "L"
+
+
+# Array type code of the column for each property index data type
+columnTypeCodes = {
+    "real": "f",
+    "double": "d",
+    "enumerated": uint32TypeCode(),
+    "unsignedInteger": uint32TypeCode(),
+    "signedInteger": "i",
+    "bool": "B"}
+
+
+class PointStore(object):
+    """One typed array per data type. allocate() appends a value and returns its slot."""
+
+    def __init__(self):
+        self.columns = dict((dataType, array.array(typeCode)) for dataType, typeCode in columnTypeCodes.items())
+
+    def allocate(self, dataType, value):
+        column = self.columns[dataType]
+        column.append(value)
+        return len(column) - 1
+
+    def accessor(self, dataType, value, writable=False, onWrite=None):
+        # Stores the value and returns an accessor for the property index
+        return ColumnAccessor(self.columns[dataType], self.allocate(dataType, value), writable, onWrite)
+
+    def pointCount(self):
+        return sum(len(column) for column in self.columns.values())
+
+    def memoryReport(self):
+        # Returns (dataType, values, bytes) for every column, and the total number of bytes
+        report = []
+        total = 0
+        for dataType in sorted(self.columns):
+            column = self.columns[dataType]
+            size = sys.getsizeof(column)
+            report.append((dataType, len(column), size))
+            total += size
+        return report, total
+
+    def summary(self):
+        report, total = self.memoryReport()
+        return "values=%d bytes=%d %s" % (self.pointCount(), total, " ".join(
+            "%s=%d/%dB" % entry for entry in report))
+
+
+class ColumnAccessor(object):
+    """Reads, and optionally writes, one slot of a PointStore column."""
+    __slots__ = ("column", "slot", "writable", "onWrite")
+
+    def __init__(self, column, slot, writable=False, onWrite=None):
+        self.column = column
+        self.slot = slot
+        self.writable = writable
+        self.onWrite = onWrite
+
+    def get(self, useArrayIndex, propertyArrayIndex):
+        return self.column[self.slot]
+
+    def set(self, value, useArrayIndex, propertyArrayIndex):
+        try:
+            self.column[self.slot] = value
+        except (OverflowError, TypeError):
+            # Out of range for the column type (e.g. a negative unsigned value)
+            return False
+        if self.onWrite is not None:
+            self.onWrite(self)
+        return True
+
+
+class PointMetadata(object):
+    """The rarely used, read only, text properties of an object."""
+    __slots__ = ("objectName", "activeText", "inactiveText", "stateText")
+
+    def __init__(self, record):
+        self.objectName = record.get("objectName")
+        self.activeText = record.get("activeText")
+        self.inactiveText = record.get("inactiveText")
+        self.stateText = record.get("stateText")
+
+    # Lets the record based accessors of the property index (FieldAccessor, ArrayElementAccessor, ...) read it
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
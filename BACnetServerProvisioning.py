@@ -0,0 +1,394 @@
+#
+# BACnet Server Example Provisioning
+# Registers devices and objects with the CAS BACnet Stack in bulk from a point list, instead of one hand-written block
+# of BACnetStack_AddObject/SetPropertyEnabled/SetPropertySubscribable/SetPropertyWritable calls per object.
+#
+# What has to be registered for an object only depends on its object type, so every object type has a profile. The
+# profiles are resolved to enumeration values once, and the point list is validated once up front, so registering an
+# object is just the AddObject call plus the calls its profile lists.
+#
+# Point lists are JSON or CSV files.
+#
+# JSON:
+#     {"devices": [{"instance": 389002, "objectName": "Device Ruby",
+#                   "objects": [{"type": "analogInput", "instance": 0, "objectName": "AI 0", "presentValue": 20.5,
+#                                "units": 62, "covIncrement": 1.0}]}]}
+#
+# CSV, one row per object. A row with the type "device" defines the device itself. Empty cells are ignored and
+# stateText is separated by "|":
+#     device,type,instance,objectName,presentValue,units,covIncrement
+#     389002,device,389002,Device Ruby,,,
+#     389002,analogInput,0,AI 0,20.5,62,1.0
+#
+
+import csv
+import json
+import sys
+import time
+
+from CASBACnetStackAdapter import *
+
+# Profiles
+# ---------------------------------------------------------------------------
+# The optional properties each object type enables, makes subscribable (COV) and makes writable. Anything not listed
+# is implied by the object type and handled by the CAS BACnet Stack (e.g. the presentValue of commandable objects).
+objectTypeProfiles = {
+    "device": {"enabled": (), "subscribable": (), "writable": ()},
+    "analogInput": {"enabled": ("covincrement", "reliability"), "subscribable": ("presentValue",),
+                    "writable": ("covincrement",)},
+    "analogOutput": {"enabled": (), "subscribable": (), "writable": ()},
+    "analogValue": {"enabled": ("reliability", "covincrement"), "subscribable": ("presentValue",),
+                    "writable": ("presentValue", "covincrement")},
+    "binaryInput": {"enabled": ("activetext", "inactivetext"), "subscribable": ("presentValue",), "writable": ()},
+    "binaryOutput": {"enabled": (), "subscribable": (), "writable": ()},
+    "binaryValue": {"enabled": ("activetext", "inactivetext"), "subscribable": ("presentValue",),
+                    "writable": ("presentValue",)},
+    "multiStateInput": {"enabled": ("statetext",), "subscribable": ("presentValue",), "writable": ()},
+    "multiStateOutput": {"enabled": ("statetext",), "subscribable": (), "writable": ()},
+    "multiStateValue": {"enabled": ("statetext",), "subscribable": ("presentValue",), "writable": ("presentValue",)},
+    "characterstringValue": {"enabled": (), "subscribable": (), "writable": ()},
+    "integerValue": {"enabled": (), "subscribable": (), "writable": ()},
+    "largeAnalogValue": {"enabled": (), "subscribable": (), "writable": ()},
+    "positiveIntegerValue": {"enabled": (), "subscribable": (), "writable": ()},
+    "networkPort": {"enabled": ("fdbbmdaddress", "fdsubscriptionlifetime"), "subscribable": (),
+                    "writable": ("fdbbmdaddress", "fdsubscriptionlifetime")}}
+
+# Optional BACnet services enabled on every device
+deviceServices = ("readPropertyMultiple", "writeProperty", "writePropertyMultiple", "subscribeCov",
+                  "subscribeCovProperty", "reinitializeDevice", "deviceCommunicationControl", "iAm",
+                  "confirmedTextMessage", "unconfirmedTextMessage")
+
+
+def parseText(value):
+    # Leaves text (including unicode text from JSON on Python 2) as it is
+    return value if hasattr(value, "encode") else str(value)
+
+
+def openCsv(path):
+    # Point list CSV files are UTF-8. The Python 2 csv module only reads bytes, its cells are decoded by decodeCell.
+    if sys.version_info[0] < 3:
+        return open(path, "rb")
+    return open(path, newline="", encoding="utf-8")
+
+
+def decodeCell(text):
+    # CSV cells are text like the strings of a JSON point list, also on Python 2. Raises UnicodeDecodeError (a
+    # ValueError) if a cell is not UTF-8.
+    return text.decode("utf-8") if isinstance(text, bytes) else text
+
+
+# Parsers for the presentValue of each object type, used for CSV cells and to validate JSON values
+presentValueParsers = {
+    "analogInput": float,
+    "analogOutput": float,
+    "analogValue": float,
+    "binaryInput": int,
+    "binaryOutput": int,
+    "binaryValue": int,
+    "multiStateInput": int,
+    "multiStateOutput": int,
+    "multiStateValue": int,
+    "characterstringValue": parseText,
+    "integerValue": int,
+    "largeAnalogValue": float,
+    "positiveIntegerValue": int}
+
+# Parsers for the other fields a point list can set
+fieldParsers = {
+    "instance": int,
+    "objectName": parseText,
+    "units": int,
+    "reliability": int,
+    "covIncrement": float,
+    "activeText": parseText,
+    "inactiveText": parseText,
+    "numberOfStates": int,
+    "stateText": lambda text: text.split("|"),
+    "vendorname": parseText,
+    "vendoridentifier": int}
+
+# Fields an object of these types must have, besides instance and objectName
+requiredFields = {
+    "networkPort": ("BACnetIPUDPPort", "ipAddress", "ipDefaultGateway", "ipDnsServer", "ipSubnetMask",
+                    "FdBbmdAddressHostIp", "FdBbmdAddressHostType", "FdBbmdAddressPort", "FdSubscriptionLifetime",
+                    "changesPending")}
+
+# Used when a device in a point list does not name its vendor
+defaultVendorName = "Example Chipkin Automation Systems"
+defaultVendorIdentifier = 0
+
+# Highest valid BACnet object instance
+maxObjectInstance = 4194302
+
+# Stop validating after this many errors
+maxReportedErrors = 20
+
+
+class ObjectProfile(object):
+    """An object type profile resolved to CAS BACnet Stack enumeration values."""
+    __slots__ = ("objectType", "enabled", "subscribable", "writable")
+
+    def __init__(self, objectTypeName, profile):
+        self.objectType = bacnet_objectType[objectTypeName]
+        self.enabled = tuple(bacnet_propertyIdentifier[name] for name in profile["enabled"])
+        self.subscribable = tuple(bacnet_propertyIdentifier[name] for name in profile["subscribable"])
+        self.writable = tuple(bacnet_propertyIdentifier[name] for name in profile["writable"])
+
+
+profiles = dict((name, ObjectProfile(name, profile)) for name, profile in objectTypeProfiles.items())
+services = tuple(casbacnetstack_service[name] for name in deviceServices)
+
+
+class ProvisioningError(ValueError):
+    """A point list that cannot be provisioned. errors lists every problem found."""
+
+    def __init__(self, errors):
+        ValueError.__init__(self, "\n".join(errors))
+        self.errors = errors
+
+
+# Point lists
+# ---------------------------------------------------------------------------
+class PointList(object):
+    """Devices to provision. Each device is a list of (objectTypeName, record) pairs, starting with its device
+    object. Records use the same fields as the example database (db)."""
+
+    def __init__(self):
+        self.devices = []
+
+    def addDevice(self, record):
+        objects = [("device", record)]
+        self.devices.append(objects)
+        return objects
+
+    def addDatabase(self, database):
+        # Adds a device in the layout of the example database, one object per object type
+        objects = self.addDevice(database["device"])
+        objects.extend((name, record) for name, record in database.items() if name != "device")
+        return objects
+
+    def extend(self, other):
+        self.devices.extend(other.devices)
+
+    def objectCount(self):
+        return sum(len(objects) for objects in self.devices)
+
+
+def FromDatabase(database):
+    pointList = PointList()
+    pointList.addDatabase(database)
+    return pointList
+
+
+def LoadJson(path):
+    with open(path) as jsonFile:
+        document = json.load(jsonFile)
+    pointList = PointList()
+    for deviceDefinition in document.get("devices", []):
+        record = dict((key, value) for key, value in deviceDefinition.items() if key != "objects")
+        objects = pointList.addDevice(record)
+        for objectDefinition in deviceDefinition.get("objects", []):
+            record = dict((key, value) for key, value in objectDefinition.items() if key != "type")
+            objects.append((objectDefinition.get("type"), record))
+    return pointList
+
+
+def LoadCsv(path):
+    pointList = PointList()
+    deviceObjects = {}
+    with openCsv(path) as csvFile:
+        for line, row in enumerate(csv.DictReader(csvFile), 2):
+            objectTypeName = row.pop("type", None)
+            deviceInstance = row.pop("device", None)
+            record = {}
+            try:
+                for field, text in row.items():
+                    if text is None or text == "" or field is None:
+                        continue
+                    text = decodeCell(text)
+                    if field == "presentValue":
+                        record[field] = presentValueParsers.get(objectTypeName, parseText)(text)
+                    else:
+                        record[field] = fieldParsers.get(field, parseText)(text)
+                deviceInstance = int(deviceInstance)
+            except (TypeError, ValueError) as error:
+                raise ProvisioningError(["%s line %d: %s" % (path, line, error)])
+
+            objects = deviceObjects.get(deviceInstance)
+            if objectTypeName == "device":
+                if objects is not None:
+                    raise ProvisioningError(["%s line %d: device %d is defined twice" % (path, line, deviceInstance)])
+                deviceObjects[deviceInstance] = pointList.addDevice(record)
+            elif objects is None:
+                raise ProvisioningError(["%s line %d: device %d must be defined before its objects" % (
+                    path, line, deviceInstance)])
+            else:
+                objects.append((objectTypeName, record))
+    return pointList
+
+
+def Load(path, report=None):
+    start = time.time()
+    if path.lower().endswith(".csv"):
+        pointList = LoadCsv(path)
+    else:
+        pointList = LoadJson(path)
+    if report is not None:
+        report.phases.append(("load", time.time() - start))
+    return pointList
+
+
+# Validation
+# ---------------------------------------------------------------------------
+def Validate(pointList, report=None):
+    """Checks the whole point list once, before anything is registered. Fills in defaults. Raises ProvisioningError
+    listing the problems found."""
+    start = time.time()
+    errors = []
+    deviceInstances = set()
+
+    def error(message, *args):
+        errors.append(message % args)
+        if len(errors) >= maxReportedErrors:
+            raise ProvisioningError(errors)
+
+    for objects in pointList.devices:
+        deviceRecord = objects[0][1]
+        deviceInstance = deviceRecord.get("instance")
+        if not isinstance(deviceInstance, int) or not 0 <= deviceInstance <= maxObjectInstance:
+            error("Invalid device instance %r", deviceInstance)
+            continue
+        if deviceInstance in deviceInstances:
+            error("Device %d is defined twice", deviceInstance)
+        deviceInstances.add(deviceInstance)
+        deviceRecord.setdefault("objectName", "Device " + str(deviceInstance))
+        deviceRecord.setdefault("vendorname", defaultVendorName)
+        deviceRecord.setdefault("vendoridentifier", defaultVendorIdentifier)
+
+        objectIds = set()
+        objectNames = set()
+        for objectTypeName, record in objects:
+            where = "device %d %s:%s" % (deviceInstance, objectTypeName, record.get("instance"))
+            if objectTypeName not in profiles:
+                error("%s: unsupported object type", where)
+                continue
+            instance = record.get("instance")
+            if not isinstance(instance, int) or not 0 <= instance <= maxObjectInstance:
+                error("%s: invalid instance", where)
+                continue
+            if (objectTypeName, instance) in objectIds:
+                error("%s: defined twice", where)
+            objectIds.add((objectTypeName, instance))
+
+            objectName = record.get("objectName")
+            if not objectName:
+                error("%s: missing objectName", where)
+            elif objectName in objectNames:
+                error("%s: objectName %r is not unique", where, objectName)
+            objectNames.add(objectName)
+
+            for field in requiredFields.get(objectTypeName, ()):
+                if field not in record:
+                    error("%s: missing %s", where, field)
+            if "presentValue" in record and objectTypeName in presentValueParsers:
+                try:
+                    record["presentValue"] = presentValueParsers[objectTypeName](record["presentValue"])
+                except (TypeError, ValueError):
+                    error("%s: invalid presentValue %r", where, record["presentValue"])
+            if "stateText" in record and "numberOfStates" in record and \
+                    len(record["stateText"]) != record["numberOfStates"]:
+                error("%s: numberOfStates does not match stateText", where)
+
+    if errors:
+        raise ProvisioningError(errors)
+    if report is not None:
+        report.phases.append(("validate", time.time() - start))
+
+
+# Registration
+# ---------------------------------------------------------------------------
+class ProvisioningReport(object):
+    """Counts and phase timings (seconds) of a Provision call."""
+
+    def __init__(self):
+        self.devices = 0
+        self.objects = 0
+        self.calls = 0
+        self.failedCalls = 0
+        self.objectTypes = {}
+        self.phases = []
+
+    def summary(self):
+        return "devices=%d objects=%d stackCalls=%d failedCalls=%d %s" % (
+            self.devices, self.objects, self.calls, self.failedCalls,
+            " ".join("%s=%.3fs" % phase for phase in self.phases))
+
+
+def Provision(stack, pointList, indexDevice=None, report=None):
+    """Registers every device and object of a validated point list with the CAS BACnet Stack, then calls
+    indexDevice(objects) for every device. Raises ProvisioningError if the stack rejects a device or an object."""
+    report = ProvisioningReport() if report is None else report
+    start = time.time()
+
+    # Look the stack functions up once
+    addDevice = stack.BACnetStack_AddDevice
+    setServiceEnabled = stack.BACnetStack_SetServiceEnabled
+    addObject = stack.BACnetStack_AddObject
+    addNetworkPortObject = stack.BACnetStack_AddNetworkPortObject
+    setPropertyEnabled = stack.BACnetStack_SetPropertyEnabled
+    setPropertySubscribable = stack.BACnetStack_SetPropertySubscribable
+    setPropertyWritable = stack.BACnetStack_SetPropertyWritable
+    networkPortType = casbacnetstack_networkType["ipv4"]
+    networkPortProtocolLevel = casbacnetstack_protocolLevel["bacnet-application"]
+
+    calls = 0
+    failedCalls = 0
+    objectTypes = report.objectTypes
+    for objects in pointList.devices:
+        deviceInstance = objects[0][1]["instance"]
+        if not addDevice(deviceInstance):
+            raise ProvisioningError(["Failed to add device %d" % deviceInstance])
+        for service in services:
+            setServiceEnabled(deviceInstance, service, True)
+        calls += 1 + len(services)
+
+        for objectTypeName, record in objects[1:]:
+            profile = profiles[objectTypeName]
+            objectType = profile.objectType
+            objectInstance = record["instance"]
+            if objectTypeName == "networkPort":
+                added = addNetworkPortObject(deviceInstance, objectInstance, networkPortType,
+                                             networkPortProtocolLevel, casbacnetstack_network_port_lowest_protocol_level)
+            else:
+                added = addObject(deviceInstance, objectType, objectInstance)
+            if not added:
+                raise ProvisioningError(["Failed to add device %d %s:%d" % (
+                    deviceInstance, objectTypeName, objectInstance)])
+            calls += 1
+
+            for propertyIdentifier in profile.enabled:
+                if not setPropertyEnabled(deviceInstance, objectType, objectInstance, propertyIdentifier, True):
+                    failedCalls += 1
+            for propertyIdentifier in profile.subscribable:
+                if not setPropertySubscribable(deviceInstance, objectType, objectInstance, propertyIdentifier, True):
+                    failedCalls += 1
+            for propertyIdentifier in profile.writable:
+                if not setPropertyWritable(deviceInstance, objectType, objectInstance, propertyIdentifier, True):
+                    failedCalls += 1
+            calls += len(profile.enabled) + len(profile.subscribable) + len(profile.writable)
+            objectTypes[objectTypeName] = objectTypes.get(objectTypeName, 0) + 1
+
+        report.devices += 1
+        report.objects += len(objects)
+
+    report.calls += calls
+    report.failedCalls += failedCalls
+    report.phases.append(("register", time.time() - start))
+
+    if indexDevice is not None:
+        start = time.time()
+        for objects in pointList.devices:
+            indexDevice(objects)
+        report.phases.append(("index", time.time() - start))
+    return report
+
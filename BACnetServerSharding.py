@@ -0,0 +1,406 @@
+#
+# BACnet Server Example Sharding
+# Spreads the devices of the example over several worker processes, so a gateway hosting many devices is not limited
+# to one core. A supervisor process forks the workers and restarts any that exit. Each worker loads its own CAS BACnet
+# Stack instance and provisions only the devices of its shard: the gateway device (db) belongs to shard 0, every other
+# device to shard deviceInstance % workers.
+#
+# Every worker binds the BACnet/IP UDP ports with SO_REUSEPORT. The kernel delivers every broadcast (Who-Is,
+# Who-Has, ...) to all of them, so each shard answers for its own devices, and spreads the unicast datagrams over them
+# by peer address. A worker that receives a unicast datagram for a device of another shard forwards it to the owner
+# over a UNIX datagram socket, with the peer's connection string appended, and the owner passes it to its stack as if
+# it had read it off its own socket. The reply is sent from the owner's socket, which is bound to the same address.
+#
+# The devices other than the gateway device are on the virtual network behind it (BACNET_VIRTUAL_NETWORK), each with
+# its device instance as its MAC address (see VirtualAddress() of the example). A client reaches them through the
+# gateway as a router, so its requests carry the virtual network as DNET and the device's MAC address as DADR. The
+# owner of a datagram is found from its BVLL and NPDU headers:
+#
+#     Original-Unicast-NPDU, DNET of the      A request routed to a virtual device: the shard that hosts the device
+#     virtual network and DADR                with the device instance of the DADR (DeviceOfAddress())
+#     Original-Unicast-NPDU, DNET 0xFFFF, or  A remote broadcast sent to this address: every shard
+#     DNET of the virtual network, no DADR
+#     Forwarded-NPDU from a peer on no local  A broadcast a BBMD on another subnet sent to this address, as to a
+#     subnet                                  registered foreign device: every shard
+#     Original-Broadcast-NPDU, Forwarded-NPDU Delivered to every shard by the kernel already, not forwarded
+#     from a peer on a local subnet
+#     anything else                           Shard 0: the gateway device, network layer messages, BVLL messages,
+#                                             requests routed to any other network
+#
+# A unicast request without DNET is for the gateway device, as on a real router, and goes to shard 0. A virtual
+# device on another shard is only reached by a routed request, as it is without workers.
+#
+# The destination address of a datagram is not available to the workers (Python 2 has no recvmsg), so a
+# Forwarded-NPDU is told apart by its sender. Register as a foreign device with a BBMD on another subnet only, and use
+# two-hop distribution (the default) between BBMDs: a one-hop directed broadcast from a BBMD on another subnet is
+# delivered to every shard by the kernel and forwarded as well, so it would be answered more than once.
+#
+# The workers write their counters into a ShardTable, a table in memory shared with the supervisor, which prints it
+# every minute and when it stops. The point values stay in the point store of the worker that owns them.
+#
+# Set BACNET_WORKERS=N to run N workers. Linux only (fork, SO_REUSEPORT, UNIX datagram sockets).
+#
+
+import errno
+import mmap
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+
+import BACnetServerDatagrams
+
+# BVLL
+bvllTypeBACnetIP = 0x81
+bvllForwardedNpdu = 0x04
+bvllOriginalUnicastNpdu = 0x0A
+bvllOriginalBroadcastNpdu = 0x0B
+
+# NPDU control octet: DNET, DLEN and DADR present
+npduDestinationSpecifier = 0x20
+globalBroadcastNetwork = 0xFFFF
+
+# Owner of a datagram for every shard, see Shard.owner()
+everyShard = -1
+
+# The peer's connection string is appended to a forwarded datagram
+forwardedTrailerSize = 6
+
+# Seconds between the reports of the supervisor
+reportInterval = 60.0
+
+
+def ShardOf(deviceInstance, workerCount, gatewayInstance):
+    """The shard that hosts a device: shard 0 for the gateway device, deviceInstance % workerCount otherwise."""
+    if deviceInstance == gatewayInstance:
+        return 0
+    return deviceInstance % workerCount
+
+
+def DeviceOfAddress(buffer, offset, length):
+    # The device instance of a virtual device from its MAC address (DADR), see VirtualAddress() of the example
+    deviceInstance = 0
+    for index in range(offset, offset + length):
+        deviceInstance = (deviceInstance << 8) | buffer[index]
+    return deviceInstance
+
+
+def WorkerAddress(address, index):
+    """The metrics address (see BACnetServerMetrics) of a worker: the port plus the worker index, or the path with the
+    worker index appended."""
+    if address.startswith("unix:"):
+        return "%s.%d" % (address, index)
+    host, _, port = address.rpartition(":")
+    return "%s:%d" % (host, int(port) + index)
+
+
+def InterruptWorker(signalNumber, frame):
+    # Signal handler of the workers. The first SIGINT or SIGTERM stops the worker with a KeyboardInterrupt, so it
+    # closes its files on the way out. A SIGINT from the terminal reaches a worker along with the SIGTERM the
+    # supervisor passes on, the second one must not interrupt the shutdown.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt()
+
+
+class ShardTable(object):
+    """A row of counters per worker, in an anonymous shared memory map created by the supervisor before it forks, so
+    it sees what the workers write. Each worker only writes its own row."""
+
+    fields = ("pid", "starts", "startTime", "updateTime", "devices", "points", "ticks", "received", "steered",
+              "forwardedIn", "callbacks")
+    rowStruct = struct.Struct("<2i2d7Q")
+
+    def __init__(self, workerCount):
+        self.workerCount = workerCount
+        self.map = mmap.mmap(-1, self.rowStruct.size * workerCount)
+
+    def read(self, index):
+        return dict(zip(self.fields, self.rowStruct.unpack_from(self.map, index * self.rowStruct.size)))
+
+    def write(self, index, row):
+        self.rowStruct.pack_into(self.map, index * self.rowStruct.size, *[row[field] for field in self.fields])
+
+    def update(self, index, **values):
+        row = self.read(index)
+        row.update(values)
+        row["updateTime"] = time.time()
+        self.write(index, row)
+
+    def callbacksPerSecond(self, row):
+        elapsed = row["updateTime"] - row["startTime"]
+        return row["callbacks"] / elapsed if row["startTime"] and elapsed > 0 else 0.0
+
+    def summary(self):
+        """One line per worker and a line with the totals."""
+        lines = []
+        totals = dict((field, 0) for field in self.fields[4:])
+        totalRate = 0.0
+        for index in range(self.workerCount):
+            row = self.read(index)
+            rate = self.callbacksPerSecond(row)
+            totalRate += rate
+            for field in totals:
+                totals[field] += row[field]
+            lines.append("shard=%d/%d pid=%d starts=%d " % (index, self.workerCount, row["pid"], row["starts"]) +
+                         " ".join("%s=%d" % (field, row[field]) for field in self.fields[4:]) +
+                         " callbacksPerSecond=%.0f" % rate)
+        lines.append("total " + " ".join("%s=%d" % (field, totals[field]) for field in self.fields[4:]) +
+                     " callbacksPerSecond=%.0f" % totalRate)
+        return lines
+
+
+class ForwardedRing(BACnetServerDatagrams.DatagramRing):
+    """The datagrams other workers forwarded to this one, read off its end of the forwarding socket pair. The ring
+    slots hold the datagram followed by its peer's connection string, the ring pops them like any other."""
+
+    def __init__(self, sock, slots=256, memmove=None):
+        BACnetServerDatagrams.DatagramRing.__init__(self, sock, slots,
+                                                    BACnetServerDatagrams.defaultSlotSize + forwardedTrailerSize,
+                                                    memmove)
+
+    def fill(self):
+        batch = 0
+        produced = self.produced
+        while produced - self.consumed < self.size:
+            slot = produced % self.size
+            buffer = self.buffers[slot]
+            try:
+                length = self.sock.recv_into(buffer, self.slotSize)
+            except socket.error as error:
+                if error.errno not in BACnetServerDatagrams.wouldBlockErrors:
+                    self.errors += 1
+                else:
+                    # Drained
+                    self.overflowing = False
+                break
+            if length <= forwardedTrailerSize:
+                self.errors += 1
+                continue
+            length -= forwardedTrailerSize
+            self.lengths[slot] = length
+            self.peers[slot] = bytes(bytearray(buffer[length:length + forwardedTrailerSize]))
+            produced += 1
+            self.produced = produced
+            batch += 1
+        else:
+            # Counted once per backlog, as in DatagramRing.fill()
+            if BACnetServerDatagrams.DatagramWaiting(self.sock):
+                if not self.overflowing:
+                    self.overflowing = True
+                    self.overflows += 1
+            else:
+                self.overflowing = False
+        if batch:
+            self.drains += 1
+            self.received += batch
+            self.highWater = max(self.highWater, produced - self.consumed)
+        return batch
+
+
+class Shard(object):
+    """The shard of one worker: which devices it hosts, and where the datagrams for the other shards go."""
+
+    def __init__(self, index, workerCount, gatewayInstance, virtualNetwork, channels, table, supervisorPid,
+                 memmove=None):
+        self.index = index
+        self.workerCount = workerCount
+        self.gatewayInstance = gatewayInstance
+        # Network number of the virtual network of the devices other than the gateway device
+        self.virtualNetwork = virtualNetwork
+        self.table = table
+        self.supervisorPid = supervisorPid
+        # Suffix of the files (state file, write log, field source sockets) of this worker
+        self.suffix = "." + str(index)
+        # channels[i]: the socket pair that forwards to worker i. Only this worker reads from its own.
+        self.forwardSockets = [channel[0] for channel in channels]
+        for forwardSocket in self.forwardSockets:
+            forwardSocket.setblocking(False)
+        for channelIndex, channel in enumerate(channels):
+            if channelIndex != index:
+                channel[1].close()
+        receiveSocket = channels[index][1]
+        receiveSocket.setblocking(False)
+        self.ring = ForwardedRing(receiveSocket, memmove=memmove)
+        # The BACnetServerInterfaces.PortSet of this worker, see attach()
+        self.portSet = None
+
+        # Counters
+        self.forwarded = 0
+        self.broadcasts = 0
+        self.forwardErrors = 0
+
+    def owns(self, deviceInstance):
+        return ShardOf(deviceInstance, self.workerCount, self.gatewayInstance) == self.index
+
+    def owner(self, buffer, length, peer):
+        """The shard a datagram from the network is for, or everyShard. peer is the sender's connection string."""
+        if length < 6 or buffer[0] != bvllTypeBACnetIP:
+            return 0
+        function = buffer[1]
+        if function == bvllOriginalBroadcastNpdu:
+            return self.index
+        if function == bvllForwardedNpdu:
+            # Broadcast on a local subnet by its BBMD, or sent to this address alone by a BBMD elsewhere
+            if self.portSet is None or self.portSet.local(socket.inet_ntoa(peer[:4])) is not None:
+                return self.index
+            return everyShard
+        if function != bvllOriginalUnicastNpdu or not buffer[5] & npduDestinationSpecifier or length < 9:
+            return 0
+        # NPDU at 4: version, control, DNET (2), DLEN, DADR
+        network = (buffer[6] << 8) | buffer[7]
+        addressLength = buffer[8]
+        if network == globalBroadcastNetwork:
+            return everyShard
+        if network != self.virtualNetwork:
+            return 0
+        if addressLength == 0:
+            return everyShard
+        if length < 9 + addressLength:
+            return 0
+        return ShardOf(DeviceOfAddress(buffer, 9, addressLength), self.workerCount, self.gatewayInstance)
+
+    def steer(self, buffer, length, peer):
+        # DatagramRing steering hook. Returns True if the datagram is for this shard (too), after forwarding it to any
+        # other shard it is for.
+        owner = self.owner(buffer, length, peer)
+        if owner == self.index:
+            return True
+        frame = bytes(bytearray(buffer[0:length])) + peer
+        if owner != everyShard:
+            self.forward(owner, frame)
+            return False
+        self.broadcasts += 1
+        for index in range(self.workerCount):
+            if index != self.index:
+                self.forward(index, frame)
+        return True
+
+    def forward(self, index, frame):
+        try:
+            self.forwardSockets[index].send(frame)
+        except socket.error:
+            # The owner is not keeping up (its socket buffer is full) or is restarting
+            self.forwardErrors += 1
+            return
+        self.forwarded += 1
+
+    def attach(self, portSet):
+        """Steers the datagrams of every port of a BACnetServerInterfaces.PortSet, and adds the forwarded datagrams to
+        the datagrams it passes to the stack."""
+        self.portSet = portSet
+        for port in portSet.ports:
+            port.ring.steer = self.steer
+        portSet.addRing(self.ring)
+
+    def report(self, portSet, **values):
+        """Writes the counters of this worker into its row of the ShardTable: the datagram counters of a
+        BACnetServerInterfaces.PortSet, and the given values."""
+        self.table.update(self.index, received=sum(port.ring.received for port in portSet.ports),
+                          steered=sum(port.ring.steered for port in portSet.ports), forwardedIn=self.ring.received,
+                          **values)
+
+    def orphaned(self):
+        # True once the supervisor is gone
+        return os.getppid() != self.supervisorPid
+
+    def summary(self):
+        return "shard=%d/%d forwarded=%d broadcasts=%d forwardErrors=%d forwardedIn=%d" % (
+            self.index, self.workerCount, self.forwarded, self.broadcasts, self.forwardErrors, self.ring.received)
+
+
+class Supervisor(object):
+    """Forks the workers and restarts any that exit, until it is stopped with SIGINT or SIGTERM."""
+
+    def __init__(self, workerCount, gatewayInstance, virtualNetwork, memmove=None, restartDelay=1.0, stopTimeout=5.0):
+        self.workerCount = workerCount
+        self.gatewayInstance = gatewayInstance
+        self.virtualNetwork = virtualNetwork
+        self.memmove = memmove
+        self.restartDelay = restartDelay
+        self.stopTimeout = stopTimeout
+        self.table = ShardTable(workerCount)
+        self.channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(workerCount)]
+        # Worker process id to worker index
+        self.workers = {}
+        self.starts = [0] * workerCount
+        self.stopTime = None
+        self.terminated = False
+
+    def run(self):
+        """Forks the workers. Returns the Shard of the worker in every worker process. In the supervisor it only
+        returns to fork a worker again, and exits once the workers have stopped."""
+        pid = os.getpid()
+        for index in range(self.workerCount):
+            shard = self.fork(index, pid)
+            if shard is not None:
+                return shard
+        print("FYI: Supervisor pid=" + str(pid) + " started " + str(self.workerCount) + " workers")
+
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        nextReport = time.time() + reportInterval
+        while self.workers:
+            try:
+                exitedPid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                break
+            if exitedPid == 0:
+                time.sleep(0.1)
+                now = time.time()
+                if self.stopTime is not None and not self.terminated and now - self.stopTime > self.stopTimeout:
+                    self.signalWorkers(signal.SIGKILL)
+                    self.terminated = True
+                if now >= nextReport:
+                    self.report()
+                    nextReport = now + reportInterval
+                continue
+
+            index = self.workers.pop(exitedPid, None)
+            if index is None or self.stopTime is not None:
+                continue
+            print("Error: Worker " + str(index) + " pid=" + str(exitedPid) + " exited with status " + str(status) +
+                  ", restarting it in " + str(self.restartDelay) + " seconds")
+            time.sleep(self.restartDelay)
+            if self.stopTime is None:
+                shard = self.fork(index, pid)
+                if shard is not None:
+                    return shard
+        self.report()
+        sys.exit(0)
+
+    def fork(self, index, supervisorPid):
+        # Returns the Shard in the new worker, None in the supervisor
+        self.starts[index] += 1
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, InterruptWorker)
+            signal.signal(signal.SIGTERM, InterruptWorker)
+            self.table.write(index, dict((field, 0) for field in ShardTable.fields))
+            self.table.update(index, pid=os.getpid(), starts=self.starts[index])
+            os.environ["BACNET_SHARD"] = "%d/%d" % (index, self.workerCount)
+            return Shard(index, self.workerCount, self.gatewayInstance, self.virtualNetwork, self.channels, self.table,
+                         supervisorPid, self.memmove)
+        self.workers[pid] = index
+        return None
+
+    def stop(self, signalNumber, frame):
+        # Passes a SIGINT or SIGTERM on to the workers. Workers still running stopTimeout seconds later are killed.
+        if self.stopTime is None:
+            self.stopTime = time.time()
+            self.signalWorkers(signal.SIGTERM)
+
+    def signalWorkers(self, signalNumber):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signalNumber)
+            except OSError:
+                pass
+
+    def report(self):
+        for line in self.table.summary():
+            print("FYI: Shards: " + line)
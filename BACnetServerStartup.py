@@ -0,0 +1,86 @@
+#
+# BACnet Server Example Startup
+# Keeps the time from process start to the first I-Am short, for small gateways where every import counts.
+#
+# StartupTimer breaks the startup time down by phase. The example prints the phases once it enters its main loop:
+#
+#     FYI: Startup phases: imports=41.2ms stack=0.3ms network=2.1ms callbacks=0.4ms provision=1.0ms ... total=47.5ms
+#
+# and "python BACnetServerBenchmark.py startup" runs the example a few times and reports the median of each phase.
+#
+# Work the first I-Am does not depend on (DNS server discovery, default gateways) runs as a BackgroundTask on its own
+# thread. Its result is taken from the event loop thread, so the records the callbacks read are only changed there.
+#
+
+import threading
+import time
+
+
+class StartupTimer(object):
+    """Time spent in each startup phase, from startTime (by default when the timer is created)."""
+
+    def __init__(self, startTime=None):
+        self.startTime = time.time() if startTime is None else startTime
+        self.lastTime = self.startTime
+        # (phase, seconds)
+        self.phases = []
+
+    def mark(self, phase):
+        # Ends a phase that started when the previous one ended
+        now = time.time()
+        self.phases.append((phase, now - self.lastTime))
+        self.lastTime = now
+
+    def total(self):
+        return self.lastTime - self.startTime
+
+    def summary(self):
+        return " ".join(["%s=%.1fms" % (phase, seconds * 1000.0) for phase, seconds in self.phases] +
+                        ["total=%.1fms" % (self.total() * 1000.0)])
+
+
+def ParseSummary(line):
+    """The (phase, milliseconds) pairs of a StartupTimer summary, total included."""
+    phases = []
+    for item in line.split():
+        phase, separator, value = item.partition("=")
+        if separator and value.endswith("ms"):
+            try:
+                phases.append((phase, float(value[:-2])))
+            except ValueError:
+                pass
+    return phases
+
+
+class BackgroundTask(object):
+    """Runs function() once on a daemon thread. The thread that started it picks the result up with take()."""
+
+    def __init__(self, function, name):
+        self.function = function
+        self.name = name
+        self.finished = threading.Event()
+        self.taken = False
+        self.result = None
+        self.error = None
+        self.duration = 0.0
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name=self.name)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        start = time.time()
+        try:
+            self.result = self.function()
+        except Exception as error:
+            self.error = error
+        self.duration = time.time() - start
+        self.finished.set()
+
+    def take(self):
+        # Returns True once, the first time it is called after the task finished. result or error is set then.
+        if self.taken or not self.finished.is_set():
+            return False
+        self.taken = True
+        return True
@@ -0,0 +1,146 @@
+#
+# BACnet Server Example Batched Updates
+# Applies many point value changes at once and tells the CAS BACnet Stack about the ones that matter.
+#
+# BACnetStack_ValueUpdated is a ctypes call per point, so calling it for every change a field bus reports quickly
+# becomes the bottleneck. The ChangeBatcher applies every change to the point store right away (so reads always see
+# the latest value), but only forwards a change to the stack when a COV notification could result from it:
+#
+# - Analog presentValues (real, double) are only forwarded once they moved at least covIncrement away from the value
+#   last forwarded. The CAS BACnet Stack compares against the value of the last notification with the same
+#   covIncrement, so smaller changes could not trigger a notification anyway.
+# - Any other value is only forwarded when it actually changed the stored value.
+# - A point changed several times in one batch is forwarded once, after the whole batch is applied.
+#
+# A COV subscription made between two forwarded values starts from a value the batcher did not forward, so call
+# forwardSuppressed() now and then (e.g. from a timer) to bring every point with a suppressed change up to date.
+#
+# Values written through BACnet change the point store without going through the batcher, and the CAS BACnet Stack
+# already knows about them. Call written() for every accepted write so the deadband is measured from the written value.
+#
+
+# Property index data types that are compared against the covIncrement
+analogDataTypes = ("real", "double")
+
+# Property index data types an update can resolve to, in lookup order
+updateDataTypes = ("real", "double", "enumerated", "unsignedInteger", "signedInteger", "bool")
+
+
+class UpdateTarget(object):
+    """A point the batcher has seen an update for."""
+    __slots__ = ("key", "accessor", "covIncrement", "reference", "suppressed")
+
+    def __init__(self, key, accessor, covIncrement, reference):
+        self.key = key
+        self.accessor = accessor
+        # Accessor of the covIncrement of an analog presentValue, otherwise None
+        self.covIncrement = covIncrement
+        # Value last forwarded to the stack, or written through BACnet
+        self.reference = reference
+        # True while a change has been applied but not forwarded
+        self.suppressed = False
+
+
+class ChangeBatcher(object):
+    """Applies batches of (deviceInstance, objectType, objectInstance, propertyIdentifier, value) updates through the
+    property index, and calls valueUpdated(deviceInstance, objectType, objectInstance, propertyIdentifier) for the
+    changes a COV notification could result from."""
+
+    def __init__(self, propertyIndex, valueUpdated, presentValueIdentifier, covIncrementIdentifier):
+        self.propertyIndex = propertyIndex
+        self.valueUpdated = valueUpdated
+        self.presentValueIdentifier = presentValueIdentifier
+        self.covIncrementIdentifier = covIncrementIdentifier
+        self.targets = {}
+
+        # Counters
+        self.batches = 0
+        self.updates = 0
+        self.forwarded = 0
+        self.suppressedDeadband = 0
+        self.suppressedUnchanged = 0
+        self.unknown = 0
+        self.rejected = 0
+
+    def resolve(self, key):
+        # Finds the accessor of a point the first time it is updated
+        for dataType in updateDataTypes:
+            accessor = self.propertyIndex[dataType].get(key)
+            if accessor is not None and hasattr(accessor, "set"):
+                break
+        else:
+            return None
+
+        covIncrement = None
+        if dataType in analogDataTypes and key[3] == self.presentValueIdentifier:
+            covIncrement = self.propertyIndex["real"].get(key[:3] + (self.covIncrementIdentifier,))
+        target = self.targets[key] = UpdateTarget(key, accessor, covIncrement, accessor.get(False, 0))
+        return target
+
+    def apply(self, updates):
+        """Applies a batch of updates. Returns the number of ValueUpdated calls made."""
+        targets = self.targets
+        forward = {}
+        count = 0
+        for deviceInstance, objectType, objectInstance, propertyIdentifier, value in updates:
+            count += 1
+            key = (deviceInstance, objectType, objectInstance, propertyIdentifier)
+            target = targets.get(key)
+            if target is None:
+                target = self.resolve(key)
+                if target is None:
+                    self.unknown += 1
+                    continue
+
+            accessor = target.accessor
+            covIncrement = target.covIncrement
+            if covIncrement is None:
+                previous = accessor.get(False, 0)
+            if not accessor.set(value, False, 0):
+                self.rejected += 1
+                continue
+
+            if covIncrement is not None:
+                if abs(value - target.reference) < covIncrement.get(False, 0):
+                    target.suppressed = True
+                    self.suppressedDeadband += 1
+                    # An earlier change in this batch may have left the deadband, this one is back inside it
+                    forward.pop(key, None)
+                    continue
+            elif value == previous:
+                # An earlier change in this batch, if any, is still forwarded
+                self.suppressedUnchanged += 1
+                continue
+            forward[key] = target
+
+        self.batches += 1
+        self.updates += count
+        return self.forward(forward.values())
+
+    def forward(self, targets):
+        valueUpdated = self.valueUpdated
+        forwarded = 0
+        for target in targets:
+            target.reference = target.accessor.get(False, 0)
+            target.suppressed = False
+            valueUpdated(*target.key)
+            forwarded += 1
+        self.forwarded += forwarded
+        return forwarded
+
+    def written(self, key):
+        """Called after a BACnet write changed the point with this key. The stack knows the written value already, so
+        it becomes the reference and any suppressed change is dropped."""
+        target = self.targets.get(key)
+        if target is not None:
+            target.reference = target.accessor.get(False, 0)
+            target.suppressed = False
+
+    def forwardSuppressed(self):
+        """Forwards every point with a change that was suppressed by the deadband. Returns the number forwarded."""
+        return self.forward([target for target in self.targets.values() if target.suppressed])
+
+    def summary(self):
+        return ("batches=%d updates=%d forwarded=%d suppressedDeadband=%d suppressedUnchanged=%d unknown=%d "
+                "rejected=%d" % (self.batches, self.updates, self.forwarded, self.suppressedDeadband,
+                                 self.suppressedUnchanged, self.unknown, self.rejected))
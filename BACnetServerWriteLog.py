@@ -0,0 +1,184 @@
+#
+# BACnet Server Example Write Log
+# An append only write-ahead log of every write accepted through the SetProperty callbacks, with the priority it was
+# written at and when.
+#
+# Writes are collected in memory and committed with group commit: the example calls commit() once after every
+# BACnetStack_Tick, so one write and one fsync cover every write of that tick, however many WriteProperty or
+# WritePropertyMultiple requests it handled. The stack sends the write acknowledgement from inside the tick, so a
+# crash can lose the writes of at most the last tick.
+#
+# At startup the log is replayed, keeping the latest record of each property, and then compacted to only those
+# records. Records are compared by their raw identity bytes, so replay does not unpack anything but the records that
+# are restored. The log is also compacted when it grows to more than twice the number of properties it holds.
+#
+# File layout: an 8 byte header (magic, version, record size) followed by 48 byte records (little endian):
+#     [0:16]  uint8 dataType, pad, uint16 objectType, uint32 deviceInstance, uint32 objectInstance,
+#             uint32 propertyIdentifier (the record identity, as in BACnetServerPersistence)
+#     [16:28] double timestamp, uint8 priority, 3 pad
+#     [28:44] value (BACnetServerPersistence.PackValue)
+#     [44:48] uint32 CRC-32 of bytes 0 to 44
+# A record with a bad CRC, or a partial record, ends the replay (a write torn by a crash) and is dropped.
+#
+
+import os
+import struct
+import time
+import zlib
+
+from BACnetServerPersistence import dataTypeCodes, dataTypeNames, PackValue, UnpackValue
+
+fileMagic = b"BACW"
+fileVersion = 1
+
+headerStruct = struct.Struct("<4sHH")
+identityStruct = struct.Struct("<BxHIII")
+identitySize = 16
+stampStruct = struct.Struct("<dB3x")
+valueOffset = 28
+crcStruct = struct.Struct("<I")
+crcOffset = 44
+recordSize = 48
+
+# First record byte of every known data type
+validDataTypeCodes = set(struct.pack("<B", code) for code in dataTypeNames)
+
+
+def PackRecord(dataType, key, value, priority, timestamp):
+    # key: (deviceInstance, objectType, objectInstance, propertyIdentifier)
+    record = bytearray(recordSize)
+    identityStruct.pack_into(record, 0, dataTypeCodes[dataType], key[1], key[0], key[2], key[3])
+    stampStruct.pack_into(record, identitySize, timestamp, priority)
+    PackValue(record, valueOffset, dataType, value)
+    crcStruct.pack_into(record, crcOffset, zlib.crc32(bytes(record[:crcOffset])) & 0xffffffff)
+    return bytes(record)
+
+
+def UnpackRecord(record):
+    # Returns (dataType, key, value, priority, timestamp)
+    dataTypeCode, objectType, deviceInstance, objectInstance, propertyIdentifier = identityStruct.unpack_from(record, 0)
+    timestamp, priority = stampStruct.unpack_from(record, identitySize)
+    dataType = dataTypeNames[dataTypeCode]
+    return (dataType, (deviceInstance, objectType, objectInstance, propertyIdentifier),
+            UnpackValue(record, valueOffset, dataType), priority, timestamp)
+
+
+class WriteAheadLog(object):
+    """Appends written values to a log file, committing them in groups. The latest record of every property is kept
+    in memory for compaction and restoring."""
+
+    def __init__(self, path, compactMinimum=4096):
+        self.path = path
+        # Log records are not compacted away before the log holds this many
+        self.compactMinimum = compactMinimum
+        # Latest record of each property, by its identity bytes
+        self.latest = {}
+        self.pending = []
+        self.file = None
+
+        # Counters
+        self.records = 0
+        self.replayed = 0
+        self.tornBytes = 0
+        self.appended = 0
+        self.commits = 0
+        self.committed = 0
+        self.commitTimeTotal = 0.0
+        self.commitTimeMax = 0.0
+        self.compactions = 0
+
+        if self.replay() and self.records == len(self.latest):
+            self.file = open(path, "ab")
+        else:
+            # New, torn, or with records of overwritten values
+            self.compact()
+
+    def replay(self):
+        # Reads the log into self.latest. Returns False if the file is missing or not a log this version can read.
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "rb") as logFile:
+            data = logFile.read()
+        if len(data) < headerStruct.size or headerStruct.unpack_from(data, 0) != (fileMagic, fileVersion, recordSize):
+            return False
+
+        latest = self.latest
+        end = headerStruct.size
+        while end + recordSize <= len(data):
+            record = data[end:end + recordSize]
+            if zlib.crc32(record[:crcOffset]) & 0xffffffff != crcStruct.unpack_from(record, crcOffset)[0] or \
+                    record[0:1] not in validDataTypeCodes:
+                break
+            latest[record[:identitySize]] = record
+            end += recordSize
+        self.records = self.replayed = (end - headerStruct.size) // recordSize
+        self.tornBytes = len(data) - end
+        return self.tornBytes == 0
+
+    def append(self, dataType, key, value, priority, timestamp=None):
+        """Adds a write to the next commit."""
+        record = PackRecord(dataType, key, value, priority, time.time() if timestamp is None else timestamp)
+        self.pending.append(record)
+        self.latest[record[:identitySize]] = record
+        self.appended += 1
+
+    def commit(self):
+        """Writes and fsyncs every write appended since the last commit. Returns the number of writes committed."""
+        if not self.pending:
+            return 0
+        start = time.time()
+        pending, self.pending = self.pending, []
+        self.file.write(b"".join(pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        duration = time.time() - start
+        self.commitTimeTotal += duration
+        if duration > self.commitTimeMax:
+            self.commitTimeMax = duration
+        self.commits += 1
+        self.committed += len(pending)
+        self.records += len(pending)
+        if self.records > max(self.compactMinimum, 2 * len(self.latest)):
+            self.compact()
+        return len(pending)
+
+    def compact(self):
+        """Rewrites the log with only the latest record of each property."""
+        compactPath = self.path + ".compact"
+        with open(compactPath, "wb") as compactFile:
+            compactFile.write(headerStruct.pack(fileMagic, fileVersion, recordSize))
+            compactFile.write(b"".join(self.latest.values()))
+            compactFile.flush()
+            os.fsync(compactFile.fileno())
+        if self.file is not None:
+            self.file.close()
+        if os.name == "nt" and os.path.exists(self.path):
+            # os.rename does not replace an existing file on Windows
+            os.remove(self.path)
+        os.rename(compactPath, self.path)
+        self.file = open(self.path, "ab")
+        self.records = len(self.latest)
+        self.compactions += 1
+
+    def items(self):
+        # Yields (dataType, key, value) for the latest write of every property
+        for record in self.latest.values():
+            yield UnpackRecord(record)[:3]
+
+    def writes(self):
+        # Yields (dataType, key, value, priority, timestamp) for the latest write of every property
+        for record in self.latest.values():
+            yield UnpackRecord(record)
+
+    def close(self):
+        self.commit()
+        self.file.close()
+
+    def summary(self):
+        return ("path=%s values=%d records=%d replayed=%d tornBytes=%d appended=%d commits=%d writesPerCommit=%.1f "
+                "commitAvg=%.6f commitMax=%.6f compactions=%d" % (
+                    self.path, len(self.latest), self.records, self.replayed, self.tornBytes, self.appended,
+                    self.commits, self.committed / float(self.commits) if self.commits else 0.0,
+                    self.commitTimeTotal / self.commits if self.commits else 0.0, self.commitTimeMax,
+                    self.compactions))
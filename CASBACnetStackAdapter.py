@@ -6,8 +6,9 @@
 
 import ctypes
 import platform
+import struct
 
-casbacnetstack_adapter_version = "0.0.4"  # For CASBACnetStack version 3.25.0 or greater
+casbacnetstack_adapter_version = "0.0.5"  # For CASBACnetStack version 3.25.0 or greater
 
 # libname
 # ---------------------------------------------------------------------------
@@ -22,26 +23,30 @@ casbacnetstack_adapter_version = "0.0.4"  # For CASBACnetStack version 3.25.0 or
 # print("platform.machine()           ",  platform.machine())
 # print("platform.architecture()      ",  platform.architecture())
 
-if platform.system() == "Windows":
-    if platform.architecture()[0] == '64bit':
+# platform.architecture() runs the "file" command on every call, which is slow on small ARM gateways. The size of a
+# pointer tells the same for the running interpreter, which is what the library has to match.
+systemName = platform.system()
+architectureBits = struct.calcsize("P") * 8
+if systemName == "Windows":
+    if architectureBits == 64:
         libname = "CASBACnetStack_x64_Debug.dll"
-    elif platform.architecture()[0] == "32bit":
+    elif architectureBits == 32:
         libname = "CASBACnetStack_x86_Debug.dll"
     else:
-        print("Error: Could not detect the platform.architecture", platform.architecture())
-elif platform.system() == "Linux":
-    if platform.architecture()[0] == "64bit":
+        print("Error: Could not detect the platform.architecture", architectureBits)
+elif systemName == "Linux":
+    if architectureBits == 64:
         libname = "libCASBACnetStack_x64_Debug.so"
-    elif platform.architecture()[0] == "32bit":
+    elif architectureBits == 32:
         if "armv7" in platform.machine():
             # Raspberry PI 3 or 4. Arm7
             libname = "libCASBACnetStack_arm7_Release.so"
         else:
             libname = "CASBACnetStack_x86_Debug.so"
     else:
-        print("Error: Could not detect the platform.architecture", platform.architecture())
+        print("Error: Could not detect the platform.architecture", architectureBits)
 else:
-    print("Error: Could not detect the platform.system", platform.system())
+    print("Error: Could not detect the platform.system", systemName)
 
 # Callbacks ---------------------------------------------------------------------------
 # https://docs.python.org/3/library/ctypes.html#callback-functions Factory functions are called with the result type
@@ -230,9 +235,155 @@ fpHookPropertyUInt = ctypes.CFUNCTYPE(None, ctypes.c_uint32, ctypes.c_uint8, cty
                                       ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint8, ctypes.c_uint8, ctypes.c_uint16,
                                       ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint8)
 
+# Functions ---------------------------------------------------------------------------
+# (restype, argtypes) of the BACnetStack_* functions, see CASBACnetStackDLL.h. LoadCASBACnetStack() declares them
+# once when the library is loaded, so call sites pass plain ints and bools, and the bool results are not read as
+# whatever happens to be in the upper bits of an int.
+casbacnetstack_functions = {
+    # Versions
+    "BACnetStack_GetAPIMajorVersion": (ctypes.c_uint32, []),
+    "BACnetStack_GetAPIMinorVersion": (ctypes.c_uint32, []),
+    "BACnetStack_GetAPIPatchVersion": (ctypes.c_uint32, []),
+    "BACnetStack_GetAPIBuildVersion": (ctypes.c_uint32, []),
+
+    # Provisioning
+    "BACnetStack_AddDevice": (ctypes.c_bool, [ctypes.c_uint32]),
+    "BACnetStack_AddObject": (ctypes.c_bool, [ctypes.c_uint32, ctypes.c_uint16, ctypes.c_uint32]),
+    "BACnetStack_AddNetworkPortObject": (ctypes.c_bool, [ctypes.c_uint32, ctypes.c_uint32, ctypes.c_uint8,
+                                                         ctypes.c_uint8, ctypes.c_uint32]),
+    "BACnetStack_SetServiceEnabled": (ctypes.c_bool, [ctypes.c_uint32, ctypes.c_uint8, ctypes.c_bool]),
+    "BACnetStack_SetPropertyEnabled": (ctypes.c_bool, [ctypes.c_uint32, ctypes.c_uint16, ctypes.c_uint32,
+                                                       ctypes.c_uint32, ctypes.c_bool]),
+    "BACnetStack_SetPropertySubscribable": (ctypes.c_bool, [ctypes.c_uint32, ctypes.c_uint16, ctypes.c_uint32,
+                                                            ctypes.c_uint32, ctypes.c_bool]),
+    "BACnetStack_SetPropertyWritable": (ctypes.c_bool, [ctypes.c_uint32, ctypes.c_uint16, ctypes.c_uint32,
+                                                        ctypes.c_uint32, ctypes.c_bool]),
+
+    # Routing: device instance, network number of the virtual network, MAC address and its length
+    "BACnetStack_AddRoutedDevice": (ctypes.c_bool, [ctypes.c_uint32, ctypes.c_uint16, ctypes.POINTER(ctypes.c_uint8),
+                                                    ctypes.c_uint8]),
+
+    # Runtime
+    "BACnetStack_Tick": (None, []),
+    "BACnetStack_ValueUpdated": (None, [ctypes.c_uint32, ctypes.c_uint16, ctypes.c_uint32, ctypes.c_uint32]),
+    "BACnetStack_SendIAm": (ctypes.c_bool, [ctypes.c_uint32, ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint8,
+                                            ctypes.c_uint8, ctypes.c_bool, ctypes.c_uint16,
+                                            ctypes.POINTER(ctypes.c_uint8), ctypes.c_uint8])}
+
+# BACnetStack_RegisterCallback<Name> functions and the prototype of the callback each one takes
+casbacnetstack_callbackPrototypes = {
+    "ReceiveMessage": fpCallbackReceiveMessage,
+    "SendMessage": fpCallbackSendMessage,
+    "GetSystemTime": fpCallbackGetSystemTime,
+    "GetPropertyBitString": fpCallbackGetPropertyBitString,
+    "GetPropertyBool": fpCallbackGetPropertyBool,
+    "GetPropertyCharacterString": fpCallbackGetPropertyCharString,
+    "GetPropertyDate": fpCallbackGetPropertyDate,
+    "GetPropertyDouble": fpCallbackGetPropertyDouble,
+    "GetPropertyEnumerated": fpCallbackGetPropertyEnum,
+    "GetPropertyOctetString": fpCallbackGetPropertyOctetString,
+    "GetPropertySignedInteger": fpCallbackGetPropertyInt,
+    "GetPropertyReal": fpCallbackGetPropertyReal,
+    "GetPropertyTime": fpCallbackGetPropertyTime,
+    "GetPropertyUnsignedInteger": fpCallbackGetPropertyUInt,
+    "SetPropertyEnumerated": fpCallbackSetPropertyEnum,
+    "SetPropertyOctetString": fpCallbackSetPropertyOctetString,
+    "SetPropertyReal": fpCallbackSetPropertyReal,
+    "SetPropertyUnsignedInteger": fpCallbackSetPropertyUInt,
+    "ReinitializeDevice": fpCallbackReinitializeDevice,
+    "DeviceCommunicationControl": fpCallbackDeviceCommunicationControl,
+    "LogDebugMessage": fpCallbackLogDebugMessage}
+for callbackName, callbackPrototype in casbacnetstack_callbackPrototypes.items():
+    casbacnetstack_functions["BACnetStack_RegisterCallback" + callbackName] = (None, [callbackPrototype])
+
+# Functions called with plain ints on the hot path only get their restype declared. With argtypes, ctypes converts
+# every argument through from_param(), which costs more per call than its default conversion of an int that fits in
+# a C int (all of their arguments do).
+casbacnetstack_uncheckedFunctions = ("BACnetStack_ValueUpdated",)
+
+
+def DeclareFunctions(library):
+    """Sets restype and argtypes of the BACnetStack_* functions of a loaded CAS BACnet Stack library. Returns the
+    names of the functions the library does not export (e.g. an older version)."""
+    missing = []
+    for name, (restype, argtypes) in casbacnetstack_functions.items():
+        try:
+            function = getattr(library, name)
+        except AttributeError:
+            missing.append(name)
+            continue
+        function.restype = restype
+        if name not in casbacnetstack_uncheckedFunctions:
+            function.argtypes = argtypes
+    return sorted(missing)
+
+
+def LoadCASBACnetStack(path, mode=ctypes.RTLD_GLOBAL):
+    """Loads the CAS BACnet Stack library and declares its functions. Returns (library, missing function names)."""
+    library = ctypes.CDLL(path, mode=mode)
+    return library, DeclareFunctions(library)
+
+
+# Memory helpers ---------------------------------------------------------------------------
+# The example moves data into and out of the CAS BACnet Stack buffers only through these, so it runs unchanged on the
+# cffi backend (CASBACnetStackAdapterCffi), which has the same helpers.
+adapterBackend = "ctypes"
+
+# ctypes type of each C type name used by NewArray
+casbacnetstack_cTypes = {
+    "bool": ctypes.c_bool,
+    "char": ctypes.c_char,
+    "uint8_t": ctypes.c_uint8,
+    "uint16_t": ctypes.c_uint16,
+    "uint32_t": ctypes.c_uint32,
+    "int32_t": ctypes.c_int32,
+    "uint64_t": ctypes.c_uint64,
+    "float": ctypes.c_float,
+    "double": ctypes.c_double}
+
+# The null pointer argument (cffi does not take None for one)
+NULL = None
+
+# MemoryMove(destination, source, length) and StringAt(address, length) -> bytes
+MemoryMove = ctypes.memmove
+StringAt = ctypes.string_at
+
+
+def NewArray(typeName, length):
+    """A zeroed array of a C type (e.g. "uint8_t"). It is passed to the stack functions and callbacks as a pointer to
+    its first element, so an array of one element stands in for a pointer to a value."""
+    return (casbacnetstack_cTypes[typeName] * length)()
+
+
 # Enumerations
 # ---------------------------------------------------------------------------
 
+class CASBACnetEnumeration(dict):
+    """An enumeration table. Maps names to integer values like a dict, and integer values back to names through a
+    reverse map that is computed on the first name() lookup, so tables that are never reverse looked up cost nothing
+    at startup. Enumeration tables are read-only."""
+    __slots__ = ("reverseMap",)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.reverseMap = None
+
+    @property
+    def names(self):
+        # Value -> name map
+        if self.reverseMap is None:
+            # Should two names share a value, the alphabetically first is kept (dicts are unordered on Python 2)
+            reverseMap = {}
+            for key, value in sorted(self.items()):
+                reverseMap.setdefault(value, key)
+            self.reverseMap = reverseMap
+        return self.reverseMap
+
+    def name(self, value, default=None):
+        # Value -> name lookup
+        return self.names.get(value, default)
+
+
 # Full list in BACnetObjectTypes.h
 bacnet_objectType = {"analogInput": 0, "analogOutput": 1, "analogValue": 2, "binaryInput": 3, "binaryOutput": 4,
                      "binaryValue": 5, "calendar": 6, "command": 7, "device": 8, "eventEnrollment": 9, "file": 10,
@@ -384,7 +535,7 @@ bacnet_propertyIdentifier = {"absenteelimit": 244, "acceptedmodes": 175, "access
                              "variancevalue": 151, "vendoridentifier": 120, "vendorname": 121, "verificationtime": 326,
                              "virtualmacaddresstable": 429, "vtclassessupported": 122, "weeklyschedule": 123,
                              "windowinterval": 147, "windowsamples": 148, "writestatus": 370, "zonefrom": 320,
-                             "zonemembers": 165, "zoneto": 32}
+                             "zonemembers": 165, "zoneto": 321}
 
 # Full list in BACnetEngineeringUnits.h
 bacnet_engineeringUnits = {"meterspersecondpersecond": 166, "squaremeters": 0, "squarecentimeters": 116,
@@ -491,3 +642,16 @@ casbacnetstack_fdBbmdAddressOffset = {"host": 1, "port": 2}
 casbacnetstack_network_port_lowest_protocol_level = 4194303
 
 casbacnet_debugMessageType = {"Error": 0, "Info": 1}
+
+# Wrap the enumeration tables so that values can be resolved back to names in O(1)
+bacnet_objectType = CASBACnetEnumeration(bacnet_objectType)
+bacnet_propertyIdentifier = CASBACnetEnumeration(bacnet_propertyIdentifier)
+bacnet_engineeringUnits = CASBACnetEnumeration(bacnet_engineeringUnits)
+bacnet_reliability = CASBACnetEnumeration(bacnet_reliability)
+bacnet_errorCode = CASBACnetEnumeration(bacnet_errorCode)
+casbacnetstack_service = CASBACnetEnumeration(casbacnetstack_service)
+casbacnetstack_reinitializeState = CASBACnetEnumeration(casbacnetstack_reinitializeState)
+casbacnetstack_networkType = CASBACnetEnumeration(casbacnetstack_networkType)
+casbacnetstack_protocolLevel = CASBACnetEnumeration(casbacnetstack_protocolLevel)
+casbacnetstack_fdBbmdAddressOffset = CASBACnetEnumeration(casbacnetstack_fdBbmdAddressOffset)
+casbacnet_debugMessageType = CASBACnetEnumeration(casbacnet_debugMessageType)
@@ -0,0 +1,101 @@
+#
+# CAS BACnet Stack Python Adapter, cffi backend
+# The same fpCallback*/fpHook* prototypes, BACnetStack_* functions, enumerations and memory helpers as
+# CASBACnetStackAdapter, built on cffi instead of ctypes. cffi callbacks are cheaper to enter than ctypes CFUNCTYPE
+# trampolines, and cffi is the fast foreign function interface of PyPy, so with this backend the example also runs
+# under PyPy.
+#
+# The C signatures are derived from the ctypes declarations of CASBACnetStackAdapter, so the two backends cannot drift
+# apart. The library is opened in ABI mode (ffi.dlopen), which needs no compiler.
+#
+# The example uses this backend when BACNET_ADAPTER=cffi (see BACnetServerExample). Package name: cffi.
+#
+
+import ctypes
+
+import cffi
+
+import CASBACnetStackAdapter
+from CASBACnetStackAdapter import *  # Enumerations, libname and the version
+
+adapterBackend = "cffi"
+
+ffi = cffi.FFI()
+
+# C type names of the ctypes types used by the declarations. c_int32 is the same type as c_int on most platforms, the
+# sized name is used then.
+cTypeNames = {}
+for cTypeName, cType in sorted(CASBACnetStackAdapter.casbacnetstack_cTypes.items()) + [("int", ctypes.c_int)]:
+    cTypeNames.setdefault(cType, cTypeName)
+
+
+def CTypeName(cType, name=""):
+    """The C declaration of a ctypes type, with an optional declarator name: a scalar, a pointer or a CFUNCTYPE
+    function pointer."""
+    if cType is None:
+        return ("void " + name).strip()
+    if issubclass(cType, ctypes._Pointer):
+        return CTypeName(cType._type_, "*" + name)
+    if issubclass(cType, ctypes._CFuncPtr):
+        return CTypeName(cType._restype_, "(*%s)(%s)" % (name, Parameters(cType._argtypes_)))
+    return (cTypeNames[cType] + " " + name).strip()
+
+
+def Parameters(argtypes):
+    return ", ".join(CTypeName(argType) for argType in argtypes) or "void"
+
+
+# The CFUNCTYPE prototypes of CASBACnetStackAdapter, by name
+prototypes = dict((name, getattr(CASBACnetStackAdapter, name)) for name in dir(CASBACnetStackAdapter)
+                  if name.startswith(("fpCallback", "fpHook")))
+
+# Parsing C declarations is the slow part of importing this module, and every ffi.typeof() of a new type is a parse,
+# so all of them are parsed at once: the functions, and the prototypes as the fields of one struct.
+ffi.cdef("\n".join(
+    ["%s;" % CTypeName(restype, "%s(%s)" % (name, Parameters(argtypes)))
+     for name, (restype, argtypes) in sorted(casbacnetstack_functions.items())] +
+    ["struct casbacnetstack_prototypes {"] +
+    ["    %s;" % CTypeName(prototype, name) for name, prototype in sorted(prototypes.items())] +
+    ["};"]))
+
+
+class CallbackPrototype(object):
+    """Makes cffi callbacks of one C function pointer type. Called with a Python function like a ctypes CFUNCTYPE,
+    it returns the callback to register with the stack. Keep a reference to it for as long as it is registered."""
+
+    def __init__(self, ctype):
+        self.ctype = ctype
+
+    def __call__(self, function):
+        # An exception in the callback is printed and the stack gets 0 (false), as with ctypes
+        return ffi.callback(self.ctype, function)
+
+
+# fpCallback* and fpHook* prototypes with the same names as in CASBACnetStackAdapter
+for prototypeName, prototypeField in ffi.typeof("struct casbacnetstack_prototypes").fields:
+    globals()[prototypeName] = CallbackPrototype(prototypeField.type)
+
+
+def LoadCASBACnetStack(path, mode=None):
+    """Loads the CAS BACnet Stack library. Returns (library, names of the declared functions it does not export)."""
+    library = ffi.dlopen(path, ffi.RTLD_NOW | ffi.RTLD_GLOBAL if mode is None else mode)
+    missing = []
+    for name in casbacnetstack_functions:
+        try:
+            getattr(library, name)
+        except AttributeError:
+            missing.append(name)
+    return library, sorted(missing)
+
+
+# Memory helpers, see CASBACnetStackAdapter
+NULL = ffi.NULL
+MemoryMove = ffi.memmove
+
+
+def StringAt(address, length):
+    return ffi.buffer(address, length)[:]
+
+
+def NewArray(typeName, length):
+    return ffi.new("%s[%d]" % (typeName, length))
@@ -0,0 +1,78 @@
+#
+# Tests of BACnetServerDatagrams. Run with "python -m pytest" or "python -m unittest test_BACnetServerDatagrams".
+#
+
+import ctypes
+import socket
+import time
+import unittest
+
+import BACnetServerDatagrams
+
+
+class DatagramRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(("127.0.0.1", 0))
+        self.receiver.setblocking(False)
+        self.sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.message = (ctypes.c_uint8 * 1500)()
+        self.connectionString = (ctypes.c_uint8 * 6)()
+
+    def tearDown(self):
+        self.receiver.close()
+        self.sender.close()
+
+    def send(self, count=1):
+        for _ in range(count):
+            self.sender.sendto(b"\x81\x0a\x00\x04", self.receiver.getsockname())
+        # Until the datagrams are queued on the receiving socket
+        time.sleep(0.05)
+
+    def test_delay_is_measured_from_arrival(self):
+        ring = BACnetServerDatagrams.DatagramRing(self.receiver, memmove=ctypes.memmove)
+        BACnetServerDatagrams.EnableArrivalTimes(self.receiver)
+        ring.timestamping = True
+        self.send()
+        time.sleep(0.1)
+        self.assertEqual(ring.receive(self.message, 1500, self.connectionString), 4)
+        self.assertGreaterEqual(ring.queueDelayMax, 0.1)
+        self.assertLess(ring.queueDelayMax, 1.0)
+
+    def test_overflow_is_counted_once_per_backlog(self):
+        ring = BACnetServerDatagrams.DatagramRing(self.receiver, slots=2, memmove=ctypes.memmove)
+        self.send(2)
+        self.assertEqual(ring.fill(), 2)
+        self.assertEqual(ring.overflows, 0)
+        self.send(3)
+        for _ in range(3):
+            self.assertEqual(ring.fill(), 0)
+        self.assertEqual(ring.overflows, 1)
+        # Drain the backlog, then fill up again
+        for _ in range(5):
+            ring.receive(self.message, 1500, self.connectionString)
+        self.assertEqual(ring.fill(), 0)
+        self.send(3)
+        ring.fill()
+        ring.fill()
+        self.assertEqual(ring.overflows, 2)
+
+    def test_receiver_thread_waits_for_the_stack(self):
+        ring = BACnetServerDatagrams.ThreadedReceiver(self.receiver, slots=2, memmove=ctypes.memmove)
+        ring.start()
+        try:
+            self.send(4)
+            # The ring stays full while nothing is taken from it
+            time.sleep(0.1)
+            self.assertEqual((ring.count, ring.overflows), (2, 1))
+            # Taking a datagram wakes the receiver thread up, which refills the ring right away
+            self.assertEqual(ring.receive(self.message, 1500, self.connectionString), 4)
+            time.sleep(0.05)
+            self.assertEqual((ring.count, ring.received, ring.overflows), (2, 3, 1))
+        finally:
+            ring.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+#
+# Tests of BACnetServerEventLoop. Run with "python -m pytest" or "python -m unittest test_BACnetServerEventLoop".
+#
+
+import os
+import signal
+import threading
+import time
+import unittest
+
+import BACnetServerEventLoop
+
+
+@unittest.skipUnless(hasattr(signal, "SIGUSR1"), "needs SIGUSR1")
+class SignalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.signals = []
+        self.previousHandler = signal.signal(signal.SIGUSR1, lambda signalNumber, frame: self.signals.append(1))
+        self.ticks = []
+        self.loop = BACnetServerEventLoop.EventLoop(lambda: self.ticks.append(1), maxIdleInterval=5.0)
+
+    def tearDown(self):
+        signal.signal(signal.SIGUSR1, self.previousHandler)
+        self.loop.close()
+
+    def runWithSignal(self):
+        # Sends SIGUSR1 (the instrumentation toggle of the example) while the loop waits in poll()
+        def Send():
+            time.sleep(0.2)
+            os.kill(os.getpid(), signal.SIGUSR1)
+        sender = threading.Thread(target=Send)
+        sender.start()
+        self.loop.addTimer(0.5, self.loop.stop, repeat=False)
+        self.loop.run()
+        sender.join()
+
+    def test_signal_during_epoll(self):
+        self.runWithSignal()
+        self.assertEqual(self.signals, [1])
+        self.assertFalse(self.loop.running)
+
+    def test_signal_during_select(self):
+        self.loop.close()
+        self.loop.epoll = None
+        self.runWithSignal()
+        self.assertEqual(self.signals, [1])
+        self.assertFalse(self.loop.running)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+#
+# Tests of BACnetServerSharding. Run with "python -m pytest" or "python -m unittest test_BACnetServerSharding".
+#
+
+import socket
+import struct
+import unittest
+
+import BACnetServerInterfaces
+import BACnetServerSharding
+
+gatewayInstance = 389999
+virtualNetwork = 1000
+localPeer = socket.inet_aton("192.168.1.20") + struct.pack("!H", 47808)
+remotePeer = socket.inet_aton("10.20.30.40") + struct.pack("!H", 47808)
+
+
+def Datagram(function, npdu):
+    return bytearray(struct.pack("!BBH", 0x81, function, 4 + len(npdu)) + npdu)
+
+
+def RoutedNpdu(deviceInstance, network=virtualNetwork):
+    # Routed to the virtual network, with the device instance as the DADR
+    return b"\x01\x24" + struct.pack("!HB", network, 4) + struct.pack("!I", deviceInstance) + b"\xff\x00\x05\x01\x0c"
+
+
+class OwnerTest(unittest.TestCase):
+
+    def setUp(self):
+        channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(4)]
+        self.sockets = [sock for channel in channels for sock in channel]
+        self.shard = BACnetServerSharding.Shard(1, 4, gatewayInstance, virtualNetwork, channels, None, 0)
+        port = BACnetServerInterfaces.BACnetIPPort("eth0", 47808)
+        port.setAddress([192, 168, 1, 10], [255, 255, 255, 0])
+        self.shard.portSet = BACnetServerInterfaces.PortSet([port])
+
+    def tearDown(self):
+        self.shard.portSet.close()
+        for sock in self.sockets:
+            sock.close()
+
+    def owner(self, datagram, peer=localPeer):
+        return self.shard.owner(datagram, len(datagram), peer)
+
+    def test_routed_request_goes_to_the_owner_of_the_device(self):
+        self.assertEqual(self.owner(Datagram(0x0A, RoutedNpdu(390002))), 390002 % 4)
+        self.assertEqual(self.owner(Datagram(0x0A, RoutedNpdu(gatewayInstance))), 0)
+
+    def test_unicast_without_dnet_goes_to_the_gateway(self):
+        # A ReadProperty of device 390002 sent to it directly instead of through the virtual network
+        npdu = b"\x01\x04\x00\x05\x01\x0c\x0c\x02\x00\x5f\x32\x19\x4b"
+        self.assertEqual(self.owner(Datagram(0x0A, npdu)), 0)
+
+    def test_request_routed_to_another_network_goes_to_the_gateway(self):
+        self.assertEqual(self.owner(Datagram(0x0A, RoutedNpdu(390002, network=2000))), 0)
+
+    def test_remote_broadcast_goes_to_every_shard(self):
+        npdu = b"\x01\x20" + struct.pack("!HB", 0xFFFF, 0) + b"\xff\x10\x08"
+        self.assertEqual(self.owner(Datagram(0x0A, npdu)), BACnetServerSharding.everyShard)
+        npdu = b"\x01\x20" + struct.pack("!HB", virtualNetwork, 0) + b"\xff\x10\x08"
+        self.assertEqual(self.owner(Datagram(0x0A, npdu)), BACnetServerSharding.everyShard)
+
+    def test_local_broadcast_stays_on_the_receiving_shard(self):
+        self.assertEqual(self.owner(Datagram(0x0B, b"\x01\x00\x10\x08")), 1)
+
+    def test_forwarded_npdu_from_a_local_bbmd_stays_on_the_receiving_shard(self):
+        self.assertEqual(self.owner(Datagram(0x04, remotePeer + b"\x01\x00\x10\x08")), 1)
+
+    def test_forwarded_npdu_to_a_foreign_device_goes_to_every_shard(self):
+        self.assertEqual(self.owner(Datagram(0x04, localPeer + b"\x01\x00\x10\x08"), remotePeer),
+                         BACnetServerSharding.everyShard)
+
+
+class ForwardedRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, receiver = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.setblocking(False)
+        self.ring = BACnetServerSharding.ForwardedRing(receiver, slots=4)
+
+    def tearDown(self):
+        self.sender.close()
+        self.ring.sock.close()
+
+    def test_overflow_is_counted_once_per_backlog(self):
+        for _ in range(6):
+            self.sender.send(b"\x81\x0a\x00\x04" + localPeer)
+        self.ring.fill()
+        self.ring.fill()
+        self.assertEqual(self.ring.overflows, 1)
+        self.ring.consumed = self.ring.produced
+        self.ring.fill()
+        self.assertFalse(self.ring.overflowing)
+        for _ in range(6):
+            self.sender.send(b"\x81\x0a\x00\x04" + localPeer)
+        self.ring.consumed = self.ring.produced
+        self.ring.fill()
+        self.assertEqual(self.ring.overflows, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+#
+# Tests of BACnetServerUpdates. Run with "python -m pytest" or "python -m unittest test_BACnetServerUpdates".
+#
+
+import unittest
+
+import BACnetServerPointStore
+import BACnetServerUpdates
+
+presentValue = 85
+covIncrement = 22
+binaryValueKey = (389999, 5, 1, presentValue)
+analogValueKey = (389999, 2, 1, presentValue)
+
+
+class ChangeBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        store = BACnetServerPointStore.PointStore()
+        self.binaryValue = store.accessor("enumerated", 1, writable=True)
+        self.analogValue = store.accessor("real", 10.0, writable=True)
+        self.propertyIndex = dict((dataType, {}) for dataType in BACnetServerUpdates.updateDataTypes)
+        self.propertyIndex["enumerated"][binaryValueKey] = self.binaryValue
+        self.propertyIndex["real"][analogValueKey] = self.analogValue
+        self.propertyIndex["real"][analogValueKey[:3] + (covIncrement,)] = store.accessor("real", 1.0)
+        self.updated = []
+        self.batcher = BACnetServerUpdates.ChangeBatcher(self.propertyIndex, lambda *key: self.updated.append(key),
+                                                         presentValue, covIncrement)
+
+    def bacnetWrite(self, accessor, key, value):
+        # What CallbackSetProperty* and PropertyWritten do
+        accessor.set(value, False, 0)
+        self.batcher.written(key)
+
+    def test_unchanged_value_is_not_forwarded(self):
+        self.assertEqual(self.batcher.apply([binaryValueKey + (1,)]), 0)
+        self.assertEqual(self.batcher.suppressedUnchanged, 1)
+
+    def test_change_after_bacnet_write_is_forwarded(self):
+        self.assertEqual(self.batcher.apply([binaryValueKey + (0,)]), 1)
+        self.bacnetWrite(self.binaryValue, binaryValueKey, 1)
+        # Changes the stored value from 1 back to 0, the stack must be told
+        self.assertEqual(self.batcher.apply([binaryValueKey + (0,)]), 1)
+        self.assertEqual(self.binaryValue.get(False, 0), 0)
+        self.assertEqual(self.updated, [binaryValueKey, binaryValueKey])
+
+    def test_change_back_within_a_batch_is_forwarded_once(self):
+        self.assertEqual(self.batcher.apply([binaryValueKey + (0,), binaryValueKey + (0,)]), 1)
+        self.assertEqual(self.batcher.suppressedUnchanged, 1)
+
+    def test_deadband_is_measured_from_the_written_value(self):
+        self.batcher.apply([analogValueKey + (10.5,)])
+        self.bacnetWrite(self.analogValue, analogValueKey, 20.0)
+        self.assertEqual(self.batcher.apply([analogValueKey + (20.5,)]), 0)
+        self.assertEqual(self.batcher.apply([analogValueKey + (11.0,)]), 1)
+        self.assertEqual(self.updated, [analogValueKey])
+
+    def test_write_drops_a_suppressed_change(self):
+        self.batcher.apply([analogValueKey + (10.5,)])
+        self.bacnetWrite(self.analogValue, analogValueKey, 20.0)
+        self.assertEqual(self.batcher.forwardSuppressed(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
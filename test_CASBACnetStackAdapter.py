@@ -0,0 +1,33 @@
+#
+# Tests of the enumeration tables of CASBACnetStackAdapter. Run with "python -m pytest" or
+# "python -m unittest test_CASBACnetStackAdapter".
+#
+
+import unittest
+
+import CASBACnetStackAdapter
+
+
+class EnumerationTest(unittest.TestCase):
+
+    def enumerations(self):
+        return [(name, table) for name, table in sorted(vars(CASBACnetStackAdapter).items())
+                if isinstance(table, CASBACnetStackAdapter.CASBACnetEnumeration)]
+
+    def test_every_value_has_one_name(self):
+        for name, table in self.enumerations():
+            self.assertEqual(len(table.names), len(table), name + " has names that share a value")
+
+    def test_name_is_the_reverse_of_the_table(self):
+        propertyIdentifier = CASBACnetStackAdapter.bacnet_propertyIdentifier
+        self.assertEqual(propertyIdentifier.name(32), "effectiveperiod")
+        self.assertEqual(propertyIdentifier.name(propertyIdentifier["zoneto"]), "zoneto")
+        self.assertEqual(propertyIdentifier.name(-1, "unknown"), "unknown")
+
+    def test_duplicate_values_keep_the_alphabetically_first_name(self):
+        table = CASBACnetStackAdapter.CASBACnetEnumeration({"b": 1, "a": 1, "c": 2})
+        self.assertEqual(table.name(1), "a")
+
+
+if __name__ == "__main__":
+    unittest.main()